@@ -44,6 +44,7 @@ python3 bird_classify.py \
     --labels models/inat_bird_labels.txt \
     --top_k 1 \
     --threshold 0.85 \
+    --motion_threshold 0.01 \
     --storage "$tmp_dir" \
     --visit_interval 10 &
 
@@ -0,0 +1,243 @@
+"""
+Inference backends
+
+Loads the classification model on the Coral EdgeTPU or, when no accelerator
+is attached, on the CPU through tflite_runtime. A backend holds a pool of one
+or more interpreters (one per EdgeTPU, or several CPU interpreters) and hands
+frames to them round-robin, recording latency and throughput per backend.
+
+"""
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pycoral.adapters import common
+
+import metrics
+
+BACKENDS = ('auto', 'edgetpu', 'cpu')
+
+
+def make_input_writer(interpreter, frame_size):
+    """Returns a function that writes an RGB frame of frame_size (width, height)
+    straight into the interpreter's input tensor. Frames already at the model's
+    input size are copied in directly; others are nearest-neighbour sampled
+    with index arrays computed once here."""
+    _, height, width, _ = interpreter.get_input_details()[0]['shape']
+    if tuple(frame_size) == (width, height):
+        def write(frame):
+            np.copyto(common.input_tensor(interpreter), frame)
+    else:
+        rows = (np.arange(height) * frame_size[1] // height)[:, None]
+        cols = np.arange(width) * frame_size[0] // width
+        def write(frame):
+            common.input_tensor(interpreter)[:] = frame[rows, cols]
+    return write
+
+
+def make_top_classes(interpreter):
+    """Returns a function giving the top_k (class id, score) pairs at or above
+    threshold, best first, like pycoral's get_classes. Quantized outputs are
+    ranked as raw uint8 with one argpartition and only the k winners are
+    dequantized, through a 256-entry table computed here."""
+    detail = interpreter.get_output_details()[0]
+    index = detail['index']
+    scale, zero_point = detail['quantization']
+    if scale:
+        table = ((np.arange(256) - zero_point) * scale).astype(np.float32)
+        dequantize = table.__getitem__
+    else:
+        dequantize = lambda scores: scores.astype(np.float32)
+    def top_classes(top_k, threshold):
+        scores = interpreter.tensor(index)().reshape(-1)
+        k = min(top_k, scores.size)
+        ids = np.argpartition(scores, -k)[-k:]
+        values = dequantize(scores[ids])
+        keep = values >= threshold
+        ids, values = ids[keep], values[keep]
+        order = np.argsort(-values, kind='stable')
+        return list(zip(ids[order].tolist(), values[order].tolist()))
+    return top_classes
+
+
+def fuse_max(results_list, top_k):
+    """Merges several classify() results, keeping each class at its highest
+    score; returns the top_k best first."""
+    best = {}
+    for results in results_list:
+        for class_id, score in results:
+            if score > best.get(class_id, -1.0):
+                best[class_id] = score
+    return sorted(best.items(), key=lambda item: -item[1])[:top_k]
+
+
+def cpu_model_path(model_path):
+    """Returns the CPU build of an EdgeTPU model ('..._edgetpu.tflite' -> '....tflite')."""
+    if model_path.endswith('_edgetpu.tflite'):
+        return model_path[:-len('_edgetpu.tflite')] + '.tflite'
+    return model_path
+
+
+def edgetpu_interpreters(model_path, count):
+    """Creates one interpreter per EdgeTPU, up to count."""
+    from pycoral.utils.edgetpu import list_edge_tpus, make_interpreter
+    available = len(list_edge_tpus())
+    if available == 0:
+        raise RuntimeError('No EdgeTPU found.')
+    if count > available:
+        print('Requested %d EdgeTPU interpreters but only %d EdgeTPUs found.' % (count, available))
+        count = available
+    return [make_interpreter(model_path, device=':%d' % i) for i in range(count)]
+
+
+def cpu_interpreters(model_path, count, num_threads, preserve_all_tensors=False):
+    """Creates count CPU interpreters, splitting num_threads between them.
+    preserve_all_tensors keeps intermediate tensors readable after invoke."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    if not os.path.isfile(model_path):
+        raise RuntimeError('CPU model not found: %s (the EdgeTPU-compiled model only runs '
+                           'on a Coral; download the plain quantized model or pass --cpu_model)'
+                           % model_path)
+    threads = max(1, num_threads // count)
+    if preserve_all_tensors:
+        return [Interpreter(model_path=model_path, num_threads=threads,
+                            experimental_preserve_all_tensors=True) for _ in range(count)]
+    return [Interpreter(model_path=model_path, num_threads=threads) for _ in range(count)]
+
+
+def edgetpu_available():
+    try:
+        from pycoral.utils.edgetpu import list_edge_tpus
+        return bool(list_edge_tpus())
+    except (ImportError, RuntimeError, ValueError):
+        return False
+
+
+class Backend:
+    """A pool of allocated interpreters used round-robin, with latency stats."""
+
+    def __init__(self, name, interpreters, frame_size, top_classes_factory=make_top_classes):
+        self.name = name
+        self.interpreters = interpreters
+        self.frame_size = tuple(frame_size)
+        self._slots = [(n, interpreter, make_input_writer(interpreter, frame_size),
+                        top_classes_factory(interpreter), threading.Lock())
+                       for n, interpreter in enumerate(interpreters)]
+        self._next_slot = itertools.cycle(self._slots)
+        self._next_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.invokes = 0
+        self.total_ms = 0.0
+        self._recent = deque(maxlen=100)  # (finish time, latency ms)
+        self._crop_writers = {}  # (interpreter index, (width, height)) -> input writer
+        self._executor = None
+
+    @property
+    def input_size(self):
+        """Model input as (width, height)."""
+        _, height, width, _ = self.interpreters[0].get_input_details()[0]['shape']
+        return int(width), int(height)
+
+    def classify(self, frame, top_k, threshold):
+        """Runs one frame through the next free interpreter; returns the top_k
+        (class id, score) pairs at or above threshold."""
+        with self._next_lock:
+            n, interpreter, write_input, top_classes, lock = next(self._next_slot)
+        size = (frame.shape[1], frame.shape[0])
+        if size != self.frame_size:
+            write_input = self._crop_writer(n, interpreter, size)
+        with lock:
+            start = time.monotonic()
+            with metrics.timer('set_input'):
+                write_input(frame)
+            with metrics.timer('invoke'):
+                interpreter.invoke()
+            with metrics.timer('top_classes'):
+                classes = top_classes(top_k, threshold)
+            end = time.monotonic()
+        latency_ms = (end - start) * 1000
+        with self._stats_lock:
+            self.invokes += 1
+            self.total_ms += latency_ms
+            self._recent.append((end, latency_ms))
+        return classes
+
+    def _crop_writer(self, n, interpreter, size):
+        # Region crops come in a few fixed sizes; their resize indices are cached
+        writer = self._crop_writers.get((n, size))
+        if writer is None:
+            writer = self._crop_writers[(n, size)] = make_input_writer(interpreter, size)
+        return writer
+
+    def classify_many(self, frames, top_k, threshold):
+        """Classifies several frames (such as region crops of one camera frame),
+        spread across the interpreter pool; returns one result list per frame."""
+        if len(frames) == 1 or len(self._slots) == 1:
+            return [self.classify(frame, top_k, threshold) for frame in frames]
+        if self._executor is None:
+            with self._next_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(len(self._slots),
+                                                        thread_name_prefix='classify')
+        return list(self._executor.map(lambda frame: self.classify(frame, top_k, threshold),
+                                       frames))
+
+    def stats(self):
+        """Returns invoke count, mean/recent latency and recent throughput."""
+        with self._stats_lock:
+            recent = list(self._recent)
+            invokes, total_ms = self.invokes, self.total_ms
+        fps = 0.0
+        if len(recent) > 1 and recent[-1][0] > recent[0][0]:
+            fps = (len(recent) - 1) / (recent[-1][0] - recent[0][0])
+        return {
+            'backend': self.name,
+            'interpreters': len(self.interpreters),
+            'invokes': invokes,
+            'mean_ms': total_ms / invokes if invokes else 0.0,
+            'recent_ms': sum(ms for _, ms in recent) / len(recent) if recent else 0.0,
+            'fps': fps,
+        }
+
+    def report(self):
+        s = self.stats()
+        return ('%s x%d: %d invokes, mean %.2f ms, recent %.2f ms, %.2f fps' %
+                (s['backend'], s['interpreters'], s['invokes'], s['mean_ms'],
+                 s['recent_ms'], s['fps']))
+
+
+def make_backend(model_path, frame_size=None, device='auto', pool_size=1,
+                 num_threads=None, cpu_model=None, head=None):
+    """Creates a Backend on the EdgeTPU or CPU. With device='auto' the EdgeTPU is
+    used when one is attached, otherwise the model runs on the CPU.
+    frame_size defaults to the model input size. A head (imprint.Head) replaces
+    the model's classifier and needs the CPU backend."""
+    if device not in BACKENDS:
+        raise ValueError('Unknown backend: %s' % device)
+    if head is not None:
+        if device == 'edgetpu':
+            raise ValueError('A retrained head only runs on the CPU backend')
+        device = 'cpu'
+    if device == 'auto':
+        device = 'edgetpu' if edgetpu_available() else 'cpu'
+    if device == 'edgetpu':
+        interpreters = edgetpu_interpreters(model_path, pool_size)
+    else:
+        interpreters = cpu_interpreters(cpu_model or cpu_model_path(model_path), pool_size,
+                                        num_threads or os.cpu_count() or 1,
+                                        preserve_all_tensors=head is not None)
+    for interpreter in interpreters:
+        interpreter.allocate_tensors()
+    if frame_size is None:
+        _, height, width, _ = interpreters[0].get_input_details()[0]['shape']
+        frame_size = (int(width), int(height))
+    if head is not None:
+        return Backend(device, interpreters, frame_size, head.make_top_classes)
+    return Backend(device, interpreters, frame_size)
@@ -0,0 +1,271 @@
+"""
+Benchmark
+
+Measures the birdcam end to end without a camera or cloud services, so
+throughput changes can be compared between commits:
+
+- the full bird_classify frame path (motion gate, CPU TFLite backend, visit
+  tracking, image saving) fed from videotestsrc or a directory of saved
+  frames, with MongoDB replaced by an in-memory collection and the Hue bridge
+  by fake_hue_bridge; reports frames/sec, per-frame and per-stage latency and
+  the memory high-water mark;
+- dashboard endpoint latency against synthetic storage folders of 1k, 10k
+  and 100k images.
+
+Results are saved as JSON; --compare prints the change against an earlier run.
+
+    python3 benchmark.py --model models/mobilenet_v2_1.0_224_inat_bird_quant_edgetpu.tflite \\
+        --cpu_model models/mobilenet_v2_1.0_224_inat_bird_quant.tflite \\
+        --labels models/inat_bird_labels.txt --output bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+import metrics
+
+BIRDS = ['Northern Cardinal', 'Blue Jay', 'American Goldfinch', 'House Finch',
+         'Black-capped Chickadee', 'Downy Woodpecker', 'Tufted Titmouse', 'Mourning Dove']
+
+ENDPOINTS = ['/', '/api/stats', '/api/bird_counts_raw', '/api/best_image',
+             '/api/latest_image', '/api/images?bird=Blue%20Jay&limit=50', '/bird/Blue%20Jay']
+
+
+class FakeCollection:
+    """In-memory stand-in for the MongoDB collection used by MongoWriter."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def insert_many(self, records, ordered=True):
+        with self._lock:
+            self.records.extend(records)
+
+
+def max_rss_mb():
+    """Peak resident memory of this process so far (Linux reports KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def stage_ms(snapshot):
+    """Per-stage latency quantiles and means from a metrics snapshot, in ms."""
+    stages = {}
+    for stage, h in snapshot['histograms'].items():
+        stages[stage] = {'count': h['count'],
+                         'mean_ms': h['sum'] / h['count'] * 1000 if h['count'] else 0.0}
+        for q, v in h['quantiles'].items():
+            stages[stage]['p%d_ms' % round(float(q) * 100)] = v * 1000
+    return stages
+
+
+def run_pipeline(args):
+    """Runs bird_classify.main on synthetic input with local service stand-ins."""
+    import bird_classify
+    import mongodb
+    import phillips_hue
+    from fake_hue_bridge import FakeHueBridge
+
+    storage = tempfile.mkdtemp(prefix='birdcam-bench-')
+    collection = FakeCollection()
+    mongodb.get_collection = lambda: collection
+    mongodb.mongoDB_connect = lambda: collection
+    bridge = FakeHueBridge(latency=args.hue_latency)
+    hue_config = phillips_hue.load_config()
+    hue_config.update({'bridge_ip': bridge.address, 'username': bridge.username})
+    hue_config_path = os.path.join(storage, 'hue_config.json')
+    with open(hue_config_path, 'w') as f:
+        json.dump(hue_config, f)
+
+    argv = ['--model', args.model, '--labels', args.labels, '--backend', 'cpu',
+            '--storage', storage, '--input', args.input, '--test_frames', str(args.frames),
+            '--web', 'none', '--mongo', 'upload', '--hue_config', hue_config_path,
+            '--mongo_spool', os.path.join(storage, 'mongo_spool.jsonl'),
+            '--pool_size', str(args.pool_size),
+            '--motion_threshold', str(args.motion_threshold),
+            '--threshold', str(args.threshold)]
+    if args.cpu_model:
+        argv += ['--cpu_model', args.cpu_model]
+    if args.num_threads:
+        argv += ['--num_threads', str(args.num_threads)]
+
+    rss_before = max_rss_mb()
+    start = time.monotonic()
+    try:
+        bird_classify.main(argv)
+        elapsed = time.monotonic() - start
+        snapshot = metrics.registry.snapshot()
+        stages = stage_ms(snapshot)
+        frames = stages.get('frame', {}).get('count', 0)
+        result = {
+            'input': args.input,
+            'frames': frames,
+            'seconds': elapsed,
+            'fps': frames / elapsed if elapsed else 0.0,
+            'frame_latency': stages.get('frame', {}),
+            'stages': stages,
+            'counters': {'%s%s' % (name, ''.join('[%s=%s]' % kv for kv in sorted(labels.items()))): value
+                         for name, labels, value in snapshot['counters']},
+            'max_rss_mb': max_rss_mb(),
+            'rss_growth_mb': max_rss_mb() - rss_before,
+            'mongo_records': len(collection.records),
+            'hue_requests': len(bridge.requests),
+        }
+    finally:
+        bridge.close()
+        if not args.keep:
+            shutil.rmtree(storage, ignore_errors=True)
+    return result
+
+
+def make_storage(folder, count, days=7):
+    """Fills folder with count empty img-* files and matching results.log lines."""
+    now = datetime.datetime.now()
+    with open(os.path.join(folder, 'results.log'), 'w') as log:
+        for i in range(count):
+            bird = BIRDS[i % len(BIRDS)]
+            score = 40 + (i * 7) % 60
+            tag = '%s_%02d_%010d' % (bird, score, 1000000 + i)
+            open(os.path.join(folder, 'img-%s.jpg' % tag), 'w').close()
+            when = now - datetime.timedelta(seconds=(count - i) * days * 86400 // count)
+            log.write('%s,000-Image: %s Results: %s Score: %.2f\n' %
+                      (when.strftime('%Y-%m-%d %H:%M:%S'), tag, bird, score / 100.0))
+
+
+def time_request(client, url):
+    start = time.perf_counter()
+    response = client.get(url)
+    response.get_data()
+    return (time.perf_counter() - start) * 1000, response.status_code
+
+
+def run_endpoints(args):
+    """Times dashboard requests against synthetic storage folders."""
+    import flask_server
+
+    client = flask_server.app.test_client()
+    results = {}
+    for count in args.image_counts:
+        storage = tempfile.mkdtemp(prefix='birdcam-bench-web-')
+        try:
+            start = time.monotonic()
+            make_storage(storage, count)
+            print('Created %d images in %.1f s' % (count, time.monotonic() - start))
+            flask_server.configure_app(storage)
+            flask_server.json_cache.clear()
+            endpoints = {}
+            for url in ENDPOINTS:
+                cold_ms, status = time_request(client, url)
+                uncached = []
+                for _ in range(args.requests):
+                    flask_server.json_cache.clear()
+                    uncached.append(time_request(client, url)[0])
+                cached = [time_request(client, url)[0] for _ in range(args.requests)]
+                uncached.sort()
+                endpoints[url] = {
+                    'status': status,
+                    'cold_ms': cold_ms,
+                    'p50_ms': statistics.median(uncached),
+                    'p95_ms': uncached[min(len(uncached) - 1, int(0.95 * len(uncached)))],
+                    'cached_p50_ms': statistics.median(cached),
+                }
+                print('%7d images %-40s cold %8.2f ms  p50 %7.2f ms  cached %6.2f ms' %
+                      (count, url, cold_ms, endpoints[url]['p50_ms'],
+                       endpoints[url]['cached_p50_ms']))
+            results[str(count)] = endpoints
+        finally:
+            shutil.rmtree(storage, ignore_errors=True)
+    return results
+
+
+def compare(old, new):
+    """Prints the change in the headline numbers between two result files."""
+    def change(name, before, after, higher_is_better=False):
+        if not before:
+            return
+        pct = (after - before) / before * 100
+        better = pct > 0 if higher_is_better else pct < 0
+        print('%-60s %10.2f -> %10.2f  %+6.1f%% %s' %
+              (name, before, after, pct, '' if abs(pct) < 5 else ('better' if better else 'WORSE')))
+
+    if old.get('pipeline') and new.get('pipeline'):
+        change('fps', old['pipeline']['fps'], new['pipeline']['fps'], higher_is_better=True)
+        change('max_rss_mb', old['pipeline']['max_rss_mb'], new['pipeline']['max_rss_mb'])
+        for stage, values in sorted(new['pipeline']['stages'].items()):
+            before = old['pipeline']['stages'].get(stage, {}).get('p50_ms')
+            change('%s p50_ms' % stage, before, values.get('p50_ms', 0.0))
+    for count, endpoints in sorted((new.get('endpoints') or {}).items(), key=lambda i: int(i[0])):
+        for url, values in endpoints.items():
+            before = (old.get('endpoints') or {}).get(count, {}).get(url, {}).get('p50_ms')
+            change('%s images %s p50_ms' % (count, url), before, values['p50_ms'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='.tflite model path (as for bird_classify)')
+    parser.add_argument('--cpu_model', default=None,
+                        help='Non-EdgeTPU .tflite model (default: --model without _edgetpu)')
+    parser.add_argument('--labels', default=os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)), 'models', 'inat_bird_labels.txt'))
+    parser.add_argument('--input', default='videotestsrc',
+                        help='videotestsrc, a video file or a directory of img-* frames')
+    parser.add_argument('--frames', type=int, default=300,
+                        help='Frames generated by videotestsrc')
+    parser.add_argument('--pool_size', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--motion_threshold', type=float, default=0.0)
+    parser.add_argument('--threshold', type=float, default=0.4)
+    parser.add_argument('--hue_latency', type=float, default=0.02,
+                        help='Seconds the fake Hue bridge takes to answer')
+    parser.add_argument('--image_counts', type=lambda s: [int(n) for n in s.split(',')],
+                        default=[1000, 10000, 100000],
+                        help='Comma separated synthetic storage sizes for the endpoint benchmark')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='Timed requests per endpoint and storage size')
+    parser.add_argument('--skip_pipeline', action='store_true')
+    parser.add_argument('--skip_endpoints', action='store_true')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the pipeline storage folder')
+    parser.add_argument('--output', default=None, help='Write results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Earlier results JSON to compare with')
+    args = parser.parse_args()
+    if not args.skip_pipeline and not args.model:
+        parser.error('--model is required unless --skip_pipeline is given')
+
+    results = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+        'pipeline': None,
+        'endpoints': None,
+    }
+    if not args.skip_pipeline:
+        results['pipeline'] = run_pipeline(args)
+        p = results['pipeline']
+        print('%d frames in %.2f s: %.2f fps, frame p50 %.2f ms p99 %.2f ms, max RSS %.1f MB' %
+              (p['frames'], p['seconds'], p['fps'], p['frame_latency'].get('p50_ms', 0.0),
+               p['frame_latency'].get('p99_ms', 0.0), p['max_rss_mb']))
+    if not args.skip_endpoints:
+        results['endpoints'] = run_endpoints(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,43 +27,100 @@ model.
 
 """
 import argparse
+import atexit
+import glob
+import os
+import subprocess
+import sys
 import time
 import logging
 import threading
 import datetime
+import startup
+import numpy as np
 from PIL import Image
-from collections import Counter
-from phue import Bridge
-from flask_server import start_flask_server, is_hue_lights_paused
+from flask_server import is_hue_lights_paused, publish_visit, publish_image
 
 from pycoral.utils.dataset import read_label_file
-from pycoral.utils.edgetpu import make_interpreter
-from pycoral.adapters import common
-from pycoral.adapters.classify import get_classes
 
+import backends
+import detection_log
+import encoder
 import gstreamer
+import framebuffer
+import motion
+import visits
 import mongodb
-
-#connect to and ping the Mongo DB
-mongodb.mongoDB_connect()
+import phillips_hue
+import preview
+import retention
+from labels import LabelTable
+import events
+import imprint
+import metrics
+from pipeline import Stage, WorkerPool, BLOCK, DROP_NEWEST
+from image_catalog import get_catalog, IMAGE_EXTENSIONS
 
 # Set the logging level for the phue library to WARNING only
 logging.getLogger("phue").setLevel(logging.WARNING)
-b = Bridge('192.168.0.156')
 
-# If the app is not registered and the button is not pressed, press the button and call connect() (this only needs to be run a single time)
-b.connect()
 
+# Seconds between inference backend latency/FPS reports
+REPORT_INTERVAL = 60
+# Default camera frame size: saved frames, thumbnails and training crops keep
+# the camera resolution; 'model' trades them for no per-frame resize
+CAPTURE_SIZE = (640, 480)
+
+# Add to this list for false positives for your camera
+EXCLUSIONS = ['background',
+             'Branta canadensis (Canada Goose)',
+             "Cyanocitta stelleri (Steller's Jay)"]
 
-def save_data(image, results, path, score=0.0, ext='png'):
-    """Saves camera frame and model inference results
-    to user-defined storage directory."""
+
+def image_tag(results, score=0.0):
+    """The name of a saved frame between 'img-' and its extension. The
+    timestamp is the wall-clock capture time in milliseconds, which retention
+    ages frames by."""
     score_int = min(99, int(score * 100))
-    tag = '%s_%02d_%010d' % (results, score_int, int(time.monotonic()*1000))
-    name = '%s/img-%s.%s' % (path, tag, ext)
-    image.save(name)
+    return '%s_%02d_%010d' % (results, score_int, int(time.time()*1000))
+
+
+def save_data(frame, tag, path, fmt='png', quality=85, thumbnail_size=0):
+    """Saves camera frame (an RGB array) as img-<tag> to user-defined
+    storage directory."""
+    name = '%s/img-%s.%s' % (path, tag, encoder.extension(fmt))
+    with metrics.timer('save'):
+        encoder.save_image(frame, name, fmt, quality, thumbnail_size)
+    get_catalog(path).add(name)
     print('Frame saved as: %s' % name)
-    logging.info('Image: %s Results: %s Score: %.2f', tag, results, score)
+    publish_image(os.path.basename(name))
+
+
+def run_image_directory(user_function, directory, frame_size, workers=1):
+    """Feeds saved img-* frames from a directory to user_function, oldest
+    first, converted straight to RGB arrays of frame_size (width, height),
+    with each file's mtime as the frame's timestamp."""
+    def load(path):
+        with metrics.timer('decode'), Image.open(path) as img:
+            img = img.convert('RGB')
+            if img.size != tuple(frame_size):
+                img = img.resize(frame_size, Image.NEAREST)
+            frame = np.asarray(img)
+        user_function(frame, None, os.path.getmtime(path))
+    stage = Stage('inference', load, maxsize=workers * 2, policy=BLOCK, workers=workers)
+    paths = [path for path in glob.glob(os.path.join(directory, 'img-*'))
+             if path.lower().endswith(IMAGE_EXTENSIONS)]
+    for path in sorted(paths, key=os.path.getmtime):
+        stage.put(path)
+    stage.close()
+
+
+def parse_size(value):
+    """Parses a 'WIDTHxHEIGHT' argument; 'model' gives None (the model input size)."""
+    if value.lower() == 'model':
+        return None
+    width, height = value.lower().split('x')
+    return int(width), int(height)
 
 
 def print_results(start_time, last_time, end_time, results):
@@ -75,6 +132,13 @@ def print_results(start_time, last_time, end_time, results):
         print(' %s, score=%.2f' % (label, score))
 
 
+def annotate(svg_canvas, results):
+    """Draws the classification results onto the SVG overlay."""
+    for n, (label, score) in enumerate(results):
+        svg_canvas.add(svg_canvas.text('%s %.2f' % (label, score), insert=(10, 30 + 30 * n),
+                                       fill='white', font_size='24'))
+
+
 def do_training(results, last_results, top_k):
     """Compares current model results to previous results and returns
     true if at least one label difference is detected. Used to collect
@@ -88,7 +152,7 @@ def do_training(results, last_results, top_k):
     return False
 
 
-def user_selections():
+def user_selections(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', required=True,
                         help='.tflite model path')
@@ -96,6 +160,90 @@ def user_selections():
                         help='label file path')
     parser.add_argument('--videosrc', help='Which video source to use',
                         default='/dev/video0')
+    parser.add_argument('--input', default=None,
+                        help='Classify a recorded video file, a directory of saved '
+                             'img-* frames or (with "videotestsrc") synthetic frames '
+                             'instead of the live camera')
+    parser.add_argument('--test_frames', type=int, default=300,
+                        help='Number of frames generated by --input videotestsrc')
+    parser.add_argument('--capture_size', type=parse_size, default=CAPTURE_SIZE,
+                        help='Camera frame size handed to the model as WIDTHxHEIGHT '
+                             '(default: 640x480). Saved frames, thumbnails and training '
+                             'crops are this size. "model" captures at the model input '
+                             'size (e.g. 224x224), which skips the per-frame resize but '
+                             'saves frames that small (ignored with --roi)')
+    parser.add_argument('--backend', choices=backends.BACKENDS, default='auto',
+                        help='Run the model on the EdgeTPU or the CPU (auto uses an '
+                             'EdgeTPU when one is attached)')
+    parser.add_argument('--cpu_model', default=None,
+                        help='Non-EdgeTPU .tflite model for the CPU backend (default: '
+                             '--model without the _edgetpu suffix)')
+    parser.add_argument('--head', default=None,
+                        help='Classes imprinted from the labeled images by imprint.py; '
+                             'replaces their scores, keeping the model\'s other classes '
+                             '(CPU backend only)')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='CPU threads shared by the CPU interpreters (default: all cores)')
+    parser.add_argument('--pool_size', type=int, default=1,
+                        help='Number of interpreters (EdgeTPUs or CPU interpreters) '
+                             'that frames are dispatched to round-robin')
+    parser.add_argument('--motion_threshold', type=float, default=0.0,
+                        help='Only classify frames when at least this fraction of the '
+                             'motion region changed (0 classifies every frame)')
+    parser.add_argument('--motion_region', type=motion.parse_region, default=(0.0, 0.0, 1.0, 1.0),
+                        help='Region checked for motion as x,y,width,height fractions of the frame')
+    parser.add_argument('--roi', type=motion.parse_region, action='append', default=[],
+                        help='Region of interest such as a feeder perch, as x,y,width,height '
+                             'fractions of the frame; repeat for several. Each frame the '
+                             'regions with motion are cropped and classified and the results '
+                             'merged. Add 0,0,1,1 to also classify the whole frame')
+    parser.add_argument('--motion_keepalive', type=float, default=10.0,
+                        help='Classify at least once every this many seconds without motion')
+    parser.add_argument('--frame_buffer', type=int, default=8,
+                        help='Preallocated frame slots for holding the best frame of open visits')
+    parser.add_argument('--image_format', choices=sorted(encoder.FORMATS), default='jpeg',
+                        help='Format for saved bird images')
+    parser.add_argument('--image_quality', type=int, default=85,
+                        help='JPEG/WebP quality for saved bird images')
+    parser.add_argument('--thumbnail_size', type=int, default=160,
+                        help='Longest side of the gallery thumbnails (0 disables them)')
+    parser.add_argument('--encoder_workers', type=int, default=1,
+                        help='Threads encoding and writing saved images')
+    parser.add_argument('--mongo', choices=('upload', 'spool'), default=None,
+                        help='Upload visit records to MongoDB, or only append them to '
+                             '--mongo_spool (default: upload, spool with --input)')
+    parser.add_argument('--mongo_spool', default=None,
+                        help='Local file holding MongoDB records until they can be uploaded '
+                             '(default: mongo_spool.jsonl next to this script, '
+                             'mongo_spool_offline.jsonl with --input)')
+    parser.add_argument('--storage_max_mb', type=float, default=0,
+                        help='Budget for saved frames and thumbnails in MB; unprotected old '
+                             'frames are deleted beyond it (default: half the free space)')
+    parser.add_argument('--storage_max_files', type=int, default=0,
+                        help='Budget for saved frames and thumbnails in files '
+                             '(default: half the free inodes)')
+    parser.add_argument('--downsample_after', type=float, default=24,
+                        help='Hours after which frames other than the best of each species '
+                             'per day are downsampled (0 never downsamples)')
+    parser.add_argument('--downsample_size', type=int, default=640,
+                        help='Longest side of downsampled frames')
+    parser.add_argument('--log_max_bytes', type=int, default=detection_log.MAX_BYTES,
+                        help='Start a new detection log segment after this many bytes '
+                             '(segments also roll over daily)')
+    parser.add_argument('--preview', action='store_true',
+                        help='Stream a live MJPEG preview to the dashboard')
+    parser.add_argument('--preview_size', type=parse_size, default=(320, 240),
+                        help='Preview frame size as WIDTHxHEIGHT')
+    parser.add_argument('--preview_fps', type=int, default=5,
+                        help='Preview frames per second')
+    parser.add_argument('--preview_overlay', action='store_true',
+                        help='Draw the current classification onto the preview')
+    parser.add_argument('--web', choices=('process', 'thread', 'none'), default=None,
+                        help='Run the dashboard in its own process (serve.py), in a '
+                             'thread of this process, or not at all (default: process, '
+                             'none with --input)')
+    parser.add_argument('--hue_config', default=phillips_hue.DEFAULT_CONFIG_PATH,
+                        help='JSON file with the Hue bridge, light, scene and bird colours')
     parser.add_argument('--top_k', type=int, default=1,
                         help='number of classes with highest score to display')
     parser.add_argument('--threshold', type=float, default=0.4,
@@ -107,162 +255,356 @@ def user_selections():
     parser.add_argument('--training', action='store_true',
                         help='Training mode for image collection')
     parser.add_argument('--visit_interval', action='store', type=int, default=2,
-                        help='Minimum interval between bird visits')
-    args = parser.parse_args()
+                        help='Seconds a bird must be unseen before its visit ends (with '
+                             '--motion_threshold, at least --motion_keepalive plus a second)')
+    parser.add_argument('--visit_window', type=int, default=3,
+                        help='Number of recent frames a new visit is voted over')
+    parser.add_argument('--visit_votes', type=int, default=2,
+                        help='Frames within --visit_window a bird must top to start a visit')
+    args = parser.parse_args(argv)
+    # Offline runs (tests, benchmarks, re-processing) stay off the dashboard and
+    # Atlas unless asked, and keep their records apart from the live spool
+    if args.web is None:
+        args.web = 'none' if args.input else 'process'
+    if args.mongo is None:
+        args.mongo = 'spool' if args.input else 'upload'
+    if args.mongo_spool is None:
+        args.mongo_spool = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'mongo_spool_offline.jsonl' if args.input
+                                        else 'mongo_spool.jsonl')
     return args
 
-# pass the bird log and flask log path as a config variable, start Flask
-from flask_server import app, configure_logging
-app.config['STORAGE_PATH'] = user_selections().storage
-app.config['LOG_FILE_PATH'] = user_selections().storage + "/results.log"
-app.config['FLASK_LOG_FILE_PATH'] = user_selections().storage + "/FlaskLogging.log"
-configure_logging()
-start_flask_server()
+def start_dashboard(args):
+    """Starts the dashboard in its own process (serve.py), in a thread of this
+    process, or not at all. Returns the server process, if any."""
+    import flask_server
+    flask_server.configure_app(args.storage)
+    if args.web == 'thread':
+        flask_server.configure_logging()
+        flask_server.start_flask_server()
+        return None
+    if args.web == 'none':
+        return None
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+               '--storage', args.storage]
+    if args.preview:
+        preview.hub.path = preview.PREVIEW_PATH
+        command += ['--preview_file', preview.PREVIEW_PATH,
+                    '--preview_fps', str(args.preview_fps)]
+    flask_server.event_sink = events.EventSender().send
+    metrics.SnapshotWriter(metrics.registry)
+    server = subprocess.Popen(command)
+    atexit.register(server.terminate)
+    return server
 
-def main():
+def main(argv=None):
     """Creates camera pipeline, and pushes pipeline through ClassificationEngine
     model. Logs results to user-defined storage. Runs either in training mode to
     gather images for custom model creation or capture mode that records images
     of bird visits if a model label is detected."""
-    args = user_selections()
+    startup_timer = startup.StartupTimer()
+    startup_timer.mark('imports')
+    args = user_selections(argv)
     print(args)
-    print("Loading %s with %s labels." % (args.model, args.labels))
-    interpreter = make_interpreter(args.model)
-    interpreter.allocate_tensors()
-    labels = read_label_file(args.labels)
+    startup_timer.mark('config')
+    # External services connect in the background; until they are ready,
+    # records are spooled and light changes are skipped.
+    if args.mongo == 'upload':
+        startup.BackgroundClient('MongoDB', mongodb.mongoDB_connect)
+    hue_config = phillips_hue.load_config(args.hue_config)
+    hue_bridge = startup.BackgroundClient('Hue bridge',
+                                          lambda: phillips_hue.connect_bridge(hue_config))
+    start_dashboard(args)
+    startup_timer.mark('dashboard')
+    head = imprint.Head(args.head) if args.head else None
+    print("Loading %s with %s labels." % (args.model, args.head or args.labels))
+    backend = backends.make_backend(args.model,
+                                    frame_size=args.capture_size or (CAPTURE_SIZE if args.roi else None),
+                                    device=args.backend, pool_size=args.pool_size,
+                                    num_threads=args.num_threads, cpu_model=args.cpu_model,
+                                    head=head)
+    print('Inference backend: %s x%d' % (backend.name, len(backend.interpreters)))
+    interpreter = backend.interpreters[0]
+    if head:
+        labels, num_classes = head.label_dict(), len(head.labels)
+    else:
+        labels = read_label_file(args.labels)
+        num_classes = interpreter.get_output_details()[0]['shape'][-1]
+    label_table = LabelTable(labels, exclusions=EXCLUSIONS, colors=hue_config['birds'],
+                             num_classes=num_classes)
     input_tensor_shape = interpreter.get_input_details()[0]['shape']
     if (input_tensor_shape.size != 4 or
             input_tensor_shape[0] != 1):
         raise RuntimeError(
             'Invalid input tensor shape! Expected: [1, height, width, channel]')
+    capture_size = backend.frame_size
 
     output_tensors = len(interpreter.get_output_details())
     if output_tensors != 1:
         raise ValueError(
             ('Classification model should have 1 output tensor only!'
              'This model has {}.'.format(output_tensors)))
+    startup_timer.mark('model')
     storage_dir = args.storage
-    # Initialize logging file
-    logging.basicConfig(filename='%s/results.log' % storage_dir,
-                        format='%(asctime)s-%(message)s',
-                        level=logging.DEBUG)
+    # Detection log: daily segments, closed ones summarized and compressed
+    log_handler = detection_log.SegmentedLogHandler('%s/results.log' % storage_dir,
+                                                    max_bytes=args.log_max_bytes)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s-%(message)s'))
+    detection_log.logger.addHandler(log_handler)
+    detection_log.logger.setLevel(logging.INFO)
     last_time = time.monotonic()
     last_results = [('label', 0)]
-    visitors = []
-    hueVisitors = []
-    #Color values using HSL values (Hue, Saturation, Brightness)
-    hue_birds = [
-        ['Cardinalis cardinalis (Northern Cardinal)', 0, 255, 255],
-        ['Cyanocitta cristata (Blue Jay)', 45000, 255, 255],
-        ['Archilochus colubris (Ruby-throated Hummingbird)', 281, 89, 255]
-    ]
-    hue_bird_detect = False
-
-    DURATION = args.visit_interval
-    timer = False
-    hueTimer = False
-
-    def timed_event():
-        nonlocal timer
-        timer = True
-        threading.Timer(DURATION, timed_event).start()
-
-    def hue_timed_event():
-        nonlocal hueTimer
-        hueTimer = True
-        threading.Timer(3, hue_timed_event).start()
-
-    timed_event()
-    hue_timed_event()
-
-    def user_callback(image, svg_canvas):
-        nonlocal last_time
-        nonlocal last_results
-        nonlocal visitors
-        nonlocal timer
-        nonlocal hueTimer
-        nonlocal hue_birds
-        nonlocal hueVisitors
-        nonlocal hue_bird_detect
-        current_time = datetime.datetime.now()
-        formatted_time = current_time.strftime("%m/%d/%Y %H:%M:%S")
+    # Each open visit keeps its best frame pinned in a preallocated ring slot;
+    # only that frame is encoded and written when the visit ends.
+    frame_ring = framebuffer.FrameRing(args.frame_buffer, (capture_size[1], capture_size[0], 3))
+    linger = args.visit_interval
+    if args.motion_threshold > 0:
+        linger = visits.gated_linger(linger, args.motion_keepalive)
+    visit_tracker = visits.VisitTracker(linger=linger,
+                                        window=args.visit_window, votes=args.visit_votes,
+                                        release=frame_ring.release)
+    # Light changes are coalesced, diffed and rate limited on the controller's thread
+    hue = phillips_hue.HueController(hue_config, hue_bridge.get,
+                                     is_paused=is_hue_lights_paused)
+
+    # Image encoding and writing run off the inference thread. The pool drops
+    # new work when it is backed up, except offline, where every record is kept.
+    pool_policy = BLOCK if args.input else DROP_NEWEST
+    storage_pool = WorkerPool('storage', workers=args.encoder_workers, maxsize=16,
+                              policy=pool_policy)
+    # Visit records are batched to MongoDB in the background, spooled locally while offline
+    mongo_writer = mongodb.start_writer(args.mongo_spool, upload=args.mongo == 'upload')
+    metrics.gauge('mongo_spooled', lambda: mongo_writer.spooled)
+    metrics.counter('hue_requests_total', lambda: hue.commands)
+    metrics.counter('images_saved_total', lambda: storage_pool.processed)
+    # Old frames are downsampled and evicted in the background to stay within budget
+    auto_bytes, auto_files = retention.default_budget(storage_dir)
+    retention.RetentionManager(storage_dir,
+                               max_bytes=int(args.storage_max_mb * 1024 * 1024) or auto_bytes,
+                               max_files=args.storage_max_files or auto_files,
+                               downsample_age=args.downsample_after * 3600,
+                               downsample_size=args.downsample_size)
+    frame_count = 0
+    image_options = {'fmt': args.image_format, 'quality': args.image_quality,
+                     'thumbnail_size': args.thumbnail_size}
+
+    # Classification runs on every interpreter in parallel; the visit and Hue
+    # bookkeeping below is shared state, so results are handled one at a time.
+    results_lock = threading.Lock()
+    last_report = time.monotonic()
+    media_time = None  # latest frame timestamp from an offline input
+    # Wall-clock time (epoch seconds) of frame time 0 for offline inputs: image
+    # directories are timed by file mtime already, a recording is taken to start
+    # at its modification time and the test source when the run starts
+    if not args.input:
+        clock_origin = None
+    elif os.path.isdir(args.input):
+        clock_origin = 0.0
+    elif args.input == 'videotestsrc':
+        clock_origin = time.time()
+    else:
+        clock_origin = os.path.getmtime(args.input)
+    motion_gate = None
+    roi_gates = []
+    if args.motion_threshold > 0 and args.roi:
+        # Each region has its own gate, so a still region costs no inference
+        roi_gates = [motion.MotionGate(threshold=args.motion_threshold, region=roi,
+                                       keepalive=args.motion_keepalive)
+                     for roi in args.roi]
+    elif args.motion_threshold > 0:
+        motion_gate = motion.MotionGate(threshold=args.motion_threshold,
+                                        region=args.motion_region,
+                                        keepalive=args.motion_keepalive)
+
+    def report():
+        print(backend.report())
+        print(mongo_writer.report())
+        print(hue.report())
+        if motion_gate:
+            print(motion_gate.report())
+        for roi, gate in zip(args.roi, roi_gates):
+            print('region %s %s' % (','.join('%g' % v for v in roi), gate.report()))
+
+    def classify_regions(frame, now):
+        """Classifies crops (views) of the regions with motion, spread over the
+        interpreter pool, keeping each class at its best score. None if no
+        region moved."""
+        if roi_gates:
+            with metrics.timer('motion'):
+                regions = [gate.region for gate in roi_gates if gate.check(frame, now)]
+        else:
+            regions = args.roi
+        if not regions:
+            return None
+        crops = [motion.region_view(frame, region) for region in regions]
+        metrics.inc('region_crops_total', len(crops))
+        with metrics.timer('classify'):
+            return backends.fuse_max(backend.classify_many(crops, args.top_k, args.threshold),
+                                     args.top_k)
+
+    def skip_frame(now):
+        """A frame the motion gate skipped: visits still end on time, since a
+        bird that left leaves a still scene behind. The tracker's linger covers
+        the keepalive gap, so a bird sitting still keeps its visit."""
+        metrics.inc('frames_skipped_total', reason='no_motion')
+        with results_lock:
+            for event in visit_tracker.expire(now):
+                handle_visit(event)
+
+    def user_callback(frame, svg_canvas, timestamp=None):
+        """Classifies one frame. Offline inputs pass the frame's own timestamp
+        (media time or file mtime), which then drives motion and visit timing
+        instead of the wall clock, so visits do not depend on decode speed.
+        With several interpreters frames finish out of order, so the latest
+        timestamp seen is used and time never runs backwards."""
+        nonlocal last_report, media_time
         start_time = time.monotonic()
-        common.set_resized_input(
-            interpreter, image.size,
-            lambda size: image.resize(size, Image.NEAREST))
-        interpreter.invoke()
-        results = get_classes(interpreter, args.top_k, args.threshold)
+        if timestamp is not None:
+            with results_lock:
+                media_time = timestamp if media_time is None else max(media_time, timestamp)
+                now = media_time
+        else:
+            now = start_time
+        if not startup_timer.done:
+            with results_lock:
+                if not startup_timer.done:
+                    startup_timer.mark('first frame')
+                    startup_timer.report()
+        if motion_gate:
+            with metrics.timer('motion'):
+                moved = motion_gate.check(frame, now)
+            if not moved:
+                skip_frame(now)
+                return
+        if args.roi:
+            results = classify_regions(frame, now)
+            if results is None:
+                skip_frame(now)
+                return
+        else:
+            with metrics.timer('classify'):
+                results = backend.classify(frame, args.top_k, args.threshold)
         end_time = time.monotonic()
-        play_sounds = [labels[i] for i, score in results]
-        results = [(labels[i], score) for i, score in results]
+        if svg_canvas is not None and args.preview_overlay:
+            annotate(svg_canvas, [(label_table.names[i], score) for i, score in results])
+        with results_lock:
+            if timestamp is not None:
+                now = media_time
+            handle_results(frame, results, start_time, end_time, now)
+            if end_time - last_report >= REPORT_INTERVAL:
+                report()
+                last_report = end_time
+        metrics.observe('frame', time.monotonic() - start_time)
+
+    def handle_results(frame, results, start_time, end_time, now):
+        nonlocal last_time
+        nonlocal last_results
+        nonlocal frame_count
+        frame_count += 1
         if args.print:
-            print_results(start_time, last_time, end_time, results)
+            print_results(start_time, last_time, end_time,
+                          [(label_table.names[i], score) for i, score in results])
 
         if args.training:
+            results = [(label_table.names[i], score) for i, score in results]
             if do_training(results, last_results, args.top_k):
-                save_data(image, results, storage_dir)
+                record_image(frame.copy(), results)
         else:
-            # Custom model mode:
-            if len(results):
-                visitor = results[0][0]
-                #variable to slice out only friendly bird name inside the parantheses
-                friendly_birdname = visitor[visitor.find('(') + 1:visitor.find(')')]
-                if visitor not in EXCLUSIONS:
-                    # Only run hue lights logic if not paused
-                    if not is_hue_lights_paused():
-                        #set countertop lights to bird color
-                        if hueTimer and hueVisitors:
-                            #print("Hue Timer up!!!!!!!!")
-                            counter = Counter(hueVisitors)
-                            # Get the most common element over the timer duration and its count
-                            most_common_bird = counter.most_common(1)[0][0]
-                            #print(most_common_bird, "count: ", counter)
-                            #Get the most common bird over the timer duration and check if its in the hue_birds list
-                            if any(most_common_bird == entry[0] for entry in hue_birds):
-                                bird_lookup = [entry for entry in hue_birds if entry[0] == most_common_bird]
-                                b.set_light('Countertop Lights', {'hue': bird_lookup[0][1], 'sat': bird_lookup[0][2], 'bri': bird_lookup[0][3]})
-                                hue_bird_detect = True
-                                print("Turning Lights bird colored...")
-                            hueTimer = False
-                            hueVisitors.clear()
-                        #set lights to switch back to selected Scene if timer is up and visitors list is not populated, and detect is false
-                        elif hueTimer and not hueVisitors and hue_bird_detect != False:
-                                b.run_scene('Kitchen','Concentrate',10)
-                                hue_bird_detect = False
-                                print("Turning Lights back to Concentrate...")
-                        else:
-                            hueVisitors.append(visitor)
-                            #print("Hue Timer Running..")
-                            #print(hueVisitors)
-                            pass
-                    # If visit interval has past, clear visitors list
-                    if timer:
-                        print("next visit...")
-                        visitors.clear()
-                        timer = False
-                    # If this is a new visit, add bird to visitors list
-                    # so we don't keep taking the same image
-                    if visitor not in visitors:
-                        print("Visitor: ", visitor)
-                        print("Score: ", results[0][1])
-                        print("Visited at: ", formatted_time)
-                        save_data(image, friendly_birdname, storage_dir, score=results[0][1])
-                        mongodb.mongo_insert(visitor, results[0][1], formatted_time)
-                        visitors.append(visitor)
-            #run light switchback logic again if no results are being detected at all at the feeder
-            elif hue_bird_detect != False and hueTimer and not is_hue_lights_paused():
-                b.run_scene('Kitchen','Concentrate',4)
-                hue_bird_detect = False
-                hueVisitors.clear()
-                print("Turned Lights back to Concentrate...")
+            # Custom model mode: excluded labels (false positives) never start visits
+            detections = label_table.detections(results)
+            for event in visit_tracker.update(now, detections,
+                                              capture=lambda: frame_ring.put(frame),
+                                              quality=lambda: framebuffer.sharpness(frame)):
+                handle_visit(event)
         last_results = results
         last_time = end_time
-    gstreamer.run_pipeline(user_callback, videosrc=args.videosrc)
+
+    def record_image(frame, results, score=0.0):
+        """Logs a detection and hands its frame to the storage pool. The log
+        line is written here, so the detection counts match the visits even
+        when the pool is backed up and drops the image."""
+        tag = image_tag(results, score)
+        if not storage_pool.submit(save_data, frame, tag, storage_dir, **image_options):
+            tag = 'none'
+        detection_log.logger.info('Image: %s Results: %s Score: %.2f', tag, results, score)
+
+    def visit_start_time(event):
+        """When a visit started, as a datetime."""
+        if clock_origin is None:
+            return datetime.datetime.now() - datetime.timedelta(seconds=event.time - event.start)
+        return datetime.datetime.fromtimestamp(clock_origin + event.start)
+
+    def visiting():
+        """Labels of the open visits, oldest first."""
+        return [v.label for v in sorted(visit_tracker.visits.values(), key=lambda v: v.start)]
+
+    def handle_visit(event):
+        """Reports visits as they start; saves and records each one when it ends."""
+        if event.kind == visits.VISIT_START:
+            print("Visitor: ", event.label)
+            print("Score: ", event.score)
+            print("Visited at: ", visit_start_time(event).strftime("%m/%d/%Y %H:%M:%S"))
+            hue.show_bird(event.label)
+            publish_visit('start', event.label, event.score, 0.0, visiting())
+        elif event.kind == visits.VISIT_END:
+            print("Visit ended: %s, peak score %.2f, %.1f s, %d frames" %
+                  (event.label, event.peak_score, event.duration, event.frames))
+            # Show the most recent bird still visiting that has a colour, else the scene
+            colored = [v for v in visit_tracker.visits.values() if label_table.is_colored(v.label)]
+            if colored:
+                hue.show_bird(max(colored, key=lambda v: v.start).label)
+            else:
+                hue.restore()
+            friendly_birdname = label_table.common_name(event.label)
+            formatted_time = visit_start_time(event).strftime("%m/%d/%Y %H:%M:%S")
+            if event.best is not None:
+                score = event.peak_score
+                record_image(frame_ring.take(event.best), friendly_birdname, score)
+            else:
+                # No frame was kept (the frame buffer was full): record the visit without one
+                score = event.top_score
+                detection_log.logger.info('Image: none Results: %s Score: %.2f',
+                                          friendly_birdname, score)
+            mongodb.mongo_insert(event.label, score, formatted_time)
+            # After the detection is logged, so the stats sent with it include the visit
+            publish_visit('end', event.label, event.peak_score, event.duration, visiting())
+
+    startup_timer.mark('setup')
+    run_start = time.monotonic()
+    try:
+        if args.input == 'videotestsrc':
+            gstreamer.run_test_pipeline(user_callback, args.test_frames,
+                                        appsink_size=capture_size,
+                                        workers=len(backend.interpreters))
+        elif args.input and os.path.isdir(args.input):
+            run_image_directory(user_callback, args.input, capture_size,
+                                workers=len(backend.interpreters))
+        elif args.input:
+            gstreamer.run_file_pipeline(user_callback, args.input,
+                                        appsink_size=capture_size,
+                                        workers=len(backend.interpreters))
+        else:
+            gstreamer.run_pipeline(user_callback, appsink_size=capture_size,
+                                   videosrc=args.videosrc,
+                                   workers=len(backend.interpreters),
+                                   preview=preview.hub if args.preview else None,
+                                   preview_size=args.preview_size,
+                                   preview_fps=args.preview_fps,
+                                   preview_overlay=args.preview_overlay)
+    finally:
+        with results_lock:
+            for event in visit_tracker.flush(media_time if media_time is not None
+                                             else time.monotonic()):
+                handle_visit(event)
+        storage_pool.close()
+        hue.close()
+        mongo_writer.close()
+    report()
+    if args.input:
+        elapsed = time.monotonic() - run_start
+        print('Classified %d frames in %.2f s (%.2f fps)' %
+              (frame_count, elapsed, frame_count / elapsed if elapsed else 0.0))
 
 
 if __name__ == '__main__':
-    # Add to this list for false positives for your camera
-    EXCLUSIONS = ['background',
-                 'Branta canadensis (Canada Goose)',
-                 "Cyanocitta stelleri (Steller's Jay)"]
     main()
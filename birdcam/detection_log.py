@@ -0,0 +1,188 @@
+"""
+Detection log
+
+Writes the detection log (results.log in the storage folder) as segments.
+results.log is always the open segment; at the first record of a new day, or
+once it reaches max_bytes, it is moved to results/<day>.<n>.log, a summary of
+it is written next to it as results/<day>.<n>.json and the segment is gzipped
+in the background. Summaries hold the detection counts and last sighting per
+day and species, and the first and last detection timestamps, so readers such
+as the detection store never reopen closed segments.
+
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+SEGMENT_FOLDER = 'results'
+MAX_BYTES = 8 * 1024 * 1024
+
+# Detections (and the startup breakdown) go to this logger only, so records of
+# other libraries logging to the root logger never end up in the detection log
+logger = logging.getLogger('detections')
+logger.propagate = False
+
+
+def parse_detection_line(line):
+    """Return (timestamp, bird) for a detection log line, or None.
+    Lines look like '2024-05-01 12:34:56,789-Image: ... Results: Bird Score: 0.87'."""
+    if 'Results:' not in line:
+        return None
+    bird = line.split('Results:')[-1].split('Score:')[0].strip()
+    return line[:19], bird
+
+
+def segment_folder(log_path):
+    return os.path.join(os.path.dirname(log_path), SEGMENT_FOLDER)
+
+
+class SegmentSummary:
+    """Detection counts of one segment, updated line by line."""
+
+    def __init__(self):
+        self.lines = 0
+        self.first = None
+        self.last = None
+        self.days = {}  # day -> {bird: [count, last seen]}, birds in order of first detection
+
+    def add(self, line):
+        self.lines += 1
+        parsed = parse_detection_line(line)
+        if parsed is None:
+            return
+        timestamp, bird = parsed
+        self.first = self.first or timestamp
+        self.last = timestamp
+        entry = self.days.setdefault(timestamp[:10], {}).setdefault(bird, [0, None])
+        entry[0] += 1
+        entry[1] = timestamp
+
+    def as_dict(self, segment):
+        return {'segment': segment, 'lines': self.lines, 'first': self.first,
+                'last': self.last, 'days': self.days}
+
+
+def write_summary(path, summary):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_summaries(folder, cache=None):
+    """Returns the segment summaries in folder, oldest first. cache
+    ({filename: summary}) is reused and updated so only new files are read."""
+    cache = {} if cache is None else cache
+    try:
+        names = sorted(n for n in os.listdir(folder) if n.endswith('.json'))
+    except OSError:
+        return []
+    summaries = []
+    for name in names:
+        summary = cache.get(name)
+        if summary is None:
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    summary = cache[name] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        summaries.append(summary)
+    for name in set(cache) - set(names):
+        del cache[name]
+    return summaries
+
+
+def compress_segment(path):
+    """Gzips a closed segment to path.gz and removes the plain file."""
+    try:
+        with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(path + '.gz.tmp', path + '.gz')
+        os.remove(path)
+    except OSError as e:
+        print('Could not compress %s: %s' % (path, e))
+
+
+class SegmentedLogHandler(logging.Handler):
+    """Logging handler writing log_path as daily, size-capped segments."""
+
+    def __init__(self, log_path, max_bytes=MAX_BYTES, compress=True):
+        super().__init__()
+        self.log_path = log_path
+        self.folder = segment_folder(log_path)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.stream = None
+        self._open()
+        if compress:
+            # Segments left uncompressed by an earlier run that stopped mid-way
+            leftover = [os.path.join(self.folder, n) for n in os.listdir(self.folder)
+                        if n.endswith('.log')] if os.path.isdir(self.folder) else []
+            if leftover:
+                threading.Thread(target=lambda: [compress_segment(p) for p in leftover],
+                                 daemon=True).start()
+
+    def _open(self):
+        self.stream = open(self.log_path, 'a', encoding='utf-8')
+        self.size = self.stream.tell()
+        self.summary = SegmentSummary()
+        self.day = None
+        # Appending to an existing segment: its summary has to include what is there
+        if self.size:
+            with open(self.log_path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if self.day is None:
+                        self.day = line[:10]
+                    self.summary.add(line.rstrip('\n'))
+
+    def _segment_name(self):
+        n = 0
+        while any(os.path.exists(os.path.join(self.folder, '%s.%03d%s' % (self.day, n, ext)))
+                  for ext in ('.json', '.log', '.log.gz')):
+            n += 1
+        return '%s.%03d' % (self.day, n)
+
+    def _rollover(self):
+        self.stream.close()
+        os.makedirs(self.folder, exist_ok=True)
+        name = self._segment_name()
+        closed = os.path.join(self.folder, name + '.log')
+        # The summary goes first: readers count closed segments by their
+        # summaries, so the detections must not leave results.log before it exists
+        write_summary(os.path.join(self.folder, name + '.json'),
+                      self.summary.as_dict(name + ('.log.gz' if self.compress else '.log')))
+        os.replace(self.log_path, closed)
+        self._open()
+        if self.compress:
+            threading.Thread(target=compress_segment, args=(closed,), daemon=True).start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            data = line + '\n'
+            size = len(data.encode('utf-8'))
+            day = time.strftime('%Y-%m-%d', time.localtime(record.created))
+            if self.day is not None and (day != self.day or (
+                    self.max_bytes and self.size + size > self.max_bytes)):
+                self._rollover()
+            if self.day is None:
+                self.day = day
+            self.stream.write(data)
+            self.stream.flush()
+            self.size += size
+            self.summary.add(line)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
@@ -0,0 +1,162 @@
+"""
+Detection store
+
+Answers the dashboard's count and stats queries from the detection log
+without rescanning it. Closed segments (see detection_log) are only read
+through their summaries; the open segment (results.log) is indexed
+incrementally into SQLite, reading only the bytes appended since the last
+checkpoint on refresh.
+
+"""
+import os
+import sqlite3
+import threading
+
+from detection_log import parse_detection_line, read_summaries, segment_folder
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bird_totals (
+    bird TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    last_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS daily_counts (
+    day TEXT NOT NULL,
+    bird TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen TEXT,
+    PRIMARY KEY (day, bird)
+);
+CREATE TABLE IF NOT EXISTS log_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+
+class DetectionStore:
+    """Per-species and per-day detection counts from the segment summaries and
+    the open segment of the results log."""
+
+    def __init__(self, log_path, db_path):
+        self.log_path = log_path
+        self.db_path = db_path
+        self.segments_path = segment_folder(log_path)
+        self._summary_cache = {}
+        self._summaries = []
+        self._summaries_mtime = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _reset(self, inode):
+        self._conn.execute('DELETE FROM bird_totals')
+        self._conn.execute('DELETE FROM daily_counts')
+        self._conn.execute(
+            'INSERT OR REPLACE INTO log_state (id, inode, offset) VALUES (1, ?, 0)',
+            (inode,))
+
+    def _index_line(self, line):
+        parsed = parse_detection_line(line)
+        if parsed is None:
+            return
+        timestamp, bird = parsed
+        self._conn.execute(
+            'INSERT INTO bird_totals (bird, count, last_seen) VALUES (?, 1, ?) '
+            'ON CONFLICT(bird) DO UPDATE SET count = count + 1, last_seen = excluded.last_seen',
+            (bird, timestamp))
+        self._conn.execute(
+            'INSERT INTO daily_counts (day, bird, count, last_seen) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT(day, bird) DO UPDATE SET count = count + 1, last_seen = excluded.last_seen',
+            (timestamp[:10], bird, timestamp))
+
+    def refresh(self):
+        """Index any complete lines appended to the log since the last call."""
+        try:
+            st = os.stat(self.log_path)
+        except OSError:
+            return
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT inode, offset FROM log_state WHERE id = 1').fetchone()
+            # A new inode or a shorter file means the log was replaced or truncated
+            if row is None or row[0] != st.st_ino or st.st_size < row[1]:
+                self._reset(st.st_ino)
+                offset = 0
+            else:
+                offset = row[1]
+            if st.st_size == offset:
+                self._conn.commit()
+                return
+            with open(self.log_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(st.st_size - offset)
+            # Leave a partially written trailing line for the next refresh
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].decode('utf-8', errors='replace').splitlines():
+                self._index_line(line)
+            self._conn.execute('UPDATE log_state SET offset = ? WHERE id = 1',
+                               (offset + end,))
+            self._conn.commit()
+
+    def closed_summaries(self):
+        """Summaries of the closed segments, oldest first; re-read only when
+        the segment folder changes."""
+        try:
+            mtime = os.stat(self.segments_path).st_mtime_ns
+        except OSError:
+            return []
+        with self._lock:
+            if mtime != self._summaries_mtime:
+                self._summaries = read_summaries(self.segments_path, self._summary_cache)
+                self._summaries_mtime = mtime
+            return self._summaries
+
+    def range_counts(self, start, end):
+        """Return ({bird: detections}, last detection timestamp) for the days
+        from start to end ('YYYY-MM-DD', inclusive), birds in order of first
+        detection."""
+        counts, last_seen = {}, None
+        for summary in self.closed_summaries():
+            if not summary['first'] or summary['last'][:10] < start or summary['first'][:10] > end:
+                continue
+            for day, birds in sorted(summary['days'].items()):
+                if start <= day <= end:
+                    for bird, (count, seen) in birds.items():
+                        counts[bird] = counts.get(bird, 0) + count
+                        last_seen = max(last_seen or seen, seen)
+        self.refresh()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT bird, count, last_seen FROM daily_counts WHERE day BETWEEN ? AND ? '
+                'ORDER BY rowid', (start, end)).fetchall()
+        for bird, count, seen in rows:
+            counts[bird] = counts.get(bird, 0) + count
+            if seen:
+                last_seen = max(last_seen or seen, seen)
+        return counts, last_seen
+
+    def bird_counts(self):
+        """Return {bird: total detections} in order of first detection."""
+        counts = {}
+        for summary in self.closed_summaries():
+            for _, birds in sorted(summary['days'].items()):
+                for bird, (count, _) in birds.items():
+                    counts[bird] = counts.get(bird, 0) + count
+        self.refresh()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT bird, count FROM bird_totals ORDER BY rowid').fetchall()
+        for bird, count in rows:
+            counts[bird] = counts.get(bird, 0) + count
+        return counts
+
+    def day_counts(self, day):
+        """Return ({bird: detections}, last detection timestamp) for a 'YYYY-MM-DD' day."""
+        return self.range_counts(day, day)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
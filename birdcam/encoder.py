@@ -0,0 +1,53 @@
+"""
+Image encoding
+
+Writes saved frames in a configurable format and quality, plus a small JPEG
+thumbnail under <storage>/thumbs for the gallery pages. Encoding is CPU heavy
+on a Pi, so bird_classify runs it on the storage worker pool rather than on
+the inference thread.
+
+"""
+import os
+
+from PIL import Image
+
+# --image_format name -> (PIL format, file extension)
+FORMATS = {
+    'png': ('PNG', 'png'),
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+}
+THUMBNAIL_DIR = 'thumbs'
+THUMBNAIL_QUALITY = 70
+
+
+def extension(fmt):
+    return FORMATS[fmt][1]
+
+
+def thumbnail_path(folder, filename):
+    """Path of the thumbnail for a saved image (always a .jpg)."""
+    return os.path.join(folder, THUMBNAIL_DIR, os.path.splitext(filename)[0] + '.jpg')
+
+
+def save_thumbnail(image, folder, filename, size):
+    """Writes a thumbnail no larger than size x size for an image in folder."""
+    path = thumbnail_path(folder, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    thumb = image.copy()
+    thumb.thumbnail((size, size), Image.BILINEAR)
+    thumb.save(path, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return path
+
+
+def save_image(frame, path, fmt='jpeg', quality=85, thumbnail_size=0):
+    """Encodes an RGB frame array to path, plus a thumbnail if thumbnail_size > 0."""
+    pil_format, _ = FORMATS[fmt]
+    image = Image.fromarray(frame)
+    if pil_format == 'PNG':
+        image.save(path, pil_format)
+    else:
+        image.save(path, pil_format, quality=quality)
+    if thumbnail_size:
+        folder, filename = os.path.split(path)
+        save_thumbnail(image, folder, filename, thumbnail_size)
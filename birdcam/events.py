@@ -0,0 +1,122 @@
+"""
+Live event hub
+
+Fans detection events out to every connected dashboard as Server-Sent
+Events. Each event is serialised once in publish() and the same message is
+queued for all subscribers; a slow client only loses its own oldest messages.
+
+When the dashboard runs in its own process (serve.py), the classifier sends
+events to it as UDP datagrams on localhost with EventSender, and the server's
+EventReceiver hands them to the hub.
+
+"""
+import json
+import queue
+import socket
+import threading
+
+from pipeline import BoundedQueue, DROP_OLDEST
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT = 15
+HEARTBEAT_MESSAGE = ': keep-alive\n\n'
+
+# Where the dashboard process listens for events from the classifier
+EVENT_ADDRESS = ('127.0.0.1', 5001)
+
+
+def format_sse(event, data):
+    """Formats one Server-Sent Event with a JSON payload."""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+class EventHub:
+    """Broadcasts formatted SSE messages to subscriber queues."""
+
+    def __init__(self, queue_size=32):
+        self.queue_size = queue_size
+        self.published = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        q = BoundedQueue(self.queue_size, DROP_OLDEST)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+        q.close()
+
+    def publish(self, event, data):
+        message = format_sse(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self.published += 1
+        for q in subscribers:
+            q.put(message)
+
+    def stream(self, q, first=None):
+        """Yields SSE messages for one subscriber until the client goes away."""
+        try:
+            if first:
+                yield first
+            while True:
+                try:
+                    yield q.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    if q.closed:
+                        return
+                    yield HEARTBEAT_MESSAGE
+        finally:
+            self.unsubscribe(q)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+class EventSender:
+    """Sends events to another process. Never blocks and never raises: events
+    sent while the receiver is down are lost, as with a disconnected client."""
+
+    def __init__(self, address=EVENT_ADDRESS):
+        self.address = address
+        self.sent = 0
+        self.failed = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def send(self, event, data):
+        try:
+            self._sock.sendto(json.dumps([event, data]).encode(), self.address)
+            self.sent += 1
+        except OSError:
+            self.failed += 1
+
+
+class EventReceiver:
+    """Calls handler(event, data) on a background thread for every event
+    received from an EventSender."""
+
+    def __init__(self, handler, address=EVENT_ADDRESS):
+        self.handler = handler
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(address)
+        thread = threading.Thread(target=self._run, name='event-receiver')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            payload, _ = self._sock.recvfrom(65536)
+            try:
+                event, data = json.loads(payload)
+                self.handler(event, data)
+            except Exception as e:
+                print('Bad event received: %s' % e)
+
+
+hub = EventHub()
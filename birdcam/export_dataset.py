@@ -0,0 +1,249 @@
+"""
+Training dataset export
+
+Turns the images labeled in the dashboard (training_data/<label>/<PositiveID|
+NegativeID>, with bbox annotations) into compressed NPZ shards for training:
+each bbox is cropped and resized to the model input size on a process pool.
+
+Exports are incremental. dataset.json in the output folder records, for every
+exported image, the shard and row holding its crop and the modification times
+it was made from; the next run only crops images that are new or whose image
+or annotation changed, writes them to new shards, and deletes shards with no
+current rows left. Use load_dataset() to read the current rows back.
+
+Each shard holds 'images' (N, size, size, 3) uint8, 'labels' (N,) int32 class
+ids, 'positive' (N,) bool (False for NegativeID) and 'keys' (N,) str.
+Class ids come from the model label file; labels not in it get new ids after
+the last model class. The map is saved as 'label_map' in dataset.json.
+
+    python3 export_dataset.py --output /home/pi/birdcam-dataset
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from labels import common_name
+from training_manifest import TrainingManifest
+
+BIRDCAM_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TRAINING_DATA = os.path.join(BIRDCAM_DIR, 'training_data')
+DEFAULT_LABELS = os.path.join(BIRDCAM_DIR, 'models', 'inat_bird_labels.txt')
+STATE_NAME = 'dataset.json'
+
+
+def read_labels(path):
+    """Returns {label: id} from a 'id label' per line label file."""
+    ids = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split(' ', 1)
+            if len(parts) == 2 and parts[0].isdigit():
+                ids[parts[1]] = int(parts[0])
+    return ids
+
+
+def build_label_map(folder_labels, model_ids, label_map=None):
+    """Maps training folder labels (common names, scientific names or full
+    labels) to class ids, keeping the ids already assigned in label_map."""
+    label_map = dict(label_map or {})
+    lookup = {}
+    for label, class_id in model_ids.items():
+        lookup[label.lower()] = class_id
+        lookup[common_name(label).lower()] = class_id
+        lookup[label.split('(')[0].strip().lower()] = class_id
+    next_id = max(list(model_ids.values()) + list(label_map.values()) + [-1]) + 1
+    for label in sorted(folder_labels):
+        if label in label_map:
+            continue
+        class_id = lookup.get(label.lower())
+        if class_id is None:
+            class_id = next_id
+            next_id += 1
+            print('Label not in the model label file, assigned new id %d: %s' % (class_id, label))
+        label_map[label] = class_id
+    return label_map
+
+
+def crop_box(size, bbox):
+    """Pixel box for a bbox of x, y, width, height ratios, clamped to the image."""
+    width, height = size
+    left = min(max(0.0, bbox['x']), 1.0) * width
+    top = min(max(0.0, bbox['y']), 1.0) * height
+    right = min(1.0, bbox['x'] + bbox['width']) * width
+    bottom = min(1.0, bbox['y'] + bbox['height']) * height
+    if right - left < 1 or bottom - top < 1:
+        return None
+    return int(left), int(top), int(round(right)), int(round(bottom))
+
+
+def crop_image(task):
+    """Worker: returns (key, crop array) or (key, None) if the image is unusable."""
+    key, path, bbox, size = task
+    try:
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+            box = crop_box(img.size, bbox) if bbox else None
+            if bbox and box is None:
+                return key, None
+            if box:
+                img = img.crop(box)
+            return key, np.asarray(img.resize((size, size), Image.BILINEAR), dtype=np.uint8)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        print('Skipping %s: %s' % (path, e))
+        return key, None
+
+
+def lower_priority(niceness):
+    if niceness:
+        os.nice(niceness)
+
+
+def load_state(output):
+    try:
+        with open(os.path.join(output, STATE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'label_map': {}, 'size': None, 'items': {}, 'shards': []}
+
+
+def save_state(output, state):
+    path = os.path.join(output, STATE_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_shard(output, name, keys, crops, labels, positive):
+    path = os.path.join(output, name)
+    # Written under a temporary name so a shard is never read half written
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, images=np.stack(crops), labels=np.array(labels, dtype=np.int32),
+                            positive=np.array(positive, dtype=bool), keys=np.array(keys))
+    os.replace(path + '.tmp', path)
+
+
+def export(training_data, output, labels_path=DEFAULT_LABELS, size=224, shard_size=256,
+           workers=None, niceness=10):
+    """Exports new and changed labeled images; returns (exported, removed) counts."""
+    os.makedirs(output, exist_ok=True)
+    state = load_state(output)
+    if state.get('size') not in (None, size):
+        print('Crop size changed from %s to %d, exporting everything again' % (state['size'], size))
+        state['items'] = {}
+    state['size'] = size
+
+    entries = TrainingManifest(training_data).entries()
+    state['label_map'] = build_label_map({label for label, _, _, _ in entries},
+                                         read_labels(labels_path), state.get('label_map'))
+
+    tasks, meta, current = [], {}, set()
+    for label, id_type, filename, bbox in entries:
+        key = '%s/%s/%s' % (label, id_type, filename)
+        path = os.path.join(training_data, label, id_type, filename)
+        try:
+            mtimes = [os.stat(path).st_mtime_ns]
+        except OSError:
+            continue
+        try:
+            mtimes.append(os.stat(os.path.splitext(path)[0] + '.json').st_mtime_ns)
+        except OSError:
+            mtimes.append(0)
+        current.add(key)
+        item = state['items'].get(key)
+        if item and item['mtimes'] == mtimes:
+            continue
+        tasks.append((key, path, bbox, size))
+        meta[key] = (state['label_map'][label], id_type == 'PositiveID', mtimes)
+
+    removed = [key for key in state['items'] if key not in current]
+    for key in removed:
+        del state['items'][key]
+
+    exported = 0
+    run = time.strftime('%Y%m%d-%H%M%S')
+    batch = []
+
+    def flush():
+        name = 'shard-%s-%04d.npz' % (run, len(state['shards']))
+        write_shard(output, name, [k for k, _ in batch], [c for _, c in batch],
+                    [meta[k][0] for k, _ in batch], [meta[k][1] for k, _ in batch])
+        for row, (k, _) in enumerate(batch):
+            state['items'][k] = {'shard': name, 'row': row, 'mtimes': meta[k][2]}
+        state['shards'].append(name)
+        # Saved after every shard so an interrupted export resumes where it stopped
+        save_state(output, state)
+        batch.clear()
+
+    if tasks:
+        with ProcessPoolExecutor(workers, initializer=lower_priority,
+                                 initargs=(niceness,)) as pool:
+            for key, crop in pool.map(crop_image, tasks, chunksize=8):
+                if crop is None:
+                    continue
+                batch.append((key, crop))
+                exported += 1
+                if len(batch) >= shard_size:
+                    flush()
+        if batch:
+            flush()
+
+    # Shards whose rows have all been replaced or removed are no longer needed
+    live = {item['shard'] for item in state['items'].values()}
+    for name in [s for s in state['shards'] if s not in live]:
+        try:
+            os.remove(os.path.join(output, name))
+        except OSError:
+            pass
+        state['shards'].remove(name)
+    save_state(output, state)
+    return exported, len(removed)
+
+
+def load_dataset(output):
+    """Returns (images, labels, positive) arrays holding the current rows."""
+    state = load_state(output)
+    rows = {}
+    for item in state['items'].values():
+        rows.setdefault(item['shard'], []).append(item['row'])
+    images, labels, positive = [], [], []
+    for shard, indices in sorted(rows.items()):
+        with np.load(os.path.join(output, shard)) as data:
+            indices = sorted(indices)
+            images.append(data['images'][indices])
+            labels.append(data['labels'][indices])
+            positive.append(data['positive'][indices])
+    if not images:
+        size = state.get('size') or 224
+        return (np.zeros((0, size, size, 3), np.uint8), np.zeros(0, np.int32),
+                np.zeros(0, bool))
+    return np.concatenate(images), np.concatenate(labels), np.concatenate(positive)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', required=True, help='Folder for the shards and dataset.json')
+    parser.add_argument('--training_data', default=DEFAULT_TRAINING_DATA)
+    parser.add_argument('--labels', default=DEFAULT_LABELS,
+                        help='Model label file the class ids come from')
+    parser.add_argument('--size', type=int, default=224, help='Crop size (the model input size)')
+    parser.add_argument('--shard_size', type=int, default=256, help='Images per shard')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Cropping processes (default: one per core)')
+    parser.add_argument('--nice', type=int, default=10,
+                        help='Niceness added to the cropping processes')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    exported, removed = export(args.training_data, args.output, args.labels, args.size,
+                               args.shard_size, args.workers, args.nice)
+    print('Exported %d images, dropped %d removed ones in %.1f s' %
+          (exported, removed, time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
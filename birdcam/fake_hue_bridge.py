@@ -0,0 +1,138 @@
+"""
+Fake Hue bridge
+
+Minimal HTTP stand-in for a Philips Hue bridge, implementing the parts of the
+REST API that phue and the HueController use (app registration, lights,
+groups, scenes and their state/action updates). Every request is recorded with
+its arrival time so tests and benchmarks can check what was sent and how fast.
+
+    server = FakeHueBridge()          # listens on 127.0.0.1, random port
+    config['bridge_ip'] = server.address
+    ...
+    server.requests                   # [(time, method, path, body), ...]
+    server.close()
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+USERNAME = 'birdcam-fake-user'
+
+
+def default_state():
+    return {
+        'lights': {'1': {'name': 'Countertop Lights', 'type': 'Extended color light',
+                         'state': {'on': True, 'hue': 8000, 'sat': 100, 'bri': 200}}},
+        'groups': {'1': {'name': 'Kitchen', 'type': 'Room', 'lights': ['1'],
+                         'action': {'on': True}}},
+        'scenes': {'conc01': {'name': 'Concentrate', 'type': 'GroupScene', 'group': '1',
+                              'lights': ['1']}},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def _handle(self, method):
+        body = self._body() if method in ('POST', 'PUT') else None
+        bridge = self.server.bridge
+        bridge.record(method, self.path, body)
+        if bridge.latency:
+            time.sleep(bridge.latency)
+        parts = [p for p in self.path.split('/') if p]
+        if parts == ['api'] and method == 'POST':
+            return self._reply([{'success': {'username': USERNAME}}])
+        if len(parts) < 2 or parts[0] != 'api':
+            return self._reply([{'error': {'type': 4, 'description': 'method not available'}}], 404)
+        resources = parts[2:]
+        with bridge.lock:
+            if not resources:
+                return self._reply(bridge.state)
+            collection = bridge.state.get(resources[0])
+            if collection is None:
+                return self._reply([{'error': {'type': 3, 'description': 'resource not available'}}])
+            if len(resources) == 1:
+                return self._reply(collection)
+            item = collection.get(resources[1])
+            if item is None:
+                return self._reply([{'error': {'type': 3, 'description': 'resource not available'}}])
+            if len(resources) == 2 and method == 'GET':
+                return self._reply(item)
+            if method == 'PUT' and len(resources) == 3:
+                item.setdefault(resources[2], {}).update(body or {})
+                base = '/%s/%s/%s/' % tuple(resources)
+                return self._reply([{'success': {base + k: v}} for k, v in (body or {}).items()])
+        return self._reply([{'error': {'type': 4, 'description': 'method not available'}}])
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeHueBridge:
+    """Runs the fake bridge on a background thread. latency adds a delay to
+    every response, to imitate a slow LAN."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.state = default_state()
+        self.requests = []
+        self.latency = latency
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.bridge = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-hue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        """host:port, usable as the phue Bridge ip."""
+        host, port = self._server.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    @property
+    def username(self):
+        return USERNAME
+
+    def record(self, method, path, body):
+        with self.lock:
+            self.requests.append((time.monotonic(), method, path, body))
+
+    def writes(self):
+        """Recorded PUT requests: [(time, path, body), ...]."""
+        with self.lock:
+            return [(t, path, body) for t, method, path, body in self.requests if method == 'PUT']
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    bridge = FakeHueBridge(port=8080)
+    print('Fake Hue bridge listening on %s (username %s)' % (bridge.address, bridge.username))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        bridge.close()
@@ -1,4 +1,5 @@
-from flask import Flask, render_template, jsonify, current_app, send_from_directory, request
+from flask import Flask, Response, render_template, jsonify, current_app, send_from_directory, request, make_response
+from functools import wraps
 import threading
 import logging
 import os
@@ -6,16 +7,126 @@ import re
 import time
 import json
 import shutil
+import sqlite3
 from collections import defaultdict
 from datetime import date
+from detection_store import DetectionStore
+from image_catalog import get_catalog, state_path
+from encoder import thumbnail_path
+from training_manifest import TrainingManifest
+from events import hub, format_sse
+import preview
+import metrics
+import retention
 
 app = Flask(__name__)
 
+# Thumbnails never change once written
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Saved img-* frames are downsampled in place by the retention manager, so
+# browsers revalidate them (ETag/Last-Modified follow the file) after this
+FRAME_MAX_AGE = 3600
+# Seconds JSON responses are reused before being recomputed
+JSON_CACHE_TTL = 2.0
+# Live streams (event feeds and MJPEG previews) hold a server thread each for
+# as long as they are open, so they are capped and run_flask sizes the pool
+# as MAX_STREAMS plus REQUEST_THREADS for everything else.
+MAX_STREAMS = 6
+REQUEST_THREADS = 4
+
+
+class StreamLimiter:
+    """Counts open live streams against a limit."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+streams = StreamLimiter(MAX_STREAMS)
+
+
+def stream_response(body, on_close=None, **kwargs):
+    """Response for a live stream holding one of the stream slots, or 503 when
+    they are all taken. The slot is freed when the server closes the response,
+    even if the body was never iterated."""
+    if not streams.acquire():
+        if hasattr(body, 'close'):
+            body.close()
+        if on_close:
+            on_close()
+        return Response("Too many live streams open", status=503, headers={'Retry-After': '30'})
+    response = Response(body, **kwargs)
+    response.call_on_close(streams.release)
+    if on_close:
+        response.call_on_close(on_close)
+    return response
+
 @app.after_request
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     return response
 
+def configure_app(storage):
+    """Points the dashboard at a bird_classify storage folder."""
+    global hue_pause_path
+    app.config['STORAGE_PATH'] = storage
+    app.config['LOG_FILE_PATH'] = storage + "/results.log"
+    app.config['FLASK_LOG_FILE_PATH'] = storage + "/FlaskLogging.log"
+    hue_pause_path = state_path(storage, HUE_PAUSE_FILE)
+    # The flag used to sit in the storage folder itself
+    legacy = os.path.join(storage, HUE_PAUSE_FILE)
+    if os.path.exists(legacy):
+        os.replace(legacy, hue_pause_path)
+
+json_cache = {}
+json_cache_lock = threading.Lock()
+
+def cached_json(view):
+    """Reuses a view's response body for JSON_CACHE_TTL seconds per URL, so
+    many open dashboards cost one computation."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.full_path
+        now = time.monotonic()
+        with json_cache_lock:
+            hit = json_cache.get(key)
+        if hit is None or hit[0] < now:
+            response = make_response(view(*args, **kwargs))
+            hit = (now + JSON_CACHE_TTL, response.get_data(), response.status_code)
+            with json_cache_lock:
+                if len(json_cache) > 256:
+                    for k in [k for k, v in json_cache.items() if v[0] < now]:
+                        del json_cache[k]
+                json_cache[key] = hit
+        response = Response(hit[1], status=hit[2], mimetype='application/json')
+        response.cache_control.max_age = int(JSON_CACHE_TTL)
+        return response
+    return wrapper
+
+def send_image(folder, filename, immutable=False):
+    """send_from_directory with conditional GET (ETag/Last-Modified); saved
+    frames are cached by browsers for an hour, thumbnails (immutable) for good."""
+    if not filename.startswith('img-'):
+        return send_from_directory(folder, filename)
+    response = send_from_directory(folder, filename,
+                                   max_age=IMMUTABLE_MAX_AGE if immutable else FRAME_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    return response
+
 # Set Flask to log to its own file
 def configure_logging():
     """Configures Flask to log to a separate file."""
@@ -30,23 +141,30 @@ def configure_logging():
     # Optionally, disable propagation to the root logger
     flask_logger.propagate = False
 
-def parse_log():
-    bird_counts = defaultdict(int)
-    # Get the bird log txt file path from config in bird_classify
-    log_file_path = current_app.config.get('LOG_FILE_PATH', '')
+detection_store = None
 
+def get_detection_store():
+    """Return the shared DetectionStore for the configured results log, creating it on first use."""
+    global detection_store
+    log_file_path = current_app.config.get('LOG_FILE_PATH', '')
     if not log_file_path:
-        return bird_counts  # No log file path set
+        return None
+    if detection_store is None or detection_store.log_path != log_file_path:
+        db_path = current_app.config.get('DETECTION_DB_PATH') or \
+            state_path(os.path.dirname(log_file_path), 'detections.db')
+        detection_store = DetectionStore(log_file_path, db_path)
+    return detection_store
+
+def parse_log():
+    # Get the bird log txt file path from config in bird_classify
+    store = get_detection_store()
+    if store is None:
+        return defaultdict(int)  # No log file path set
     try:
-        with open(log_file_path, 'r') as file:
-            for line in file:
-                if "Results:" in line:
-                    bird = line.split("Results:")[-1].split("Score:")[0].strip()
-                    bird_counts[bird] += 1
-    except IOError:
+        return store.bird_counts()
+    except (IOError, sqlite3.Error):
         print("Error reading log file.")
         return {}
-    return bird_counts
 
 @app.route('/')
 def index():
@@ -63,14 +181,8 @@ def serve_bird_images(bird):
         print(f"DEBUG: Storage folder not found at {storage_folder}")
         return f"No storage folder found at {storage_folder}.", 404
         
-    all_files = os.listdir(storage_folder)
-
-    # Keep spaces in the search term since filenames have spaces
-    search_term = bird.lower()
-    print(f"DEBUG: Searching for files containing '{search_term}'")
-    
-    # Find all files containing the bird name (case insensitive)
-    images = [f for f in all_files if search_term in f.lower()]
+    # Look up all saved frames for the bird (case insensitive)
+    images = get_catalog(storage_folder).images(bird)
 
     #send data to template
     return render_template('image_gallery.html', bird=bird, images=images)
@@ -83,101 +195,88 @@ def serve_image(filename):
         return f"No storage folder found at {storage_folder}.", 404
         
     if os.path.exists(os.path.join(storage_folder, filename)):
-        return send_from_directory(storage_folder, filename)
+        return send_image(storage_folder, filename)
     else:
         return f"Image not found: {filename}", 404
 
+@app.route('/thumbs/<filename>')
+def serve_thumbnail(filename):
+    """Serve the thumbnail of a saved image, or the image itself if it has none."""
+    storage_folder = current_app.config.get('STORAGE_PATH','')
+    thumb = thumbnail_path(storage_folder, filename)
+    if os.path.isfile(thumb):
+        return send_image(os.path.dirname(thumb), os.path.basename(thumb), immutable=True)
+    return serve_image(filename)
+
 @app.route('/api/bird_counts_raw')
+@cached_json
 def get_bird_data():
-    return jsonify(parse_log())
+    """Detection counts per species; with start and/or end ('YYYY-MM-DD')
+    only those days are counted."""
+    start, end = request.args.get('start'), request.args.get('end')
+    if not (start or end):
+        return jsonify(parse_log())
+    store = get_detection_store()
+    if store is None:
+        return jsonify({})
+    try:
+        counts, _ = store.range_counts(start or '0000-00-00', end or '9999-99-99')
+    except (IOError, sqlite3.Error):
+        print("Error reading log file.")
+        counts = {}
+    return jsonify(counts)
 
 @app.route('/api/best_image')
+@cached_json
 def get_best_image():
     storage_folder = current_app.config.get('STORAGE_PATH', '')
     bird_filters = request.args.getlist('birds[]')
 
-    files = [f for f in os.listdir(storage_folder)
-             if f.startswith('img-') and f.endswith(('.png', '.jpg', '.jpeg'))]
-
-    if bird_filters:
-        files = [f for f in files
-                 if any(bf.lower().replace(' ', '') in f.lower().replace(' ', '') for bf in bird_filters)]
-
-    if not files:
+    best = get_catalog(storage_folder).best(bird_filters)
+    if best is None:
         return jsonify({'filename': None, 'bird': None}), 404
-
-    def score_ts(name):
-        m = re.search(r'_(\d{2})_(\d{10,})\.', name)
-        if m:
-            return (int(m.group(1)), int(m.group(2)))
-        # old filename format — fall back to timestamp only, score 0
-        m2 = re.search(r'(\d{10,})\.', name)
-        return (0, int(m2.group(1)) if m2 else 0)
-
-    best = max(files, key=score_ts)
     return jsonify({'filename': best, 'bird': extract_bird_name(best)})
 
 @app.route('/api/latest_image')
+@cached_json
 def get_latest_image():
     storage_folder = current_app.config.get('STORAGE_PATH', '')
     bird_filters = request.args.getlist('birds[]')
 
-    files = [f for f in os.listdir(storage_folder)
-             if f.startswith('img-') and f.endswith(('.png', '.jpg', '.jpeg'))]
-
-    if bird_filters:
-        files = [f for f in files
-                 if any(bf.lower().replace(' ', '') in f.lower().replace(' ', '') for bf in bird_filters)]
-
-    if not files:
+    latest = get_catalog(storage_folder).latest(bird_filters)
+    if latest is None:
         return jsonify({'filename': None, 'bird': None}), 404
-
-    def ts_only(name):
-        m = re.search(r'_(\d{2})_(\d{10,})\.', name)
-        if m:
-            return int(m.group(2))
-        m2 = re.search(r'(\d{10,})\.', name)
-        return int(m2.group(1)) if m2 else 0
-
-    latest = max(files, key=ts_only)
     return jsonify({'filename': latest, 'bird': extract_bird_name(latest)})
 
 
 @app.route('/api/images')
+@cached_json
 def get_images_for_bird():
     storage_folder = current_app.config.get('STORAGE_PATH', '')
     bird = request.args.get('bird', '')
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
     if not storage_folder or not os.path.isdir(storage_folder):
         return jsonify([])
-    search_term = bird.lower().replace(' ', '')
-    files = [f for f in os.listdir(storage_folder)
-             if f.startswith('img-') and f.lower().endswith(('.png', '.jpg', '.jpeg'))
-             and search_term in f.lower().replace(' ', '')]
-    return jsonify(sorted(files))
+    return jsonify(get_catalog(storage_folder).images(bird, offset, limit))
 
 
 @app.route('/api/stats')
+@cached_json
 def get_stats():
-    log_file_path = current_app.config.get('LOG_FILE_PATH', '')
+    return jsonify(stats_snapshot())
+
+def stats_snapshot():
+    """Today's totals from the detection store, as served by /api/stats."""
     today_str = date.today().strftime('%Y-%m-%d')
-    today_counts = defaultdict(int)
+    today_counts = {}
     last_detection = None
 
-    if log_file_path:
+    store = get_detection_store()
+    if store is not None:
         try:
-            with open(log_file_path, 'r') as f:
-                for line in f:
-                    if 'Results:' not in line:
-                        continue
-                    if not line.startswith(today_str):
-                        continue
-                    bird = line.split('Results:')[-1].split('Score:')[0].strip()
-                    today_counts[bird] += 1
-                    try:
-                        last_detection = line[:19]
-                    except Exception:
-                        pass
-        except IOError:
+            today_counts, last_detection = store.day_counts(today_str)
+        except (IOError, sqlite3.Error):
             pass
 
     total = sum(today_counts.values())
@@ -185,13 +284,73 @@ def get_stats():
     most_frequent = max(today_counts, key=today_counts.get) if today_counts else None
     most_frequent_count = today_counts[most_frequent] if most_frequent else 0
 
-    return jsonify({
+    return {
         'total_today': total,
         'species_today': species_count,
         'most_frequent': most_frequent,
         'most_frequent_count': most_frequent_count,
-        'last_detection': last_detection
-    })
+        'last_detection': last_detection,
+        'storage': retention.read_stats(current_app.config.get('STORAGE_PATH', ''))
+    }
+
+@app.route('/preview.mjpg')
+def preview_stream():
+    """Live MJPEG stream from the camera's preview branch (bird_classify --preview)."""
+    if not preview.hub.enabled:
+        return "Preview not enabled", 404
+    return stream_response(preview.hub.stream(), mimetype=preview.MIMETYPE,
+                           headers={'Cache-Control': 'no-cache'})
+
+@app.route('/preview.jpg')
+def preview_snapshot():
+    jpeg = preview.hub.latest()
+    if not preview.hub.enabled or jpeg is None:
+        return "Preview not available", 404
+    return Response(jpeg, mimetype='image/jpeg', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage latency quantiles and frame/queue counters in the Prometheus text
+    format. Out of process, these come from bird_classify's snapshot file."""
+    snapshot = metrics.registry.snapshot()
+    snapshot_path = current_app.config.get('METRICS_SNAPSHOT_PATH')
+    if snapshot_path:
+        snapshot = metrics.read_snapshot(snapshot_path)
+        if snapshot is None:
+            return "No metrics from bird_classify yet", 503
+    return Response(metrics.render(snapshot), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/events')
+def event_stream():
+    """Server-Sent Events feed of visits, today's stats and newly saved images."""
+    first = format_sse('stats', stats_snapshot())
+    q = hub.subscribe()
+    return stream_response(hub.stream(q, first), on_close=lambda: hub.unsubscribe(q),
+                           mimetype='text/event-stream',
+                           headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def broadcast(event, data):
+    """Publishes an event to the connected dashboards. A new image or the end
+    of a visit is preceded by the updated stats, computed once for all clients."""
+    if not len(hub):
+        return
+    if event == 'image' or (event == 'visit' and data.get('kind') == 'end'):
+        with app.app_context():
+            hub.publish('stats', stats_snapshot())
+    hub.publish(event, data)
+
+# Replaced by an EventSender when the dashboard runs in its own process
+event_sink = broadcast
+
+def publish_visit(kind, label, score, duration, visiting=()):
+    """Broadcasts a visit start or end to the dashboards, with the birds still
+    visiting afterwards."""
+    event_sink('visit', {'kind': kind, 'bird': label, 'score': round(float(score), 2),
+                         'duration': round(duration, 1), 'visiting': list(visiting)})
+
+def publish_image(filename):
+    """Broadcasts a newly saved image; called after its detection is logged."""
+    event_sink('image', {'filename': filename, 'bird': extract_bird_name(filename)})
 
 import threading
 
@@ -201,68 +360,59 @@ def close_application():
     os.system("sudo shutdown now")  # Shutdown the Raspberry Pi
     return "Shutting down...", 200
 
+# The pause flag is a file in the storage folder's state/ subfolder so the
+# classifier sees it when the dashboard runs in another process
+HUE_PAUSE_FILE = 'hue_paused'
+hue_pause_path = None
 hue_lights_paused = False
 
+def set_hue_lights_paused(paused):
+    global hue_lights_paused
+    hue_lights_paused = paused
+    if hue_pause_path is None:
+        return
+    if paused:
+        open(hue_pause_path, 'a').close()
+    elif os.path.exists(hue_pause_path):
+        os.remove(hue_pause_path)
+
 @app.route('/api/hue_pause', methods=['POST'])
 def pause_hue_lights():
-    global hue_lights_paused
     data = None
     try:
         data = request.get_json()
     except Exception:
         pass
     if data and 'paused' in data:
-        hue_lights_paused = data['paused']
-        print(f"Hue lights paused: {hue_lights_paused}")
-        return jsonify({'status': 'ok', 'paused': hue_lights_paused})
+        set_hue_lights_paused(bool(data['paused']))
+        print(f"Hue lights paused: {is_hue_lights_paused()}")
+        return jsonify({'status': 'ok', 'paused': is_hue_lights_paused()})
     return jsonify({'status': 'error'}), 400
 
 @app.route('/api/hue_pause', methods=['GET'])
 def get_hue_pause():
-    global hue_lights_paused
-    return jsonify({'paused': hue_lights_paused})
+    return jsonify({'paused': is_hue_lights_paused()})
 
 def is_hue_lights_paused():
-    global hue_lights_paused
+    if hue_pause_path is not None:
+        return os.path.exists(hue_pause_path)
     return hue_lights_paused
 
 TRAINING_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'training_data')
 
 
-def get_labeled_filenames():
-    """Return set of filenames that have already been labeled in training_data/."""
-    labeled = set()
-    if not os.path.isdir(TRAINING_DATA_DIR):
-        return labeled
-    for bird_dir in os.listdir(TRAINING_DATA_DIR):
-        bird_path = os.path.join(TRAINING_DATA_DIR, bird_dir)
-        if not os.path.isdir(bird_path):
-            continue
-        for id_type in ('PositiveID', 'NegativeID'):
-            id_path = os.path.join(bird_path, id_type)
-            if os.path.isdir(id_path):
-                for f in os.listdir(id_path):
-                    if f.endswith(('.png', '.jpg', '.jpeg')):
-                        labeled.add(f)
-    return labeled
+training_manifest = TrainingManifest(TRAINING_DATA_DIR)
+
+
+def get_labeled_filenames(filenames=None):
+    """Return set of filenames that have already been labeled in training_data/
+    (only those among filenames, if given)."""
+    return training_manifest.labeled_filenames(filenames)
 
 
 def get_training_counts():
-    """Return dict of {bird: {positive: N, negative: N}} from training_data folder."""
-    counts = {}
-    if not os.path.isdir(TRAINING_DATA_DIR):
-        return counts
-    for bird_dir in sorted(os.listdir(TRAINING_DATA_DIR)):
-        bird_path = os.path.join(TRAINING_DATA_DIR, bird_dir)
-        if not os.path.isdir(bird_path):
-            continue
-        pos_dir = os.path.join(bird_path, 'PositiveID')
-        neg_dir = os.path.join(bird_path, 'NegativeID')
-        pos = len([f for f in os.listdir(pos_dir) if f.endswith(('.png', '.jpg', '.jpeg'))]) if os.path.isdir(pos_dir) else 0
-        neg = len([f for f in os.listdir(neg_dir) if f.endswith(('.png', '.jpg', '.jpeg'))]) if os.path.isdir(neg_dir) else 0
-        if pos > 0 or neg > 0:
-            counts[bird_dir] = {'positive': pos, 'negative': neg}
-    return counts
+    """Return dict of {bird: {positive: N, negative: N}} from the training manifest."""
+    return training_manifest.counts()
 
 
 def load_labels():
@@ -301,10 +451,8 @@ def training_bird_images(bird):
     storage_folder = current_app.config.get('STORAGE_PATH', '')
     if not storage_folder or not os.path.isdir(storage_folder):
         return "No storage folder found.", 404
-    all_files = os.listdir(storage_folder)
-    search_term = bird.lower()
-    images = [f for f in all_files if search_term in f.lower() and f.endswith(('.png', '.jpg', '.jpeg'))]
-    labeled = get_labeled_filenames()
+    images = get_catalog(storage_folder).images(bird)
+    labeled = get_labeled_filenames(images)
     return render_template('training_select.html', bird=bird, images=images, labeled=labeled)
 
 
@@ -323,7 +471,7 @@ def extract_bird_name(filename):
 @app.route('/training/label/<filename>')
 def training_label_image(filename):
     """Show the labeling interface for a specific image."""
-    is_labeled = filename in get_labeled_filenames()
+    is_labeled = training_manifest.is_labeled(filename)
     detected_bird = extract_bird_name(filename)
     return render_template('training_label.html', filename=filename,
                            is_labeled=is_labeled, detected_bird=detected_bird or '')
@@ -361,11 +509,7 @@ def api_training_save():
     dest_dir = os.path.join(TRAINING_DATA_DIR, safe_label, id_folder)
     os.makedirs(dest_dir, exist_ok=True)
 
-    # Copy image
     dest_path = os.path.join(dest_dir, filename)
-    shutil.copy2(src_path, dest_path)
-
-    # Save annotation alongside image
     annotation = {
         'filename': filename,
         'label': label,
@@ -373,8 +517,15 @@ def api_training_save():
         'bbox': bbox
     }
     annotation_path = os.path.splitext(dest_path)[0] + '.json'
-    with open(annotation_path, 'w') as f:
-        json.dump(annotation, f, indent=2)
+
+    def write_files():
+        # Copy image and save annotation alongside it
+        shutil.copy2(src_path, dest_path)
+        with open(annotation_path, 'w') as f:
+            json.dump(annotation, f, indent=2)
+
+    # The manifest entry is only committed once both files are written
+    training_manifest.save(safe_label, id_folder, filename, bbox, write_files)
 
     return jsonify({'status': 'ok', 'saved_to': dest_path})
 
@@ -388,9 +539,20 @@ def serve_training_image(bird, id_type, filename):
     return "Image not found", 404
 
 
-def run_flask():
-    print("Starting Flask server...")
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+def run_flask(host='0.0.0.0', port=5000, max_streams=MAX_STREAMS, threads=REQUEST_THREADS):
+    """Serves the dashboard with waitress when it is installed, else with the
+    Flask development server. At most max_streams live streams are served at
+    once, each holding a thread; threads more are kept for other requests."""
+    streams.limit = max_streams
+    threads += max_streams
+    try:
+        from waitress import serve
+    except ImportError:
+        print("Starting Flask server (install waitress for production serving)...")
+        app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+        return
+    print("Starting waitress server with %d threads..." % threads)
+    serve(app, host=host, port=port, threads=threads)
 
 def start_flask_server():
     flask_thread = threading.Thread(target=run_flask)
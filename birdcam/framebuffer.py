@@ -0,0 +1,61 @@
+"""
+Frame ring buffer
+
+Fixed pool of preallocated frame slots used to hold each visit's best frame
+until the visit ends. Frames are copied into a free slot (no per-frame
+allocation); slots stay pinned until the frame is taken or released.
+
+"""
+import threading
+
+import numpy as np
+
+
+def sharpness(frame, step=2):
+    """Variance of a Laplacian over a strided grayscale view; higher is sharper."""
+    gray = frame[::step, ::step].sum(axis=2, dtype=np.int32)
+    lap = (gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1]
+           - 4 * gray[1:-1, 1:-1])
+    return float(lap.var())
+
+
+class FrameRing:
+    """Preallocated (size, height, width, 3) uint8 slots with pinning."""
+
+    def __init__(self, size, frame_shape):
+        self.frames = np.empty((size,) + tuple(frame_shape), dtype=np.uint8)
+        self._pinned = [False] * size
+        self._next = 0
+        self._lock = threading.Lock()
+        self.overflows = 0
+
+    def put(self, frame):
+        """Copies frame into the next unpinned slot and pins it. Returns the
+        slot index, or None if every slot is pinned."""
+        with self._lock:
+            size = len(self._pinned)
+            for i in range(size):
+                slot = (self._next + i) % size
+                if not self._pinned[slot]:
+                    self._pinned[slot] = True
+                    self._next = (slot + 1) % size
+                    break
+            else:
+                self.overflows += 1
+                return None
+        np.copyto(self.frames[slot], frame)
+        return slot
+
+    def get(self, slot):
+        """Returns a view of a pinned slot."""
+        return self.frames[slot]
+
+    def release(self, slot):
+        with self._lock:
+            self._pinned[slot] = False
+
+    def take(self, slot):
+        """Returns a copy of the slot's frame and releases the slot."""
+        frame = self.frames[slot].copy()
+        self.release(slot)
+        return frame
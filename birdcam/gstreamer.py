@@ -20,7 +20,10 @@ import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstBase', '1.0')
 from gi.repository import GLib, GObject, Gst, GstBase
-from PIL import Image
+import numpy as np
+
+import metrics
+from pipeline import Stage, DROP_OLDEST, BLOCK
 
 GObject.threads_init()
 Gst.init(None)
@@ -38,18 +41,80 @@ def on_bus_message(bus, message, loop):
         loop.quit()
     return True
 
-def on_new_sample(sink, overlay, screen_size, appsink_size, user_function):
-    sample = sink.emit('pull-sample')
-    buf = sample.get_buffer()
+def on_new_sample(sink, inference_stage):
+    # Runs on the streaming thread: hand the sample off and return immediately.
+    # The inference queue keeps only the newest frame if inference falls behind
+    # (counted in queue_dropped_total), so frames_total is every frame delivered.
+    metrics.inc('frames_total')
+    inference_stage.put(sink.emit('pull-sample'))
+    return Gst.FlowReturn.OK
+
+def frame_view(data, appsink_size):
+    """Wrap a mapped RGB buffer as a (height, width, 3) uint8 array without copying.
+    Rows may be padded to a 4-byte stride, so slice each row down to width * 3."""
+    width, height = appsink_size
+    rows = np.frombuffer(data, dtype=np.uint8).reshape(height, -1)
+    return rows[:, :width * 3].reshape(height, width, 3)
+
+def on_preview_sample(sink, preview):
+    # Copy the encoded JPEG out of the buffer for the viewers.
+    buf = sink.emit('pull-sample').get_buffer()
     result, mapinfo = buf.map(Gst.MapFlags.READ)
     if result:
-      img = Image.frombytes('RGB', (appsink_size[0], appsink_size[1]), mapinfo.data, 'raw')
-      svg_canvas = svgwrite.Drawing('', size=(screen_size[0], screen_size[1]))
-      user_function(img, svg_canvas)
-      overlay.set_property('data', svg_canvas.tostring())
-    buf.unmap(mapinfo)
+      try:
+        preview.publish(bytes(mapinfo.data))
+      finally:
+        buf.unmap(mapinfo)
     return Gst.FlowReturn.OK
 
+def update_preview_valve(valve, preview):
+    # Only feed the preview encoder while someone is watching.
+    valve.set_property('drop', not preview.watched())
+    return True
+
+def preview_encoder(quality):
+    if Gst.ElementFactory.find('v4l2jpegenc'):
+        return 'v4l2jpegenc'
+    return 'jpegenc quality=%d' % quality
+
+def buffer_time(buf):
+    """The buffer's presentation time in seconds, or None if it has none."""
+    if buf.pts == Gst.CLOCK_TIME_NONE:
+      return None
+    return buf.pts / Gst.SECOND
+
+def process_sample(sample, overlays, screen_size, appsink_size, user_function,
+                   media_time=False):
+    buf = sample.get_buffer()
+    with metrics.timer('map'):
+      result, mapinfo = buf.map(Gst.MapFlags.READ)
+    if result:
+      # The frame is a view of the mapped buffer and is only valid inside
+      # user_function; anything kept for later must be copied out.
+      svg_canvas = svgwrite.Drawing('', size=(screen_size[0], screen_size[1]))
+      try:
+        if media_time:
+          user_function(frame_view(mapinfo.data, appsink_size), svg_canvas, buffer_time(buf))
+        else:
+          user_function(frame_view(mapinfo.data, appsink_size), svg_canvas)
+      finally:
+        buf.unmap(mapinfo)
+      if overlays:
+        svg = svg_canvas.tostring()
+        for overlay in overlays:
+          overlay.set_property('data', svg)
+
+def watch_queue_overruns(pipeline):
+    # Count every time a leaky queue is full and drops a buffer.
+    it = pipeline.iterate_elements()
+    while True:
+      result, element = it.next()
+      if result != Gst.IteratorResult.OK:
+        break
+      if element.get_factory().get_name() == 'queue':
+        element.connect('overrun', lambda queue: metrics.inc('queue_overruns_total',
+                                                             queue=queue.get_name()))
+
 def detectCoralDevBoard():
   try:
     if 'MX8MQ' in open('/sys/firmware/devicetree/base/model').read():
@@ -60,7 +125,12 @@ def detectCoralDevBoard():
 
 def run_pipeline(user_function,
                  src_size=(640,480),
-                 appsink_size=(640, 480), videosrc='/dev/video0'):
+                 appsink_size=(640, 480), videosrc='/dev/video0', workers=1,
+                 preview=None, preview_size=(320, 240), preview_fps=5,
+                 preview_overlay=False, preview_quality=70):
+    """Runs the live camera pipeline. With a preview hub, a third tee branch
+    encodes a reduced size, reduced frame rate JPEG stream for the dashboard;
+    preview_overlay composites the SVG overlay into it."""
     PIPELINE = 'v4l2src device={videosrc} ! {src_caps} ! {leaky_q}  ! tee name=t'
     if detectCoralDevBoard():
         SRC_CAPS = 'video/x-raw,format=YUY2,width={width},height={height},framerate=30/1'
@@ -78,7 +148,19 @@ def run_pipeline(user_function,
                ! rsvgoverlay name=overlay ! videoconvert ! ximagesink
             """
 
-    SINK_ELEMENT = 'appsink name=appsink sync=false emit-signals=true max-buffers=1 drop=true'
+    if preview:
+        PIPELINE += """
+            t. ! {leaky_q} ! valve name=preview_valve drop=true
+               ! videorate drop-only=true ! videoscale ! videoconvert ! {preview_caps}
+               {preview_overlay} ! {preview_encoder} ! {preview_sink}
+            """
+
+    # The appsink never drops: on_new_sample pulls every buffer straight into the
+    # DROP_OLDEST inference stage, which does the dropping and counts it
+    SINK_ELEMENT = 'appsink name=appsink sync=false emit-signals=true max-buffers=1 drop=false'
+    PREVIEW_SINK = 'appsink name=preview sync=false emit-signals=true max-buffers=1 drop=true'
+    PREVIEW_CAPS = 'video/x-raw,width={width},height={height},framerate={fps}/1'
+    PREVIEW_OVERLAY = '! rsvgoverlay name=preview_overlay fit-to-frame=true ! videoconvert'
     DL_CAPS = 'video/x-raw,format=RGBA,width={width},height={height}'
     SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
     LEAKY_Q = 'queue max-size-buffers=1 leaky=downstream'
@@ -86,18 +168,74 @@ def run_pipeline(user_function,
     src_caps = SRC_CAPS.format(width=src_size[0], height=src_size[1])
     dl_caps = DL_CAPS.format(width=appsink_size[0], height=appsink_size[1])
     sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
+    preview_caps = PREVIEW_CAPS.format(width=preview_size[0], height=preview_size[1],
+                                       fps=preview_fps)
     pipeline = PIPELINE.format(videosrc=videosrc, leaky_q=LEAKY_Q,
         src_caps=src_caps, dl_caps=dl_caps, sink_caps=sink_caps,
+        sink_element=SINK_ELEMENT, preview_caps=preview_caps,
+        preview_overlay=PREVIEW_OVERLAY if preview_overlay else '',
+        preview_encoder=preview_encoder(preview_quality), preview_sink=PREVIEW_SINK)
+
+    launch_pipeline(pipeline, user_function, screen_size=src_size,
+                    appsink_size=appsink_size, queue_size=workers, workers=workers,
+                    preview=preview)
+
+def run_file_pipeline(user_function, path, appsink_size=(640, 480), workers=1):
+    """Decodes a recorded video file and feeds every frame to user_function as
+    fast as the model allows. Nothing is displayed and no frame is dropped:
+    when inference falls behind, the decoder waits. Each frame's timestamp (in
+    seconds of the recording) is passed as a third argument."""
+    PIPELINE = ('filesrc location="{path}" ! decodebin ! videoconvert ! videoscale '
+                '! {sink_caps} ! {sink_element}')
+    SINK_ELEMENT = 'appsink name=appsink sync=false emit-signals=true max-buffers=2 drop=false'
+    SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
+
+    sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
+    pipeline = PIPELINE.format(path=path, sink_caps=sink_caps,
+        sink_element=SINK_ELEMENT)
+    launch_pipeline(pipeline, user_function, screen_size=appsink_size,
+                    appsink_size=appsink_size, queue_size=workers * 2, policy=BLOCK,
+                    workers=workers, media_time=True)
+
+def run_test_pipeline(user_function, num_frames=300, appsink_size=(640, 480), workers=1):
+    """Feeds num_frames synthetic frames (a moving ball) to user_function as
+    fast as the model allows, for benchmarks without a camera. Frames carry
+    their timestamps like run_file_pipeline."""
+    PIPELINE = ('videotestsrc num-buffers={num_frames} pattern=ball ! videoconvert ! videoscale '
+                '! {sink_caps} ! {sink_element}')
+    SINK_ELEMENT = 'appsink name=appsink sync=false emit-signals=true max-buffers=2 drop=false'
+    SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
+
+    sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
+    pipeline = PIPELINE.format(num_frames=num_frames, sink_caps=sink_caps,
         sink_element=SINK_ELEMENT)
+    launch_pipeline(pipeline, user_function, screen_size=appsink_size,
+                    appsink_size=appsink_size, queue_size=workers * 2, policy=BLOCK,
+                    workers=workers, media_time=True)
 
+def launch_pipeline(pipeline, user_function, screen_size, appsink_size,
+                    queue_size=1, policy=DROP_OLDEST, workers=1, preview=None,
+                    media_time=False):
     print('Gstreamer pipeline: ', pipeline)
     pipeline = Gst.parse_launch(pipeline)
 
-    overlay = pipeline.get_by_name('overlay')
+    overlays = [o for o in (pipeline.get_by_name('overlay'),
+                            pipeline.get_by_name('preview_overlay')) if o]
     appsink = pipeline.get_by_name('appsink')
+    inference_stage = Stage('inference', partial(process_sample,
+        overlays=overlays, screen_size = screen_size,
+        appsink_size=appsink_size, user_function=user_function,
+        media_time=media_time),
+        maxsize=queue_size, policy=policy, workers=workers)
     appsink.connect('new-sample', partial(on_new_sample,
-        overlay=overlay, screen_size = src_size,
-        appsink_size=appsink_size, user_function=user_function))
+        inference_stage=inference_stage))
+    watch_queue_overruns(pipeline)
+    preview_sink = pipeline.get_by_name('preview')
+    if preview and preview_sink:
+        preview_sink.connect('new-sample', partial(on_preview_sample, preview=preview))
+        GLib.timeout_add_seconds(1, update_preview_valve,
+                                 pipeline.get_by_name('preview_valve'), preview)
+        preview.enabled = True
     loop = GObject.MainLoop()
 
     # Set up a pipeline bus watch to catch errors.
@@ -112,7 +250,11 @@ def run_pipeline(user_function,
     except:
         pass
 
-    # Clean up.
+    # Clean up. Queued frames are only worth finishing when none may be dropped;
+    # closing the stage first also releases a streaming thread blocked on it.
+    inference_stage.close(wait=(policy == BLOCK))
+    if preview:
+        preview.enabled = False
     pipeline.set_state(Gst.State.NULL)
     while GLib.MainContext.default().iteration(False):
         pass
@@ -0,0 +1,174 @@
+"""
+Image catalog
+
+Keeps an in-memory index of the saved 'img-<bird>_<score>_<ts>' frames in the
+storage folder. Each filename is parsed once and filed under its species,
+sorted by timestamp and by score, so best/latest lookups and gallery listings
+do not need a directory scan. save_data() reports new files through add();
+any other change to the folder is picked up by comparing the folder mtime.
+Bookkeeping files are kept in the state/ subfolder (see state_path) so that
+writing them does not change the folder mtime and trigger a rescan.
+
+"""
+import os
+import re
+import threading
+from bisect import insort
+from collections import namedtuple
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+STATE_DIR = 'state'
+
+ImageEntry = namedtuple('ImageEntry', ['filename', 'key', 'score', 'ts'])
+
+
+def species_key(name):
+    """Normalise a bird name for matching: lowercase with spaces removed."""
+    return name.lower().replace(' ', '')
+
+
+def state_path(folder, name, create=True):
+    """Path of a bookkeeping file (detection index, retention accounting, the
+    Hue pause flag) of a storage folder."""
+    state = os.path.join(folder, STATE_DIR)
+    if create:
+        os.makedirs(state, exist_ok=True)
+    return os.path.join(state, name)
+
+
+def parse_image_filename(filename):
+    """Return an ImageEntry for a saved frame filename, or None if it is not one."""
+    if not filename.startswith('img-') or not filename.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    stem = os.path.splitext(filename)[0][len('img-'):]
+    m = re.search(r'_(\d{2})_(\d{10,})$', stem)
+    if m:
+        return ImageEntry(filename, species_key(stem[:m.start()]),
+                          int(m.group(1)), int(m.group(2)))
+    # old filename format — bare timestamp, score 0
+    m = re.search(r'(\d{10,})$', stem)
+    if m:
+        return ImageEntry(filename, species_key(stem[:m.start()]), 0, int(m.group(1)))
+    return ImageEntry(filename, species_key(stem), 0, 0)
+
+
+class _Species:
+    """Entries for one species, ordered by timestamp and by (score, timestamp)."""
+
+    def __init__(self):
+        self.by_ts = []
+        self.by_score = []
+
+    def add(self, entry):
+        insort(self.by_ts, (entry.ts, entry.filename))
+        insort(self.by_score, (entry.score, entry.ts, entry.filename))
+
+    def remove(self, entry):
+        self.by_ts.remove((entry.ts, entry.filename))
+        self.by_score.remove((entry.score, entry.ts, entry.filename))
+
+
+class ImageCatalog:
+    """Per-species index of the saved frames in one storage folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._species = {}
+        self._dir_mtime = None
+
+    def _add_entry(self, entry):
+        self._entries[entry.filename] = entry
+        self._species.setdefault(entry.key, _Species()).add(entry)
+
+    def _remove_entry(self, filename):
+        entry = self._entries.pop(filename)
+        species = self._species[entry.key]
+        species.remove(entry)
+        if not species.by_ts:
+            del self._species[entry.key]
+
+    def add(self, filename):
+        """Record a newly saved frame (called by save_data)."""
+        entry = parse_image_filename(os.path.basename(filename))
+        if entry is None:
+            return
+        with self._lock:
+            if entry.filename not in self._entries:
+                self._add_entry(entry)
+
+    def discard(self, filename):
+        """Forget a frame that has been deleted from the folder."""
+        with self._lock:
+            if filename in self._entries:
+                self._remove_entry(filename)
+
+    def refresh(self):
+        """Reconcile with the folder if it changed since the last scan."""
+        try:
+            mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            if mtime == self._dir_mtime:
+                return
+            names = set(os.listdir(self.folder))
+            for filename in [f for f in self._entries if f not in names]:
+                self._remove_entry(filename)
+            for filename in names.difference(self._entries):
+                entry = parse_image_filename(filename)
+                if entry is not None:
+                    self._add_entry(entry)
+            self._dir_mtime = mtime
+
+    def _matching(self, bird_filters):
+        if not bird_filters:
+            return list(self._species.values())
+        keys = [species_key(bf) for bf in bird_filters]
+        return [species for key, species in self._species.items()
+                if any(k in key for k in keys)]
+
+    def best(self, bird_filters=None):
+        """Return the filename with the highest (score, timestamp), or None."""
+        self.refresh()
+        with self._lock:
+            tops = [s.by_score[-1] for s in self._matching(bird_filters)]
+        return max(tops)[2] if tops else None
+
+    def latest(self, bird_filters=None):
+        """Return the most recently saved filename, or None."""
+        self.refresh()
+        with self._lock:
+            tops = [s.by_ts[-1] for s in self._matching(bird_filters)]
+        return max(tops)[1] if tops else None
+
+    def images(self, bird, offset=0, limit=None):
+        """Return filenames for species matching bird, oldest first."""
+        self.refresh()
+        with self._lock:
+            matches = self._matching([bird])
+            if len(matches) == 1:
+                items = matches[0].by_ts
+            else:
+                items = sorted(item for s in matches for item in s.by_ts)
+            end = None if limit is None else offset + limit
+            return [filename for _, filename in items[offset:end]]
+
+    def __len__(self):
+        self.refresh()
+        with self._lock:
+            return len(self._entries)
+
+
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+
+def get_catalog(folder):
+    """Return the shared ImageCatalog for a storage folder."""
+    folder = os.path.abspath(folder)
+    with catalogs_lock:
+        if folder not in catalogs:
+            catalogs[folder] = ImageCatalog(folder)
+        return catalogs[folder]
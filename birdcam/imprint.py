@@ -0,0 +1,456 @@
+"""
+Weight imprinting
+
+Retrains the last layer of the bird classifier on the images labeled in the
+dashboard, on the Pi itself. The CPU build of the model
+(mobilenet_v2_1.0_224_inat_bird_quant.tflite) is run over each labeled crop to
+get its penultimate-layer embedding (the 1280 pooled features the model's own
+classifier reads). Embeddings are computed once per crop and kept in a
+memory-mapped store keyed by a hash of the image file and its bbox, so after a
+few new labels only those crops go through the model again.
+
+The model's own class logits are cached alongside, and the labeled classes
+are then imprinted into the full classifier in seconds: each gets the
+normalized mean of its PositiveID embeddings as its weights, calibrated
+against the model's logits and optionally refined by a few epochs of softmax
+regression over all classes that also pushes NegativeID crops away from
+their label. Only the labeled classes' scores are replaced (or added, for
+labels the model does not know); background and every other class keep the
+model's own logits, so an empty feeder still scores as background.
+The new rows are saved as an NPZ (the head) and used by bird_classify
+--head, which reads the embedding and logits from the CPU interpreter. An
+EdgeTPU build would need the rows written back into the .tflite and
+compiled with edgetpu_compiler off the device.
+
+    python3 imprint.py --model models/mobilenet_v2_1.0_224_inat_bird_quant.tflite \\
+        --output models/birdcam_head.npz
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+import backends
+from export_dataset import DEFAULT_LABELS, DEFAULT_TRAINING_DATA, build_label_map, crop_image, read_labels
+from training_manifest import TrainingManifest
+
+DEFAULT_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models',
+                             'mobilenet_v2_1.0_224_inat_bird_quant.tflite')
+STORE_NAME = 'embeddings'
+VECTORS_NAME = 'vectors.f32'
+INDEX_NAME = 'index.json'
+# Cosine similarities are in [-1, 1]; the softmax needs them spread out
+DEFAULT_SCALE = 10.0
+# Logits by which an imprinted class beats the model's best class on its own positives
+CALIBRATION_MARGIN = 1.0
+
+
+def find_embedding_tensor(interpreter, name=None):
+    """Returns the details of the penultimate-layer tensor: the named one, or
+    the widest 1x1 feature vector that is not the class output."""
+    details = interpreter.get_tensor_details()
+    if name:
+        for detail in details:
+            if detail['name'] == name:
+                return detail
+        raise ValueError('No tensor named %s in the model' % name)
+    num_classes = interpreter.get_output_details()[0]['shape'][-1]
+    best = None
+    for detail in details:
+        shape = detail['shape']
+        # Pooled features are (1, C) or (1, 1, 1, C); weights and biases are not
+        if (len(shape) < 2 or shape[0] != 1 or int(np.prod(shape)) != shape[-1] or
+                shape[-1] == num_classes):
+            continue
+        if best is None or shape[-1] > best['shape'][-1]:
+            best = detail
+    if best is None:
+        raise ValueError('Could not find the embedding tensor; pass --embedding_tensor')
+    return best
+
+
+def find_logits_tensor(interpreter, name=None):
+    """Returns the details of the pre-softmax class logits: the named one, or
+    the class-sized vector that is not the output. None if the model has no
+    such tensor, in which case the logs of the output scores are used."""
+    details = interpreter.get_tensor_details()
+    if name:
+        for detail in details:
+            if detail['name'] == name:
+                return detail
+        raise ValueError('No tensor named %s in the model' % name)
+    output = interpreter.get_output_details()[0]
+    num_classes = output['shape'][-1]
+    for detail in details:
+        shape = detail['shape']
+        if 'softmax' in detail['name'].lower():
+            continue
+        if (detail['index'] != output['index'] and len(shape) >= 2 and shape[0] == 1 and
+                int(np.prod(shape)) == shape[-1] == num_classes):
+            return detail
+    return None
+
+
+def make_logits_reader(interpreter, detail):
+    """Returns a function giving the float32 class logits of the last invoke,
+    from the logits tensor or, without one, as the logs of the output scores
+    (which give the same softmax)."""
+    if detail is None:
+        detail = interpreter.get_output_details()[0]
+        as_log = True
+    else:
+        as_log = False
+    index = detail['index']
+    scale, zero_point = detail['quantization']
+    def read():
+        values = interpreter.get_tensor(index).reshape(-1).astype(np.float32)
+        if scale:
+            values = (values - zero_point) * scale
+        return np.log(np.maximum(values, 1e-6)) if as_log else values
+    return read
+
+
+def make_embedding_reader(interpreter, detail):
+    """Returns a function giving the L2-normalized float32 embedding of the
+    last invoke. The interpreter must preserve intermediate tensors."""
+    index = detail['index']
+    scale, zero_point = detail['quantization']
+    def read():
+        values = interpreter.get_tensor(index).reshape(-1).astype(np.float32)
+        if scale:
+            values = (values - zero_point) * scale
+        norm = np.linalg.norm(values)
+        return values / norm if norm else values
+    return read
+
+
+def file_key(path, bbox):
+    """Store key of a crop: hash of the image bytes and its bbox."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(json.dumps(bbox, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """Append-only embeddings in a memory-mapped float32 file, one row per key.
+
+    index.json maps keys to rows and records the model and tensor the vectors
+    came from; if either changes the store starts over."""
+
+    def __init__(self, folder, model, tensor, dim):
+        self.folder = folder
+        self.vectors_path = os.path.join(folder, VECTORS_NAME)
+        self.index_path = os.path.join(folder, INDEX_NAME)
+        self.dim = dim
+        self.identity = {'model': model, 'tensor': tensor, 'dim': dim}
+        os.makedirs(folder, exist_ok=True)
+        self.rows = {}
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get('identity') == self.identity:
+                self.rows = index['rows']
+            else:
+                print('Model changed, recomputing embeddings')
+        except (OSError, ValueError, KeyError):
+            pass
+        if not self.rows and os.path.exists(self.vectors_path):
+            os.remove(self.vectors_path)
+        self.capacity = 0
+        self._vectors = None
+        self._reserve(max(len(self.rows), 1))
+
+    def _reserve(self, count):
+        # Grows the file by doubling so appends rarely remap it
+        if count <= self.capacity:
+            return
+        row_bytes = self.dim * 4
+        existing = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        capacity = max(count, self.capacity * 2, 64, existing)
+        if capacity > existing:
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                  shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, key, vector):
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.rows)
+            self._reserve(row + 1)
+            self.rows[key] = row
+        self._vectors[row] = vector
+
+    def get(self, keys):
+        """Returns the (len(keys), dim) embeddings of keys."""
+        return np.asarray(self._vectors[[self.rows[key] for key in keys]])
+
+    def flush(self):
+        self._vectors.flush()
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump({'identity': self.identity, 'rows': self.rows}, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+
+class Embedder:
+    """Computes crop embeddings, followed by the model's class logits, with a
+    CPU interpreter."""
+
+    def __init__(self, model_path, num_threads=None, tensor_name=None, logits_name=None):
+        self.model_path = model_path
+        self.interpreter = backends.cpu_interpreters(model_path, 1, num_threads or os.cpu_count() or 1,
+                                                     preserve_all_tensors=True)[0]
+        self.interpreter.allocate_tensors()
+        self.tensor = find_embedding_tensor(self.interpreter, tensor_name)
+        self.logits_tensor = find_logits_tensor(self.interpreter, logits_name)
+        self.embedding_dim = int(self.tensor['shape'][-1])
+        self.num_classes = int(self.interpreter.get_output_details()[0]['shape'][-1])
+        self.dim = self.embedding_dim + self.num_classes
+        _, height, width, _ = self.interpreter.get_input_details()[0]['shape']
+        self.input_size = (int(width), int(height))
+        self._write = backends.make_input_writer(self.interpreter, self.input_size)
+        self._read = make_embedding_reader(self.interpreter, self.tensor)
+        self._read_logits = make_logits_reader(self.interpreter, self.logits_tensor)
+
+    @property
+    def logits_name(self):
+        return self.logits_tensor['name'] if self.logits_tensor else ''
+
+    def embed(self, crop):
+        self._write(crop)
+        self.interpreter.invoke()
+        return np.concatenate([self._read(), self._read_logits()])
+
+
+def collect(training_data, store, embedder):
+    """Embeds the labeled crops missing from the store; returns
+    (samples, computed) where samples are (label, positive, key) triples."""
+    samples, computed = [], 0
+    for label, id_type, filename, bbox in TrainingManifest(training_data).entries():
+        path = os.path.join(training_data, label, id_type, filename)
+        try:
+            key = file_key(path, bbox)
+        except OSError:
+            continue
+        if key not in store:
+            _, crop = crop_image((key, path, bbox, embedder.input_size[0]))
+            if crop is None:
+                continue
+            store.add(key, embedder.embed(crop))
+            computed += 1
+        samples.append((label, id_type == 'PositiveID', key))
+    store.flush()
+    return samples, computed
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    e = np.exp(logits)
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def imprint(embeddings, targets, num_classes):
+    """Weights of each class: the normalized mean of its embeddings."""
+    weights = np.zeros((num_classes, embeddings.shape[1]), np.float32)
+    np.add.at(weights, targets, embeddings)
+    norms = np.linalg.norm(weights, axis=1, keepdims=True)
+    return weights / np.where(norms > 0, norms, 1)
+
+
+def calibrate(weights, embeddings, base_logits, targets, scale=DEFAULT_SCALE,
+              margin=CALIBRATION_MARGIN):
+    """Biases putting each imprinted class's logit on its positives margin
+    above the model's best logit for them, so imprinted and model scores
+    compare: crops far from the imprinted weights fall back to the model's
+    classes, background included."""
+    bias = np.zeros(len(weights), np.float32)
+    offsets = (base_logits.max(axis=1) + margin -
+               scale * np.einsum('ij,ij->i', embeddings, weights[targets]))
+    for c in range(len(weights)):
+        bias[c] = offsets[targets == c].mean()
+    return bias
+
+
+def combined_logits(base_logits, ids, weights, bias, embeddings, scale, size):
+    """Model logits with the imprinted classes (columns ids) replaced or added."""
+    logits = np.empty((len(base_logits), size), np.float32)
+    logits[:, :base_logits.shape[1]] = base_logits
+    logits[:, ids] = scale * embeddings @ weights.T + bias
+    return logits
+
+
+def train(weights, bias, ids, size, embeddings, base_logits, targets, negatives=None,
+          negative_base=None, negative_targets=None, epochs=100, learning_rate=0.5,
+          scale=DEFAULT_SCALE, negative_weight=0.5):
+    """Refines the imprinted rows by full-batch softmax regression over every
+    class (the model's logits stay fixed) on the positives, plus -log(1 - p)
+    for each negative's label; returns (weights, bias). targets are indices
+    into ids."""
+    weights, bias = weights.copy(), bias.copy()
+    onehot = np.zeros((len(embeddings), size), np.float32)
+    onehot[np.arange(len(embeddings)), ids[targets]] = 1
+    has_negatives = negatives is not None and len(negatives)
+    if has_negatives:
+        negative_onehot = np.zeros((len(negatives), size), np.float32)
+        negative_onehot[np.arange(len(negatives)), ids[negative_targets]] = 1
+    for _ in range(epochs):
+        p = softmax(combined_logits(base_logits, ids, weights, bias, embeddings, scale, size))
+        grad = ((p - onehot) / len(embeddings))[:, ids]
+        grad_w = scale * grad.T @ embeddings
+        grad_b = grad.sum(0)
+        if has_negatives:
+            pn = softmax(combined_logits(negative_base, ids, weights, bias, negatives,
+                                         scale, size))
+            pc = pn[np.arange(len(negatives)), ids[negative_targets]][:, None]
+            # d/dlogits of -log(1 - p_c) is p_c / (1 - p_c) * (onehot_c - p)
+            gn = (pc / np.maximum(1 - pc, 1e-6) * (negative_onehot - pn))[:, ids]
+            grad_w += negative_weight * scale * gn.T @ negatives / len(negatives)
+            grad_b += negative_weight * gn.sum(0) / len(negatives)
+        weights -= learning_rate * grad_w
+        bias -= learning_rate * grad_b
+    return weights.astype(np.float32), bias.astype(np.float32)
+
+
+def build_head(samples, store, model_labels, embedding_dim, num_classes, epochs=0,
+               scale=DEFAULT_SCALE, negative_weight=0.5):
+    """Returns (labels, weights, bias, ids) for the classes with positive
+    samples: labels are every output's label (the model's, then labels it
+    does not know), ids the outputs whose scores the imprinted rows give."""
+    folders = sorted({label for label, positive, _ in samples if positive})
+    if not folders:
+        raise ValueError('No PositiveID images labeled yet')
+    # Folders naming the same class (common and scientific name) share one row
+    label_ids = build_label_map(folders, model_labels)
+    ids = np.array(sorted(set(label_ids.values())))
+    class_index = {label: int(np.searchsorted(ids, label_ids[label])) for label in folders}
+    size = max(num_classes, int(ids.max()) + 1)
+    names = {class_id: label for label, class_id in model_labels.items()}
+    for label in folders:
+        names.setdefault(label_ids[label], label)
+    labels = [names.get(i, str(i)) for i in range(size)]
+
+    def split(keys):
+        rows = store.get(keys)
+        return rows[:, :embedding_dim], rows[:, embedding_dim:]
+
+    positives = [(class_index[label], key) for label, positive, key in samples if positive]
+    negatives = [(class_index[label], key) for label, positive, key in samples
+                 if not positive and label in class_index]
+    embeddings, base_logits = split([key for _, key in positives])
+    targets = np.array([i for i, _ in positives])
+    weights = imprint(embeddings, targets, len(ids))
+    bias = calibrate(weights, embeddings, base_logits, targets, scale)
+    if epochs:
+        negative_embeddings = negative_base = None
+        if negatives:
+            negative_embeddings, negative_base = split([key for _, key in negatives])
+        weights, bias = train(weights, bias, ids, size, embeddings, base_logits, targets,
+                              negative_embeddings, negative_base,
+                              np.array([i for i, _ in negatives]), epochs, scale=scale,
+                              negative_weight=negative_weight)
+    return labels, weights, bias, ids
+
+
+def save_head(path, labels, weights, bias, ids, tensor, logits_tensor, scale=DEFAULT_SCALE):
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, labels=np.array(labels), weights=weights, bias=bias, ids=ids,
+                 tensor=np.array(tensor), logits_tensor=np.array(logits_tensor),
+                 scale=np.float32(scale))
+    os.replace(path + '.tmp', path)
+
+
+class Head:
+    """Imprinted classifier rows, loaded from the NPZ written by imprint.py."""
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.labels = [str(label) for label in data['labels']]
+            self.weights = data['weights'].astype(np.float32)
+            self.bias = data['bias'].astype(np.float32)
+            self.ids = data['ids'].astype(np.int64)
+            self.tensor = str(data['tensor'])
+            self.logits_tensor = str(data['logits_tensor'])
+            self.scale = float(data['scale'])
+
+    def label_dict(self):
+        """{id: label} like read_label_file."""
+        return dict(enumerate(self.labels))
+
+    def make_top_classes(self, interpreter):
+        """Like backends.make_top_classes, with the imprinted classes scored
+        from the embedding and every other class from the model's logits."""
+        read = make_embedding_reader(interpreter, find_embedding_tensor(interpreter, self.tensor))
+        read_logits = make_logits_reader(
+            interpreter, find_logits_tensor(interpreter, self.logits_tensor) if self.logits_tensor else None)
+        weights = self.weights * self.scale
+        logits = np.empty(len(self.labels), np.float32)
+        def top_classes(top_k, threshold):
+            base = read_logits()
+            logits[:len(base)] = base
+            logits[self.ids] = weights @ read() + self.bias
+            scores = softmax(logits)
+            k = min(top_k, scores.size)
+            ids = np.argpartition(scores, -k)[-k:]
+            ids = ids[np.argsort(-scores[ids], kind='stable')]
+            return [(int(i), float(scores[i])) for i in ids if scores[i] >= threshold]
+        return top_classes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=DEFAULT_MODEL,
+                        help='Non-EdgeTPU .tflite model the embeddings come from')
+    parser.add_argument('--labels', default=DEFAULT_LABELS, help='Model label file')
+    parser.add_argument('--training_data', default=DEFAULT_TRAINING_DATA)
+    parser.add_argument('--store', default=None,
+                        help='Embedding store folder (default: training_data/embeddings)')
+    parser.add_argument('--output', required=True, help='Head NPZ to write')
+    parser.add_argument('--embedding_tensor', default=None,
+                        help='Name of the penultimate tensor (default: found automatically)')
+    parser.add_argument('--logits_tensor', default=None,
+                        help='Name of the pre-softmax logits tensor (default: found '
+                             'automatically, else the logs of the output scores)')
+    parser.add_argument('--epochs', type=int, default=100,
+                        help='Softmax regression epochs after imprinting (0: imprint only)')
+    parser.add_argument('--scale', type=float, default=DEFAULT_SCALE,
+                        help='Logit scale applied to the cosine similarities')
+    parser.add_argument('--negative_weight', type=float, default=0.5,
+                        help='Weight of the NegativeID loss while training')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    model_path = backends.cpu_model_path(args.model)
+    start = time.monotonic()
+    embedder = Embedder(model_path, args.num_threads, args.embedding_tensor, args.logits_tensor)
+    store = EmbeddingStore(args.store or os.path.join(args.training_data, STORE_NAME),
+                           os.path.basename(model_path),
+                           '%s+%s' % (embedder.tensor['name'], embedder.logits_name), embedder.dim)
+    samples, computed = collect(args.training_data, store, embedder)
+    print('Embedded %d new crops, %d cached, in %.1f s' %
+          (computed, len(samples) - computed, time.monotonic() - start))
+
+    start = time.monotonic()
+    labels, weights, bias, ids = build_head(samples, store, read_labels(args.labels),
+                                            embedder.embedding_dim, embedder.num_classes,
+                                            args.epochs, args.scale, args.negative_weight)
+    save_head(args.output, labels, weights, bias, ids, embedder.tensor['name'],
+              embedder.logits_name, args.scale)
+    print('Imprinted %d classes into the %d class classifier, written to %s in %.2f s' %
+          (len(ids), len(labels), args.output, time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
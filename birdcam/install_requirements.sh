@@ -18,6 +18,8 @@ if grep -s -q "Mendel" /etc/os-release; then
 else
   # Install gstreamer
   sudo apt-get install -y gstreamer1.0-plugins-bad gstreamer1.0-plugins-good python3-gst-1.0 python3-gi gir1.2-gtk-3.0 python3-svgwrite
+  # Production server for the dashboard (serve.py falls back to the Flask dev server without it)
+  sudo apt-get install -y python3-waitress
 
   if grep -s -q "Raspberry Pi" /sys/firmware/devicetree/base/model; then
     echo "Installing Raspberry Pi specific dependencies"
@@ -0,0 +1,49 @@
+"""
+Label table
+
+Everything the detection path needs to know about a class, computed once when
+the model loads: label and common name, whether it is excluded (known false
+positives) and whether the Hue lights have a colour for it. Per-frame work is
+then array indexing by class id instead of string parsing and list scans.
+
+"""
+import numpy as np
+
+
+def common_name(label):
+    """'Cardinalis cardinalis (Northern Cardinal)' -> 'Northern Cardinal'."""
+    start, end = label.find('('), label.find(')')
+    if 0 <= start < end:
+        return label[start + 1:end]
+    return label
+
+
+class LabelTable:
+    """Per-class lookups indexed by model output id.
+
+    labels is the {id: label} dict from read_label_file; exclusions are labels
+    that never count as detections; colors is the 'birds' map of the Hue config."""
+
+    def __init__(self, labels, exclusions=(), colors=None, num_classes=None):
+        size = max(max(labels) + 1 if labels else 0, num_classes or 0)
+        colors = colors or {}
+        self.names = [labels.get(i, str(i)) for i in range(size)]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.common = [common_name(name) for name in self.names]
+        self.excluded = np.array([name in exclusions for name in self.names], dtype=bool)
+        self.colored = np.array([name in colors for name in self.names], dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def detections(self, results):
+        """(label, score) pairs for the classify() results that are not excluded."""
+        return [(self.names[i], score) for i, score in results if not self.excluded[i]]
+
+    def common_name(self, label):
+        i = self.ids.get(label)
+        return self.common[i] if i is not None else common_name(label)
+
+    def is_colored(self, label):
+        i = self.ids.get(label)
+        return i is not None and bool(self.colored[i])
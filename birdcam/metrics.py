@@ -0,0 +1,179 @@
+"""
+Metrics
+
+Per-stage timers, counters and gauges for the frame path, rendered in the
+Prometheus text format on the dashboard's /metrics route. Each stage keeps a
+rolling window of recent durations for p50/p95/p99 plus running totals.
+
+    with metrics.timer('invoke'):
+        interpreter.invoke()
+    metrics.inc('queue_overruns_total', queue='camera')
+
+When the dashboard runs in its own process, bird_classify writes a snapshot
+to SNAPSHOT_PATH every few seconds and the dashboard renders that.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PREFIX = 'birdcam'
+QUANTILES = (0.5, 0.95, 0.99)
+SNAPSHOT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                             'birdcam-metrics.json')
+
+
+class Histogram:
+    """Recent durations (seconds) of one stage, with running count and sum."""
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def quantiles(self, qs=QUANTILES):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs}
+
+
+class Registry:
+    """Holds the stage histograms, counters and gauge callbacks."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._callbacks = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def gauge(self, name, fn, **labels):
+        """Registers fn() to be read whenever metrics are collected."""
+        with self._lock:
+            self._callbacks[(name, tuple(sorted(labels.items())))] = ('gauges', fn)
+
+    def counter(self, name, fn, **labels):
+        """Like gauge(), for running totals other objects already keep, such
+        as queue drops."""
+        with self._lock:
+            self._callbacks[(name, tuple(sorted(labels.items())))] = ('counters', fn)
+
+    def snapshot(self):
+        """Returns the current values as a JSON-serialisable dict."""
+        with self._lock:
+            histograms = {stage: {'quantiles': {str(q): v for q, v in h.quantiles().items()},
+                                  'count': h.count, 'sum': h.sum}
+                          for stage, h in self._histograms.items()}
+            counters = [[name, dict(labels), value]
+                        for (name, labels), value in self._counters.items()]
+            callbacks = list(self._callbacks.items())
+        result = {'time': time.time(), 'histograms': histograms,
+                  'counters': counters, 'gauges': []}
+        for (name, labels), (kind, fn) in callbacks:
+            try:
+                result[kind].append([name, dict(labels), fn()])
+            except Exception:
+                pass
+        return result
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+def render(snapshot):
+    """Formats a snapshot in the Prometheus text exposition format."""
+    lines = []
+    name = '%s_stage_seconds' % PREFIX
+    lines.append('# HELP %s Time spent in each stage of the frame path.' % name)
+    lines.append('# TYPE %s summary' % name)
+    for stage, h in sorted(snapshot['histograms'].items()):
+        for q, v in sorted(h['quantiles'].items()):
+            lines.append('%s%s %.6f' % (name, _labels({'stage': stage, 'quantile': q}), v))
+        lines.append('%s_sum%s %.6f' % (name, _labels({'stage': stage}), h['sum']))
+        lines.append('%s_count%s %d' % (name, _labels({'stage': stage}), h['count']))
+    for kind, entries in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+        seen = set()
+        for metric, labels, value in sorted(entries, key=lambda e: (e[0], sorted(e[1].items()))):
+            full = '%s_%s' % (PREFIX, metric)
+            if full not in seen:
+                lines.append('# TYPE %s %s' % (full, kind))
+                seen.add(full)
+            lines.append('%s%s %s' % (full, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(path, snapshot):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path):
+    """Returns the snapshot saved at path, or None if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SnapshotWriter:
+    """Saves the registry to path every interval seconds for another process."""
+
+    def __init__(self, registry, path=SNAPSHOT_PATH, interval=5.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        thread = threading.Thread(target=self._run, name='metrics-writer')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                write_snapshot(self.path, self.registry.snapshot())
+            except OSError as e:
+                print('Could not write metrics snapshot: %s' % e)
+
+
+registry = Registry()
+timer = registry.timer
+observe = registry.observe
+inc = registry.inc
+gauge = registry.gauge
+counter = registry.counter
@@ -1,30 +1,282 @@
 import os
+import json
+import queue
+import threading
+import time
+import uuid
+from pymongo.errors import BulkWriteError, PyMongoError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
-# Get the password from the environment variable
-mongodb_password = os.environ["MONGODB_PASSWORD"]
+import metrics
 
-# Construct the URI with the password
-uri = "mongodb+srv://jackson8:{}@birdcam.tpshz91.mongodb.net/?retryWrites=true&w=majority&appName=BirdCam".format(mongodb_password)
-print("Connection string: ", uri)
+# Seconds to wait for Atlas before giving up on a connection or server selection
+TIMEOUT_MS = 5000
+
+# Longest wait between reconnect attempts while offline
+MAX_RETRY_INTERVAL = 600.0
+
+client = None
+collection = None
+client_lock = threading.Lock()
+
+
+class Unavailable(Exception):
+    """The collection could not be obtained (missing config or no connection)."""
+
+
+def get_collection():
+    """Returns the BirdVisitors collection, creating the client on first use.
+    Nothing touches the network until this is called."""
+    global client, collection
+    with client_lock:
+        if collection is None:
+            # Get the password from the environment variable
+            mongodb_password = os.environ.get("MONGODB_PASSWORD")
+            if not mongodb_password:
+                raise Unavailable('MONGODB_PASSWORD is not set')
+            # Construct the URI with the password
+            uri = "mongodb+srv://jackson8:{}@birdcam.tpshz91.mongodb.net/?retryWrites=true&w=majority&appName=BirdCam".format(mongodb_password)
+            # Create a new client (connects lazily, on the first operation)
+            client = MongoClient(uri, server_api=ServerApi('1'),
+                                 connectTimeoutMS=TIMEOUT_MS,
+                                 serverSelectionTimeoutMS=TIMEOUT_MS)
+            collection = client["Birds"]["BirdVisitors"]
+        return collection
 
-# Create a new client and connect to the server
-client = MongoClient(uri, server_api=ServerApi('1'))
 
 # Send a ping to confirm a successful connection
 def mongoDB_connect():
-    try:
-        client.admin.command('ping')
-        print("Pinged your deployment. You successfully connected to MongoDB!")
-    except Exception as e:
-        print(e)
+    get_collection()
+    client.admin.command('ping')
+    print("Pinged your deployment. You successfully connected to MongoDB!")
+    return client
+
+
+writer = None
+
+
+class MongoWriter:
+    """Buffers records and writes them with insert_many from a background thread.
+
+    A batch is flushed when it reaches batch_size records or flush_interval
+    seconds. Records that cannot be written (remote unreachable, collection
+    unavailable, or the queue is full) are appended to a local JSONL spool and
+    replayed once the remote is back; while offline, attempts back off from
+    retry_interval up to MAX_RETRY_INTERVAL. Every record gets a unique _id up front, so a replayed record
+    that did reach the server is skipped instead of duplicated.
+    get_collection is any callable returning a pymongo-compatible collection
+    (a mongomock collection works for testing). With upload=False every record
+    goes to the spool and the remote is never contacted."""
+
+    def __init__(self, get_collection, spool_path, batch_size=20, flush_interval=5.0,
+                 maxsize=1000, retry_interval=30.0, upload=True):
+        self.get_collection = get_collection
+        self.upload = upload
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self._retry_delay = retry_interval
+        self.flushed = 0
+        self.spooled = 0
+        self.last_flush_ms = 0.0
+        self._queue = queue.Queue(maxsize)
+        self._spool_lock = threading.Lock()
+        self._offline_until = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mongo-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def insert(self, record):
+        """Queues a record; never blocks. Overflow goes straight to the spool."""
+        record.setdefault('_id', uuid.uuid4().hex)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._spool([record])
+
+    @property
+    def replay_path(self):
+        """Spooled records being replayed; the spool itself keeps taking new ones."""
+        return self.spool_path + '.replay'
+
+    def _spool(self, records):
+        if not records:
+            return
+        with self._spool_lock:
+            self._append(self.spool_path, [json.dumps(record) + '\n' for record in records])
+            self.spooled += len(records)
+
+    @staticmethod
+    def _append(path, lines):
+        with open(path, 'a') as f:
+            # A line cut short by a crash must not swallow the next record
+            if f.tell() and not MongoWriter._ends_with_newline(path):
+                f.write('\n')
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _read_spool(self, path):
+        """Returns the records spooled in path. Lines that do not parse, such as
+        one cut short by a power loss, are moved to spool_path + '.bad'."""
+        records, bad = [], []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if isinstance(record, dict):
+                    records.append(record)
+                else:
+                    bad.append(line.rstrip('\n') + '\n')
+        if bad:
+            with open(self.spool_path + '.bad', 'a') as f:
+                f.writelines(bad)
+            print('Moved %d unreadable spooled records to %s.bad' % (len(bad), self.spool_path))
+            # Rewritten without them, so a retried replay does not move them again
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        return records
+
+    def _insert_many(self, records):
+        """Writes records, treating duplicate _ids (already written) as success."""
+        try:
+            collection = self.get_collection()
+        except Unavailable:
+            raise
+        except Exception as e:
+            raise Unavailable('Cannot get the MongoDB collection: %r' % e)
+        try:
+            with metrics.timer('mongo_insert'):
+                collection.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != 11000 for err in errors):
+                raise
+
+    def _take_spool(self):
+        """Moves the spool's records to the replay file, behind any left there
+        by a replay that failed part way."""
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return
+            if not os.path.exists(self.replay_path):
+                os.replace(self.spool_path, self.replay_path)
+                return
+            with open(self.spool_path) as f:
+                lines = f.readlines()
+            self._append(self.replay_path, lines)
+            os.remove(self.spool_path)
+
+    def _replay_spool(self):
+        # Only the file moves happen under the spool lock: insert() spools an
+        # overflowing queue under it and must not wait on the network
+        self._take_spool()
+        if not os.path.exists(self.replay_path):
+            return
+        records = self._read_spool(self.replay_path)
+        # A failure leaves the replay file to be retried whole; records that
+        # did get written are then skipped as duplicate _ids
+        for i in range(0, len(records), self.batch_size):
+            self._insert_many(records[i:i + self.batch_size])
+        os.remove(self.replay_path)
+        with self._spool_lock:
+            self.spooled = max(0, self.spooled - len(records))
+        self.flushed += len(records)
+        print('Replayed %d spooled MongoDB records.' % len(records))
+
+    def _flush(self, batch):
+        if not self.upload or time.monotonic() < self._offline_until:
+            self._spool(batch)
+            return
+        start = time.monotonic()
+        try:
+            self._replay_spool()
+            if batch:
+                self._insert_many(batch)
+        except (PyMongoError, Unavailable) as e:
+            print('MongoDB unavailable, spooling records locally: %s' % e)
+            self._go_offline()
+            self._spool(batch)
+            return
+        self._retry_delay = self.retry_interval
+        self.last_flush_ms = (time.monotonic() - start) * 1000
+        self.flushed += len(batch)
+
+    def _go_offline(self):
+        """Spools everything until the next attempt, waiting twice as long
+        after each failure in a row."""
+        print('Retrying MongoDB in %.0f s.' % self._retry_delay)
+        self._offline_until = time.monotonic() + self._retry_delay
+        self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_INTERVAL)
+
+    def _try_flush(self, batch):
+        # Whatever goes wrong, the writer thread keeps running and the batch is kept
+        try:
+            self._flush(batch)
+        except Exception as e:
+            print('MongoDB writer error, spooling records locally: %r' % e)
+            self._go_offline()
+            try:
+                self._spool(batch)
+            except OSError as e:
+                print('Could not spool %d MongoDB records: %s' % (len(batch), e))
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch or os.path.exists(self.spool_path) or os.path.exists(self.replay_path):
+                    self._try_flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self._try_flush(batch)
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(), 'spooled': self.spooled,
+                'flushed': self.flushed, 'last_flush_ms': self.last_flush_ms}
+
+    def report(self):
+        return ('mongo writer: %(queue_depth)d queued, %(spooled)d spooled, '
+                '%(flushed)d written, last flush %(last_flush_ms).1f ms' % self.stats())
+
+    def close(self, timeout=10):
+        """Flushes whatever is queued (to MongoDB or the spool) and stops."""
+        self._stop.set()
+        self._thread.join(timeout)
+
 
-mongoDB_connect()
+def start_writer(spool_path, **kwargs):
+    """Starts the background writer used by mongo_insert."""
+    global writer
+    writer = MongoWriter(get_collection, spool_path, **kwargs)
+    return writer
 
-db = client["Birds"]
-collection = db["BirdVisitors"]
 
 def mongo_insert(visitor, score, date):
-    new_record = {"Bird:": visitor, "Score": score, "Date": date}
-    collection.insert_one(new_record)
\ No newline at end of file
+    new_record = {"Bird:": visitor, "Score": float(score), "Date": date}
+    if writer is not None:
+        writer.insert(new_record)
+    else:
+        get_collection().insert_one(new_record)
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+Motion gate
+
+Cheap pre-check that decides whether a camera frame is worth classifying.
+A strided (downscaled) view of the region of interest is compared against a
+running-average background; inference only runs when enough of the region has
+changed, for a short hold time after motion stops, and periodically as a
+keep-alive so a bird sitting perfectly still is not missed.
+
+"""
+import threading
+import time
+
+import numpy as np
+
+
+def parse_region(value):
+    """Parses an 'x,y,width,height' region given as fractions of the frame."""
+    x, y, w, h = (float(v) for v in value.split(','))
+    if not (0 <= x < 1 and 0 <= y < 1 and 0 < w <= 1 - x and 0 < h <= 1 - y):
+        raise ValueError('Region must lie inside the frame: %s' % value)
+    return x, y, w, h
+
+
+def region_view(frame, region, step=1):
+    """Returns the region (x, y, width, height fractions) of a frame as a view,
+    sampling every step-th row and column. No pixels are copied."""
+    height, width = frame.shape[:2]
+    x, y, w, h = region
+    return frame[int(y * height):int((y + h) * height):step,
+                 int(x * width):int((x + w) * width):step]
+
+
+class MotionGate:
+    """Frame-difference motion detector over a downscaled region of the frame."""
+
+    def __init__(self, threshold=0.01, region=(0.0, 0.0, 1.0, 1.0), step=4,
+                 pixel_delta=20, alpha=0.05, hold=2.0, keepalive=10.0):
+        self.threshold = threshold      # Fraction of region pixels that must change
+        self.region = region
+        self.step = step                # Sample every step-th row and column
+        self.pixel_delta = pixel_delta  # Per-channel change that counts as motion
+        self.alpha = alpha              # Background update rate
+        self.hold = hold                # Seconds to keep classifying after motion
+        self.keepalive = keepalive      # Max seconds between classifications
+        self.frames = 0
+        self.skipped = 0
+        self._background = None
+        self._last_motion = None
+        self._last_pass = None
+        self._lock = threading.Lock()
+
+    def _sample(self, frame):
+        view = region_view(frame, self.region, self.step)
+        # Sum of channels as a cheap stand-in for luminance (0..765)
+        return view.sum(axis=2, dtype=np.int16)
+
+    def motion_fraction(self, frame):
+        """Updates the background and returns the fraction of changed pixels."""
+        sample = self._sample(frame)
+        if self._background is None or self._background.shape != sample.shape:
+            self._background = sample.astype(np.float32)
+            return 1.0
+        diff = np.abs(sample - self._background)
+        changed = np.count_nonzero(diff > self.pixel_delta * 3) / diff.size
+        self._background += self.alpha * (sample - self._background)
+        return changed
+
+    def check(self, frame, now=None):
+        """Returns True when the frame should be classified."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.frames += 1
+            if self.motion_fraction(frame) >= self.threshold:
+                self._last_motion = now
+            run = ((self._last_motion is not None and now - self._last_motion <= self.hold) or
+                   self._last_pass is None or now - self._last_pass >= self.keepalive)
+            if run:
+                self._last_pass = now
+            else:
+                self.skipped += 1
+            return run
+
+    def report(self):
+        with self._lock:
+            frames, skipped = self.frames, self.skipped
+        return 'motion gate: %d of %d frames skipped (%.0f%%)' % (
+            skipped, frames, 100.0 * skipped / frames if frames else 0.0)
@@ -1,37 +1,202 @@
-from phue import Bridge
-import time
+"""
+Philips Hue controller
+
+Changes the countertop lights to a bird's colour while it visits and back to
+the kitchen scene afterwards. Callers post intents (show_bird / restore) from
+the detection path; a background thread coalesces bursts so only the latest
+intent is applied, skips intents that match the state already on the lights,
+and paces bridge requests with a token bucket (the bridge throttles at about
+10 commands per second). Bird colours, light and scene names live in
+hue_config.json.
+
+Run this file directly to list the lights, scenes and groups on the bridge.
+"""
+import json
+import os
 import threading
-from collections import Counter
-
-b = Bridge('192.168.0.156')
-
-# If the app is not registered and the button is not pressed, press the button and call connect() (this only needs to be run a single time)
-b.connect()
-
-# Get the bridge state (This returns the full dictionary that you can explore)
-bridge_state = b.get_api()
-
-'''
-    lights_state = 'no_bird,_detect'
-    try:
-        if bird == 'Cardinalis cardinalis (Northern Cardinal)':
-            b.set_light(lights, {'hue': 0, 'sat': 255, 'bri': 255})
-            print('Setting lights to Red for Cardinal')
-            lights_state = "bird_detect"
-        elif bird == 'Cyanocitta cristata (Blue Jay)':
-            b.set_light(lights, {'hue': 45000, 'sat': 255, 'bri': 255})
-            print('Setting lights to Blue for Blue Jay')
-            lights_state = "bird_detect"
+import time
+
+from phue import Bridge
+
+import metrics
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hue_config.json')
+
+DEFAULT_CONFIG = {
+    'bridge_ip': '192.168.0.156',
+    'username': None,
+    'light': 'Countertop Lights',
+    'scene': {'group': 'Kitchen', 'name': 'Concentrate', 'transition': 10},
+    # Color values using HSL values (Hue, Saturation, Brightness)
+    'birds': {},
+}
+
+SCENE = 'scene'
+
+
+def load_config(path=DEFAULT_CONFIG_PATH):
+    """Reads the Hue config file over the defaults."""
+    config = dict(DEFAULT_CONFIG)
+    if path and os.path.isfile(path):
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def connect_bridge(config):
+    """Creates and connects the Hue bridge client."""
+    b = Bridge(config['bridge_ip'], username=config.get('username'))
+    # If the app is not registered and the button is not pressed, press the button and call connect() (this only needs to be run a single time)
+    b.connect()
+    return b
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def take(self):
+        """Takes one token, sleeping until one is available."""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+
+class HueController:
+    """Applies the latest light intent off the inference thread.
+
+    get_bridge returns a connected phue Bridge or None while it is not
+    available; is_paused returns True while the dashboard has paused the lights."""
+
+    def __init__(self, config, get_bridge, is_paused=lambda: False,
+                 rate=5.0, burst=5, coalesce=0.25):
+        self.config = config
+        self.get_bridge = get_bridge
+        self.is_paused = is_paused
+        self.coalesce = coalesce
+        self.bucket = TokenBucket(rate, burst)
+        self.commands = 0
+        self.skipped = 0
+        # The lights are assumed to start on the scene, so restore() is a no-op
+        self.applied = SCENE
+        self.bridge = None
+        self._desired = None
+        self._posted = 0.0
+        self._light_id = None
+        self._scene_ids = None
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='hue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def color_for(self, label):
+        return self.config['birds'].get(label)
+
+    def _post(self, state):
+        with self._cond:
+            self._desired = state
+            self._posted = time.monotonic()
+            self._cond.notify()
+
+    def show_bird(self, label):
+        """Asks for the lights to take the bird's colour (ignored for birds without one)."""
+        color = self.color_for(label)
+        if color is not None:
+            self._post(('bird', label))
+
+    def restore(self):
+        """Asks for the lights to go back to the configured scene."""
+        self._post(SCENE)
+
+    def _request(self, method, *args):
+        self.bucket.take()
+        self.commands += 1
+        with metrics.timer('hue_request'):
+            return getattr(self.bridge, method)(*args)
+
+    def _resolve(self):
+        """Looks up light, group and scene IDs once so each change is one request."""
+        if self._light_id is None:
+            light_id = self._request('get_light_id_by_name', self.config['light'])
+            # phue takes a string light id for a name and looks it up again
+            self._light_id = int(light_id) if light_id else None
+        if self._scene_ids is None:
+            scene = self.config['scene']
+            group_id = self._request('get_group_id_by_name', scene['group'])
+            scenes = self._request('get_scene')
+            scene_id = next((sid for sid, info in scenes.items()
+                             if info.get('name') == scene['name'] and
+                             str(info.get('group', group_id)) == str(group_id)), None)
+            self._scene_ids = (group_id, scene_id)
+
+    def _apply(self, state):
+        self._resolve()
+        if state == SCENE:
+            group_id, scene_id = self._scene_ids
+            if scene_id is None:
+                print('Hue scene not found: %s' % self.config['scene']['name'])
+                return
+            self._request('set_group', group_id, {'scene': scene_id},
+                          None, self.config['scene']['transition'])
+            print("Turning Lights back to %s..." % self.config['scene']['name'])
         else:
-            if lights_state != 'no_bird_detect':
-                b.run_scene('Kitchen','Concentrate',4)
-                print('Setting lights back to Concentrate')
-                lights_state = 'no_bird_detect'
-    except Exception as e:
-        print("An error occurred while setting lights:", e)
+            if self._light_id is None:
+                print('Hue light not found: %s' % self.config['light'])
+                return
+            color = self.color_for(state[1])
+            self._request('set_light', self._light_id,
+                          {'hue': color[0], 'sat': color[1], 'bri': color[2]})
+            print("Turning Lights bird colored...")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._desired is not None or self._stop)
+                if self._stop:
+                    return
+                # Let a burst of intents settle, then take only the latest
+                settle = self._posted + self.coalesce - time.monotonic()
+                if settle > 0:
+                    self._cond.wait(settle)
+                    if time.monotonic() < self._posted + self.coalesce:
+                        continue
+                state, self._desired = self._desired, None
+            if state == self.applied or self.is_paused():
+                self.skipped += 1
+                continue
+            self.bridge = self.get_bridge()
+            if self.bridge is None:
+                self.skipped += 1
+                continue
+            try:
+                self._apply(state)
+                self.applied = state
+            except Exception as e:
+                print("An error occurred while setting lights:", e)
+
+    def report(self):
+        return 'hue: %d bridge requests, %d intents skipped' % (self.commands, self.skipped)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
 
 
 if __name__ == "__main__":
+    b = connect_bridge(load_config())
     # Get a dictionary with the light name as the key
     light_names = b.get_light_objects('name')
     print(light_names)
@@ -52,7 +217,3 @@ if __name__ == "__main__":
         print("Group Type:", group_info['type'])
         print("Group Lights:", group_info['lights'])
         print()
-    #Test setting lights function
-    setLights('Cyanocitta cristata (Blue Jay)', 'Countertop Lights')
-    pass
-'''
\ No newline at end of file
@@ -0,0 +1,149 @@
+"""
+Frame pipeline stages
+
+Bounded queues and worker threads used to split the camera path into stages:
+frame capture (the GStreamer appsink), inference, and side effects (saving
+images, MongoDB inserts, Hue calls). Every queue has an explicit policy for
+what happens when it is full, so a slow stage never stalls the one before it.
+
+"""
+import queue
+import threading
+import traceback
+from collections import deque
+
+import metrics
+
+DROP_OLDEST = 'drop_oldest'  # Replace the oldest queued item (freshest frame wins)
+DROP_NEWEST = 'drop_newest'  # Reject the incoming item
+BLOCK = 'block'              # Wait for space (no item is ever dropped)
+
+
+class BoundedQueue:
+    """Thread-safe FIFO with a fixed size and an overflow policy."""
+
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError('Unknown queue policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        """Queue item, returning False if it (or an older item) was dropped."""
+        with self._cond:
+            accepted = True
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    accepted = False
+                else:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+            self._items.append(item)
+            self._cond.notify_all()
+            return accepted
+
+    def get(self, timeout=None):
+        """Return the next item, or raise queue.Empty on timeout or close."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._closed, timeout):
+                raise queue.Empty
+            if not self._items:
+                raise queue.Empty
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def join(self):
+        """Wait until the queue has been drained."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._items or self._closed)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+
+class Stage:
+    """Runs handler(item) on worker threads for every item put on its queue."""
+
+    def __init__(self, name, handler, maxsize=1, policy=DROP_OLDEST, workers=1):
+        self.name = name
+        self.handler = handler
+        self.queue = BoundedQueue(maxsize, policy)
+        self.processed = 0
+        self._threads = []
+        metrics.counter('queue_dropped_total', lambda: self.queue.dropped, queue=name)
+        metrics.gauge('queue_depth', lambda: len(self.queue), queue=name)
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def put(self, item):
+        return self.queue.put(item)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except queue.Empty:
+                if self.queue.closed:
+                    return
+                continue
+            try:
+                self.handler(item)
+            except Exception:
+                print('Error in %s stage:' % self.name)
+                traceback.print_exc()
+            self.processed += 1
+
+    def close(self, wait=True):
+        """Stop accepting work; with wait, let queued items finish first."""
+        if wait:
+            self.queue.join()
+        self.queue.close()
+        for t in self._threads:
+            t.join(timeout=5)
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+
+class WorkerPool(Stage):
+    """Stage whose items are callables, used for fire-and-forget side effects."""
+
+    def __init__(self, name, workers=1, maxsize=32, policy=DROP_NEWEST):
+        super().__init__(name, self._call, maxsize=maxsize, policy=policy,
+                         workers=workers)
+
+    @staticmethod
+    def _call(task):
+        fn, args, kwargs = task
+        fn(*args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); returns False if the pool dropped it."""
+        accepted = self.put((fn, args, kwargs))
+        if not accepted:
+            print('%s queue full, dropped %s' % (self.name, getattr(fn, '__name__', fn)))
+        return accepted
@@ -0,0 +1,137 @@
+"""
+Live preview
+
+Holds the newest JPEG from the camera pipeline's preview branch and streams it
+to dashboard viewers as multipart MJPEG. The pipeline encodes once at a reduced
+size and frame rate; every viewer is sent the same bytes, and a slow viewer
+simply skips to the newest frame. While nobody is watching, the pipeline stops
+feeding the preview encoder (see gstreamer.run_pipeline).
+
+When the dashboard runs in its own process, the classifier's hub also writes
+each frame to PREVIEW_PATH (on tmpfs where available) and a PreviewFileReader
+in the dashboard process republishes it; the reader touches a '.watch' file
+while it has viewers so the classifier knows to keep encoding.
+
+"""
+import os
+import tempfile
+import threading
+import time
+
+BOUNDARY = 'frame'
+MIMETYPE = 'multipart/x-mixed-replace; boundary=' + BOUNDARY
+
+PREVIEW_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                            'birdcam-preview.jpg')
+# Seconds a '.watch' touch keeps the classifier encoding
+WATCH_TIMEOUT = 3.0
+
+
+def watch_path(path):
+    return path + '.watch'
+
+
+class PreviewHub:
+    """Latest encoded preview frame, shared by all viewers."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = False
+        self.frames = 0
+        self.viewers = 0
+        self._jpeg = None
+        self._seq = 0
+        self._time = 0.0
+        self._cond = threading.Condition()
+
+    def publish(self, jpeg):
+        """Called by the pipeline with each encoded frame."""
+        with self._cond:
+            self._jpeg = jpeg
+            self._seq += 1
+            self._time = time.monotonic()
+            self.frames += 1
+            self._cond.notify_all()
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(jpeg)
+            os.replace(tmp, self.path)
+
+    def watched(self):
+        """True while a viewer is connected here or to another process's reader."""
+        if self.viewers:
+            return True
+        if self.path:
+            try:
+                return time.time() - os.stat(watch_path(self.path)).st_mtime < WATCH_TIMEOUT
+            except OSError:
+                pass
+        return False
+
+    def latest(self):
+        """Returns the newest frame or None."""
+        with self._cond:
+            return self._jpeg
+
+    def wait(self, seq, timeout=5.0):
+        """Waits for a frame newer than seq; returns (seq, jpeg), jpeg None on timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq != seq, timeout):
+                return seq, None
+            return self._seq, self._jpeg
+
+    def stream(self):
+        """Yields multipart MJPEG parts until the viewer disconnects."""
+        with self._cond:
+            self.viewers += 1
+        try:
+            seq = 0
+            while True:
+                seq, jpeg = self.wait(seq)
+                if jpeg is None:
+                    continue
+                yield (b'--' + BOUNDARY.encode() + b'\r\n'
+                       b'Content-Type: image/jpeg\r\n'
+                       b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' +
+                       jpeg + b'\r\n')
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+
+class PreviewFileReader:
+    """Republishes the frames another process writes to path while hub has viewers."""
+
+    def __init__(self, hub, path=PREVIEW_PATH, fps=5):
+        self.hub = hub
+        self.path = path
+        self.interval = 1.0 / fps
+        self._mtime = None
+        hub.enabled = True
+        thread = threading.Thread(target=self._run, name='preview-reader')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            if self.hub.viewers:
+                self._poll()
+            time.sleep(self.interval)
+
+    def _poll(self):
+        try:
+            with open(watch_path(self.path), 'a'):
+                os.utime(watch_path(self.path))
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path, 'rb') as f:
+                jpeg = f.read()
+        except OSError:
+            return
+        self._mtime = mtime
+        self.hub.publish(jpeg)
+
+
+hub = PreviewHub()
@@ -0,0 +1,306 @@
+"""
+Storage retention
+
+Keeps the storage folder within a byte and file (inode) budget, since
+birdcam.sh stores everything under /tmp, which is RAM backed or a small SD
+card on a Pi, and bird_classify never deletes a saved frame by itself.
+
+A background thread at idle I/O priority and raised niceness rescans the
+folder incrementally (only when it changed) and on each pass:
+
+- protects the best frame (highest score) of each species per day and frames
+  saved in the last few minutes, which stay at full quality;
+- downsamples other frames older than downsample_age in place, oldest day
+  and lowest score first, a batch per pass;
+- when the budget is exceeded, deletes unprotected frames (and thumbnails) in
+  the same order until usage is back under low_water of the budget.
+
+Frames are aged by the capture time in their filename, so downsampling can
+rewrite a file (and its mtime) without making it look new.
+
+Accounting (usage, budget, evictions) is written to retention.json in the
+storage folder's state/ subfolder for the dashboard's /api/stats.
+
+"""
+import ctypes
+import json
+import os
+import platform
+import threading
+import time
+
+from PIL import Image
+
+import metrics
+from encoder import FORMATS, THUMBNAIL_DIR, thumbnail_path
+from image_catalog import get_catalog, parse_image_filename, state_path
+
+STATS_NAME = 'retention.json'
+# ioprio_set syscall numbers; the I/O priority is left alone elsewhere
+IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'armv6l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+PIL_FORMATS = {ext: pil_format for pil_format, ext in FORMATS.values()}
+PIL_FORMATS['jpeg'] = 'JPEG'
+# Filename timestamps at or above this are wall-clock milliseconds; older
+# frames were named by the monotonic clock and fall back to their mtime
+EPOCH_MS_MIN = 10 ** 12
+
+
+def lower_thread_priority(niceness):
+    """Raises the calling thread's niceness and moves it to the idle I/O class.
+    On Linux both apply to a single thread when given its thread id."""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + niceness))
+    except (AttributeError, OSError):
+        pass
+    syscall = IOPRIO_SET.get(platform.machine())
+    if syscall:
+        try:
+            ctypes.CDLL(None, use_errno=True).syscall(
+                syscall, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        except (AttributeError, OSError):
+            pass
+
+
+def capture_time(entry, mtime):
+    """When a frame was saved (epoch seconds), from its filename if it has a
+    wall-clock timestamp, else from the file's mtime when first seen."""
+    if entry.ts >= EPOCH_MS_MIN:
+        return entry.ts / 1000.0
+    return mtime
+
+
+def default_budget(folder, fraction=0.5):
+    """(bytes, files): fraction of the space and inodes free in folder's filesystem."""
+    st = os.statvfs(folder)
+    return int(st.f_bavail * st.f_frsize * fraction), int(st.f_favail * fraction)
+
+
+def read_stats(folder):
+    """Returns the accounting saved in folder by RetentionManager, or None."""
+    try:
+        with open(state_path(folder, STATS_NAME, create=False)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class RetentionManager:
+    """Enforces the storage budget of one folder from a background thread."""
+
+    def __init__(self, folder, max_bytes, max_files, interval=30.0, keep_age=600,
+                 downsample_age=86400, downsample_size=640, downsample_quality=60,
+                 low_water=0.9, batch=20, niceness=10):
+        self.folder = folder
+        self.thumbs = os.path.join(folder, THUMBNAIL_DIR)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.interval = interval
+        self.keep_age = keep_age
+        self.downsample_age = downsample_age
+        self.downsample_size = downsample_size
+        self.downsample_quality = downsample_quality
+        self.low_water = low_water
+        self.batch = batch
+        self.niceness = niceness
+        self.images = {}   # filename -> [bytes, capture time, entry]
+        self.thumb_sizes = {}  # thumbnail filename -> bytes
+        self.small = set()  # frames at or below downsample_size
+        self._mtimes = {}
+        self._written = None
+        self.protected = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.downsampled = 0
+        self.downsampled_bytes = 0
+        self.last_pass = None
+        metrics.gauge('storage_bytes', lambda: self.used()[0])
+        metrics.gauge('storage_files', lambda: self.used()[1])
+        metrics.counter('storage_evicted_total', lambda: self.evicted)
+        metrics.counter('storage_downsampled_total', lambda: self.downsampled)
+        thread = threading.Thread(target=self._run, name='retention')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        lower_thread_priority(self.niceness)
+        while True:
+            try:
+                self.run_pass()
+            except OSError as e:
+                print('Retention pass failed: %s' % e)
+            time.sleep(self.interval)
+
+    def _scan(self, folder, known, match, value):
+        """Stats the files matching match() that are new to folder since the
+        last scan, storing value(name, stat) in known; forgets removed ones."""
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            known.clear()
+            return
+        if self._mtimes.get(folder) == mtime:
+            return
+        names = set()
+        with os.scandir(folder) as it:
+            for item in it:
+                if not match(item.name):
+                    continue
+                names.add(item.name)
+                if item.name not in known:
+                    try:
+                        known[item.name] = value(item.name, item.stat())
+                    except OSError:
+                        names.discard(item.name)
+        for name in [n for n in known if n not in names]:
+            del known[name]
+        self._mtimes[folder] = mtime
+
+    @staticmethod
+    def _capture(name, st):
+        entry = parse_image_filename(name)
+        return capture_time(entry, st.st_mtime), entry
+
+    def scan(self):
+        self._scan(self.folder, self.images,
+                   lambda name: parse_image_filename(name) is not None,
+                   lambda name, st: [st.st_size, *self._capture(name, st)])
+        self._scan(self.thumbs, self.thumb_sizes, lambda name: not name.endswith('.tmp'),
+                   lambda name, st: st.st_size)
+        self.small.intersection_update(self.images)
+
+    def used(self):
+        """(bytes, files) taken by the saved frames and their thumbnails."""
+        images, thumbs = dict(self.images), dict(self.thumb_sizes)
+        return (sum(v[0] for v in images.values()) + sum(thumbs.values()),
+                len(images) + len(thumbs))
+
+    def _thumb_name(self, filename):
+        return os.path.basename(thumbnail_path(self.folder, filename))
+
+    def _candidates(self, now):
+        """Unprotected frames, oldest day and lowest score first."""
+        best = {}
+        for filename, (_, captured, entry) in self.images.items():
+            key = (entry.key, time.strftime('%Y-%m-%d', time.localtime(captured)))
+            if key not in best or (entry.score, captured) > best[key][0]:
+                best[key] = ((entry.score, captured), filename)
+        keep = {filename for _, filename in best.values()}
+        self.protected = len(keep)
+        candidates = []
+        for filename, (_, captured, entry) in self.images.items():
+            if filename not in keep and now - captured >= self.keep_age:
+                candidates.append((time.strftime('%Y-%m-%d', time.localtime(captured)),
+                                   entry.score, captured, filename))
+        candidates.sort()
+        return candidates
+
+    def downsample(self, filename):
+        """Shrinks a frame in place to downsample_size; returns the bytes saved.
+        Its age still comes from the capture time recorded at the first scan."""
+        path = os.path.join(self.folder, filename)
+        ext = os.path.splitext(filename)[1][1:].lower()
+        st = os.stat(path)
+        with Image.open(path) as img:
+            if max(img.size) <= self.downsample_size:
+                self.small.add(filename)
+                return 0
+            img.thumbnail((self.downsample_size, self.downsample_size), Image.BILINEAR)
+            with open(path + '.tmp', 'wb') as f:
+                img.save(f, PIL_FORMATS.get(ext, 'JPEG'), quality=self.downsample_quality)
+        os.replace(path + '.tmp', path)
+        size = os.path.getsize(path)
+        self.images[filename][0] = size
+        self.small.add(filename)
+        self.downsampled += 1
+        self.downsampled_bytes += st.st_size - size
+        return st.st_size - size
+
+    def evict(self, filename):
+        """Deletes a frame and its thumbnail; returns (bytes, files) freed."""
+        freed, files = 0, 0
+        for folder, name, sizes in ((self.folder, filename, None),
+                                    (self.thumbs, self._thumb_name(filename), self.thumb_sizes)):
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+            if sizes is None:
+                freed += self.images.pop(filename)[0]
+                files += 1
+            elif name in sizes:
+                freed += sizes.pop(name)
+                files += 1
+        get_catalog(self.folder).discard(filename)
+        self.evicted += 1
+        self.evicted_bytes += freed
+        return freed, files
+
+    def run_pass(self):
+        now = time.time()
+        self.scan()
+        candidates = self._candidates(now)
+        used_bytes, used_files = self.used()
+
+        if self.downsample_age:
+            done = 0
+            for _, _, captured, filename in candidates:
+                if done >= self.batch:
+                    break
+                if filename in self.small or now - captured < self.downsample_age:
+                    continue
+                try:
+                    used_bytes -= self.downsample(filename)
+                except (OSError, ValueError) as e:
+                    print('Could not downsample %s: %s' % (filename, e))
+                    self.small.add(filename)
+                done += 1
+
+        if used_bytes > self.max_bytes or used_files > self.max_files:
+            target_bytes = self.max_bytes * self.low_water
+            target_files = self.max_files * self.low_water
+            for _, _, _, filename in candidates:
+                if used_bytes <= target_bytes and used_files <= target_files:
+                    break
+                if filename not in self.images:
+                    continue
+                freed, files = self.evict(filename)
+                used_bytes -= freed
+                used_files -= files
+            if used_bytes > self.max_bytes or used_files > self.max_files:
+                print('Storage over budget with only protected frames left: %d bytes, %d files'
+                      % (used_bytes, used_files))
+
+        self.last_pass = now
+        self.write_stats()
+
+    def stats(self):
+        used_bytes, used_files = self.used()
+        return {
+            'used_bytes': used_bytes,
+            'used_files': used_files,
+            'max_bytes': self.max_bytes,
+            'max_files': self.max_files,
+            'images': len(self.images),
+            'protected': self.protected,
+            'downsampled': self.downsampled,
+            'downsampled_bytes': self.downsampled_bytes,
+            'evicted': self.evicted,
+            'evicted_bytes': self.evicted_bytes,
+            'last_pass': self.last_pass,
+        }
+
+    def write_stats(self):
+        stats = self.stats()
+        # Only rewritten when the accounting changed, to spare the SD card
+        unchanged = dict(stats, last_pass=None)
+        if unchanged == self._written:
+            return
+        path = state_path(self.folder, STATS_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.replace(path + '.tmp', path)
+        self._written = unchanged
@@ -0,0 +1,51 @@
+"""
+Dashboard server
+
+Runs the Flask dashboard in its own process, so web requests never compete
+with the inference loop for the GIL. State is shared with bird_classify through
+the storage folder: detection counts come from the results log (via the
+detection store), images from the folder itself, and the Hue pause flag is a
+file. Live events arrive over localhost UDP; the preview and metrics through files.
+
+bird_classify starts this automatically (--web process); to run it by hand:
+
+    python3 serve.py --storage /tmp/birdcam-2024-05-01-xxxx
+"""
+import argparse
+
+import events
+import flask_server
+import metrics
+import preview
+from flask_server import app, broadcast, configure_app, configure_logging, run_flask
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', required=True,
+                        help='bird_classify storage folder (images and results.log)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max_streams', type=int, default=flask_server.MAX_STREAMS,
+                        help='Live event feeds and previews served at once (each holds a '
+                             'thread); more get 503 and the dashboard falls back to polling')
+    parser.add_argument('--threads', type=int, default=flask_server.REQUEST_THREADS,
+                        help='Threads for other requests, on top of one per live stream')
+    parser.add_argument('--preview_file', default=None,
+                        help='Frame file written by bird_classify --preview')
+    parser.add_argument('--preview_fps', type=int, default=5)
+    parser.add_argument('--metrics_file', default=metrics.SNAPSHOT_PATH,
+                        help='Metrics snapshot written by bird_classify')
+    args = parser.parse_args()
+
+    configure_app(args.storage)
+    configure_logging()
+    app.config['METRICS_SNAPSHOT_PATH'] = args.metrics_file
+    events.EventReceiver(broadcast)
+    if args.preview_file:
+        preview.PreviewFileReader(preview.hub, args.preview_file, args.preview_fps)
+    run_flask(args.host, args.port, args.max_streams, args.threads)
+
+
+if __name__ == '__main__':
+    main()
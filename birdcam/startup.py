@@ -0,0 +1,76 @@
+"""
+Startup helpers
+
+Background connections for external services (MongoDB, the Hue bridge) so
+that a slow or missing service never delays the camera, and a timer that
+breaks down how long startup took up to the first classified frame.
+Imported by bird_classify before its heavy imports so import time is counted.
+
+"""
+import threading
+import time
+
+import detection_log
+
+IMPORT_START = time.monotonic()
+
+
+class BackgroundClient:
+    """Creates a client with factory() on a background thread.
+    get() never blocks: it returns None until the client is ready."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.error = None
+        self._client = None
+        self._ready = threading.Event()
+        thread = threading.Thread(target=self._connect, args=(factory,),
+                                  name='connect-%s' % name)
+        thread.daemon = True
+        thread.start()
+
+    def _connect(self, factory):
+        start = time.monotonic()
+        try:
+            self._client = factory()
+            print('Connected to %s in %.0f ms' % (self.name, (time.monotonic() - start) * 1000))
+        except Exception as e:
+            self.error = e
+            print('Could not connect to %s: %s' % (self.name, e))
+        self._ready.set()
+
+    def get(self):
+        return self._client
+
+    def wait(self, timeout=None):
+        """Waits for the connection attempt; returns the client or None."""
+        self._ready.wait(timeout)
+        return self._client
+
+
+class StartupTimer:
+    """Records the duration of each startup phase since the previous one."""
+
+    def __init__(self, start=IMPORT_START):
+        self.start = start
+        self._last = start
+        self.phases = []
+        self.done = False
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, (now - self._last) * 1000))
+        self._last = now
+
+    @property
+    def total_ms(self):
+        return (self._last - self.start) * 1000
+
+    def report(self):
+        """Prints and logs the breakdown; startup counts as done afterwards."""
+        self.done = True
+        breakdown = ', '.join('%s %.0f ms' % phase for phase in self.phases)
+        message = 'Startup: %s (total %.0f ms)' % (breakdown, self.total_ms)
+        print(message)
+        detection_log.logger.info(message)
+        return message
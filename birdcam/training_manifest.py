@@ -0,0 +1,139 @@
+"""
+Training manifest
+
+SQLite index of the labeled images under training_data/ (one row per image
+copied into <label>/PositiveID or <label>/NegativeID, with its annotation), so
+the training views look labels and counts up instead of walking every species
+folder. api_training_save records each label in the same step that writes the
+files; if the manifest is missing it is rebuilt from the folders and their
+annotation JSON files.
+
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from image_catalog import IMAGE_EXTENSIONS
+
+ID_TYPES = ('PositiveID', 'NegativeID')
+MANIFEST_NAME = 'manifest.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labeled (
+    label TEXT NOT NULL,
+    id_type TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    bbox TEXT,
+    PRIMARY KEY (label, id_type, filename)
+);
+CREATE INDEX IF NOT EXISTS labeled_filename ON labeled (filename);
+"""
+
+
+def read_annotation(image_path):
+    """Returns the annotation saved next to an image, or None."""
+    try:
+        with open(os.path.splitext(image_path)[0] + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TrainingManifest:
+    """Labeled images and per-label counts for one training_data folder."""
+
+    def __init__(self, root, db_path=None):
+        self.root = root
+        self.db_path = db_path or os.path.join(root, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        # Rebuild whenever the manifest file is missing, including after it is deleted
+        if self._conn is not None and os.path.exists(self.db_path):
+            return self._conn
+        if self._conn is not None:
+            self._conn.close()
+        missing = not os.path.exists(self.db_path)
+        os.makedirs(self.root, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        if missing:
+            self._rebuild()
+        return self._conn
+
+    def _rebuild(self):
+        """Indexes every labeled image on disk."""
+        rows = []
+        for label in os.listdir(self.root):
+            for id_type in ID_TYPES:
+                folder = os.path.join(self.root, label, id_type)
+                if not os.path.isdir(folder):
+                    continue
+                for filename in os.listdir(folder):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        annotation = read_annotation(os.path.join(folder, filename)) or {}
+                        rows.append((label, id_type, filename,
+                                     json.dumps(annotation.get('bbox'))))
+        with self._conn:
+            self._conn.execute('DELETE FROM labeled')
+            self._conn.executemany('INSERT OR REPLACE INTO labeled VALUES (?, ?, ?, ?)', rows)
+        print('Rebuilt training manifest: %d labeled images' % len(rows))
+
+    def rebuild(self):
+        with self._lock:
+            self._connect()
+            self._rebuild()
+
+    def save(self, label, id_type, filename, bbox, write_files):
+        """Records a labeled image and calls write_files() in one transaction:
+        the row is only committed once the files are written, and is rolled
+        back if writing them fails."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO labeled VALUES (?, ?, ?, ?)',
+                             (label, id_type, filename, json.dumps(bbox)))
+                write_files()
+
+    def is_labeled(self, filename):
+        with self._lock:
+            return self._connect().execute(
+                'SELECT 1 FROM labeled WHERE filename = ? LIMIT 1', (filename,)).fetchone() is not None
+
+    def labeled_filenames(self, filenames=None):
+        """Returns the labeled filenames, or only those among filenames."""
+        with self._lock:
+            conn = self._connect()
+            if filenames is None:
+                return {row[0] for row in conn.execute('SELECT DISTINCT filename FROM labeled')}
+            filenames = list(filenames)
+            labeled = set()
+            for i in range(0, len(filenames), 500):
+                chunk = filenames[i:i + 500]
+                labeled.update(row[0] for row in conn.execute(
+                    'SELECT DISTINCT filename FROM labeled WHERE filename IN (%s)' %
+                    ','.join('?' * len(chunk)), chunk))
+            return labeled
+
+    def counts(self):
+        """Returns {label: {'positive': N, 'negative': N}} sorted by label."""
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT label, id_type, COUNT(*) FROM labeled GROUP BY label, id_type '
+                'ORDER BY label').fetchall()
+        counts = {}
+        for label, id_type, n in rows:
+            key = 'positive' if id_type == 'PositiveID' else 'negative'
+            counts.setdefault(label, {'positive': 0, 'negative': 0})[key] = n
+        return counts
+
+    def entries(self):
+        """Returns every (label, id_type, filename, bbox) row."""
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT label, id_type, filename, bbox FROM labeled ORDER BY label, filename'
+            ).fetchall()
+        return [(label, id_type, filename, json.loads(bbox) if bbox else None)
+                for label, id_type, filename, bbox in rows]
@@ -0,0 +1,139 @@
+"""
+Visit tracker
+
+Turns the per-frame classification stream into bird visits. Scores are
+smoothed with an exponential moving average per label and a visit only starts
+once a label has won enough of the recent frames (a sliding-window vote), so a
+single stray frame does not count as a visit. A visit ends once its bird has
+not been seen for the linger time. Everything runs on the timestamps passed
+in (time.monotonic() in the live pipeline); there are no timer threads.
+
+"""
+from collections import deque, namedtuple
+
+VISIT_START = 'start'
+VISIT_UPDATE = 'update'
+VISIT_END = 'end'
+
+# kind: VISIT_START/UPDATE/END; best: whatever capture() returned at the peak;
+# peak_score: the score of best; top_score: the highest score seen, kept or not
+VisitEvent = namedtuple('VisitEvent', ['kind', 'label', 'start', 'time', 'score',
+                                       'peak_score', 'duration', 'frames', 'best',
+                                       'top_score'])
+
+# Slack on top of a motion gate's keepalive for frame spacing and jitter
+KEEPALIVE_MARGIN = 1.0
+
+
+def gated_linger(linger, keepalive, margin=KEEPALIVE_MARGIN):
+    """Linger time for frames thinned by a motion gate. A bird sitting still
+    is only classified once per keepalive, so its visit has to outlast that
+    gap or it would end and restart on every keepalive frame."""
+    return max(linger, keepalive + margin)
+
+class Visit:
+    """State of one bird's visit."""
+
+    def __init__(self, label, start):
+        self.label = label
+        self.start = start
+        self.last_seen = start
+        self.peak_score = 0.0
+        self.top_score = 0.0
+        self.frames = 0
+        self.best = None
+        self.best_quality = None
+
+    def event(self, kind, now, score):
+        return VisitEvent(kind, self.label, self.start, now, score, self.peak_score,
+                          self.last_seen - self.start, self.frames, self.best,
+                          self.top_score)
+
+
+class VisitTracker:
+    """Smooths (timestamp, top-k scores) samples into visit start/update/end events."""
+
+    def __init__(self, linger=2.0, window=3, votes=2, alpha=0.5, release=None):
+        self.linger = linger    # Seconds without a sighting before a visit ends
+        self.window = window    # Frames in the voting window
+        self.votes = votes      # Wins within the window needed to start a visit
+        self.alpha = alpha      # EMA weight of the newest score
+        self.release = release  # Called with a best-frame payload that was replaced
+        self.smoothed = {}
+        self.visits = {}
+        self._winners = deque(maxlen=window)
+
+    def _smooth(self, scores):
+        for label in set(self.smoothed).union(scores):
+            value = (1 - self.alpha) * self.smoothed.get(label, 0.0) + \
+                self.alpha * scores.get(label, 0.0)
+            if value < 1e-3:
+                self.smoothed.pop(label, None)
+            else:
+                self.smoothed[label] = value
+
+    def _keep_best(self, visit, score, capture, quality):
+        """Makes this frame the visit's best if it scores higher, or ties the
+        peak score with a higher quality (e.g. is sharper)."""
+        if score < visit.peak_score:
+            return False
+        q = quality() if quality is not None else None
+        if score == visit.peak_score and (q is None or visit.best_quality is None or
+                                          q <= visit.best_quality):
+            return False
+        if capture is not None:
+            payload = capture()
+            if payload is None:
+                # Nothing was kept (e.g. no free frame slot): the peak stays
+                # with the frame held, and a later frame can try again
+                return False
+            if visit.best is not None and self.release is not None:
+                self.release(visit.best)
+            visit.best = payload
+        visit.peak_score = score
+        visit.best_quality = q
+        return True
+
+    def update(self, now, results, capture=None, quality=None):
+        """Feeds one frame's [(label, score), ...] (already thresholded; empty
+        when nothing was detected). capture() is called for the frame payload
+        whenever a visit reaches a new peak score; with quality(), ties on the
+        peak score go to the higher-quality frame. Returns a list of events."""
+        events = self.expire(now)
+        scores = dict(results)
+        self._smooth(scores)
+        winner = max(scores, key=lambda label: self.smoothed[label]) if scores else None
+        self._winners.append(winner)
+
+        for label, score in scores.items():
+            visit = self.visits.get(label)
+            if visit is None:
+                if label != winner or self._winners.count(label) < self.votes:
+                    continue
+                visit = self.visits[label] = Visit(label, now)
+                kind = VISIT_START
+            else:
+                kind = VISIT_UPDATE
+            visit.last_seen = now
+            visit.frames += 1
+            visit.top_score = max(visit.top_score, score)
+            if not self._keep_best(visit, score, capture, quality) and kind == VISIT_UPDATE:
+                continue
+            events.append(visit.event(kind, now, score))
+        return events
+
+    def expire(self, now):
+        """Ends visits whose bird has not been seen for the linger time."""
+        events = []
+        for label, visit in list(self.visits.items()):
+            if now - visit.last_seen > self.linger:
+                del self.visits[label]
+                events.append(visit.event(VISIT_END, now, self.smoothed.get(label, 0.0)))
+        return events
+
+    def flush(self, now):
+        """Ends every open visit, e.g. at shutdown."""
+        events = [visit.event(VISIT_END, now, self.smoothed.get(label, 0.0))
+                  for label, visit in self.visits.items()]
+        self.visits.clear()
+        return events
@@ -0,0 +1,163 @@
+import gzip
+import json
+import logging
+import os
+import time
+
+import pytest
+
+import detection_log
+from detection_store import DetectionStore
+
+DAY1 = time.mktime((2024, 5, 1, 12, 0, 0, 0, 0, -1))
+DAY2 = DAY1 + 86400
+
+
+def detection(bird, created, score=0.9):
+    record = logging.LogRecord('detections', logging.INFO, __file__, 0,
+                               'Image: none Results: %s Score: %.2f', (bird, score), None)
+    record.created = created
+    record.msecs = 0
+    return record
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / 'results.log')
+
+
+def make_handler(log_path, **kwargs):
+    kwargs.setdefault('compress', False)
+    handler = detection_log.SegmentedLogHandler(log_path, **kwargs)
+    handler.setFormatter(logging.Formatter('%(asctime)s-%(message)s'))
+    return handler
+
+
+def summaries(log_path):
+    return detection_log.read_summaries(detection_log.segment_folder(log_path))
+
+
+def test_parse_detection_line():
+    line = '2024-05-01 12:34:56,789-Image: x Results: Northern Cardinal Score: 0.87'
+    assert detection_log.parse_detection_line(line) == ('2024-05-01 12:34:56', 'Northern Cardinal')
+    assert detection_log.parse_detection_line('2024-05-01 12:34:56,789-Startup: ...') is None
+
+
+def test_new_day_rolls_over_with_a_summary(log_path):
+    handler = make_handler(log_path)
+    handler.emit(detection('Robin', DAY1))
+    handler.emit(detection('Robin', DAY1 + 60))
+    handler.emit(detection('Jay', DAY1 + 120))
+    handler.emit(detection('Jay', DAY2))
+    handler.close()
+    summary, = summaries(log_path)
+    assert summary['segment'] == '2024-05-01.000.log'
+    assert summary['days']['2024-05-01'] == {'Robin': [2, '2024-05-01 12:01:00'],
+                                             'Jay': [1, '2024-05-01 12:02:00']}
+    assert os.path.exists(os.path.join(detection_log.segment_folder(log_path),
+                                       '2024-05-01.000.log'))
+    with open(log_path) as f:
+        assert f.read().count('Results:') == 1
+
+
+def test_size_cap_rolls_over(log_path):
+    handler = make_handler(log_path, max_bytes=200)
+    for n in range(6):
+        handler.emit(detection('Robin', DAY1 + n))
+    handler.close()
+    closed = summaries(log_path)
+    assert closed
+    assert os.path.getsize(log_path) <= 200
+    with open(log_path) as f:
+        open_lines = len(f.readlines())
+    assert sum(s['days']['2024-05-01']['Robin'][0] for s in closed) + open_lines == 6
+
+
+def test_reopened_segment_keeps_its_summary(log_path):
+    handler = make_handler(log_path)
+    handler.emit(detection('Robin', DAY1))
+    handler.close()
+    handler = make_handler(log_path)
+    handler.emit(detection('Robin', DAY1 + 1))
+    handler.emit(detection('Robin', DAY2))
+    handler.close()
+    summary, = summaries(log_path)
+    assert summary['days']['2024-05-01']['Robin'][0] == 2
+
+
+def test_summary_is_written_before_the_segment_moves(log_path, monkeypatch):
+    handler = make_handler(log_path)
+    handler.emit(detection('Robin', DAY1))
+    folder = detection_log.segment_folder(log_path)
+    replace = os.replace
+    seen = []
+
+    def checked_replace(src, dst):
+        if src == log_path:
+            seen.append(os.path.exists(os.path.join(folder, '2024-05-01.000.json')))
+        replace(src, dst)
+    monkeypatch.setattr(detection_log.os, 'replace', checked_replace)
+    handler.emit(detection('Robin', DAY2))
+    handler.close()
+    assert seen == [True]
+
+
+def test_compress_segment(tmp_path):
+    path = str(tmp_path / 'segment.log')
+    with open(path, 'w') as f:
+        f.write('line\n')
+    detection_log.compress_segment(path)
+    assert not os.path.exists(path)
+    with gzip.open(path + '.gz', 'rt') as f:
+        assert f.read() == 'line\n'
+
+
+def test_store_counts_closed_and_open_segments(log_path, tmp_path):
+    handler = make_handler(log_path)
+    store = DetectionStore(log_path, str(tmp_path / 'detections.db'))
+    handler.emit(detection('Robin', DAY1))
+    handler.emit(detection('Jay', DAY1 + 1))
+    assert store.bird_counts() == {'Robin': 1, 'Jay': 1}
+    handler.emit(detection('Robin', DAY2))
+    handler.emit(detection('Robin', DAY2 + 1))
+    handler.close()
+    assert store.bird_counts() == {'Robin': 3, 'Jay': 1}
+    assert store.day_counts('2024-05-01') == ({'Robin': 1, 'Jay': 1}, '2024-05-01 12:00:01')
+    assert store.day_counts('2024-05-02') == ({'Robin': 2}, '2024-05-02 12:00:01')
+    assert store.range_counts('2024-05-01', '2024-05-02')[0] == {'Robin': 3, 'Jay': 1}
+    store.close()
+
+
+def test_store_leaves_a_partial_line_for_later(log_path, tmp_path):
+    line = '2024-05-01 12:00:00,000-Image: none Results: Robin Score: 0.90\n'
+    with open(log_path, 'w') as f:
+        f.write(line + line[:30])
+    store = DetectionStore(log_path, str(tmp_path / 'detections.db'))
+    assert store.bird_counts() == {'Robin': 1}
+    with open(log_path, 'a') as f:
+        f.write(line[30:])
+    assert store.bird_counts() == {'Robin': 2}
+    store.close()
+
+
+def test_store_reindexes_a_replaced_log(log_path, tmp_path):
+    line = '2024-05-01 12:00:00,000-Image: none Results: %s Score: 0.90\n'
+    with open(log_path, 'w') as f:
+        f.write(line % 'Robin' + line % 'Robin')
+    store = DetectionStore(log_path, str(tmp_path / 'detections.db'))
+    assert store.bird_counts() == {'Robin': 2}
+    with open(log_path + '.new', 'w') as f:
+        f.write(line % 'Jay')
+    os.replace(log_path + '.new', log_path)
+    assert store.bird_counts() == {'Jay': 1}
+    store.close()
+
+
+def test_summary_files_are_plain_json(log_path):
+    handler = make_handler(log_path)
+    handler.emit(detection('Robin', DAY1))
+    handler.emit(detection('Robin', DAY2))
+    handler.close()
+    folder = detection_log.segment_folder(log_path)
+    with open(os.path.join(folder, '2024-05-01.000.json')) as f:
+        assert json.load(f)['lines'] == 1
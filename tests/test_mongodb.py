@@ -0,0 +1,121 @@
+import json
+import time
+
+import mongomock
+import pytest
+
+import mongodb
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()['Birds']['BirdVisitors']
+
+
+def start(tmp_path, get_collection, **kwargs):
+    kwargs.setdefault('flush_interval', 0.05)
+    return mongodb.MongoWriter(get_collection, str(tmp_path / 'spool.jsonl'), **kwargs)
+
+
+def unavailable():
+    raise mongodb.Unavailable('offline')
+
+
+def write_spool(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+
+
+def test_records_are_written_in_batches(tmp_path, collection):
+    writer = start(tmp_path, lambda: collection, batch_size=2)
+    for n in range(5):
+        writer.insert({'Bird:': 'robin', 'n': n})
+    writer.close()
+    assert sorted(doc['n'] for doc in collection.find()) == list(range(5))
+    assert writer.flushed == 5
+
+
+def test_offline_records_are_spooled(tmp_path):
+    writer = start(tmp_path, unavailable)
+    writer.insert({'Bird:': 'robin'})
+    writer.close()
+    lines = (tmp_path / 'spool.jsonl').read_text().splitlines()
+    assert [json.loads(line)['Bird:'] for line in lines] == ['robin']
+    assert writer.spooled == 1
+
+
+def test_spool_is_replayed_without_duplicates(tmp_path, collection):
+    collection.insert_one({'_id': 'a', 'Bird:': 'robin'})
+    write_spool(tmp_path / 'spool.jsonl', [json.dumps({'_id': 'a', 'Bird:': 'robin'}),
+                                           json.dumps({'_id': 'b', 'Bird:': 'jay'})])
+    writer = start(tmp_path, lambda: collection)
+    writer.close()
+    assert sorted(doc['_id'] for doc in collection.find()) == ['a', 'b']
+    assert not (tmp_path / 'spool.jsonl').exists()
+    assert not (tmp_path / 'spool.jsonl.replay').exists()
+
+
+def test_torn_spool_line_is_quarantined(tmp_path, collection):
+    write_spool(tmp_path / 'spool.jsonl', [json.dumps({'_id': 'a'}), '{"_id": "b", "Bi',
+                                           json.dumps({'_id': 'c'})])
+    writer = start(tmp_path, lambda: collection)
+    writer.close()
+    assert sorted(doc['_id'] for doc in collection.find()) == ['a', 'c']
+    assert (tmp_path / 'spool.jsonl.bad').read_text() == '{"_id": "b", "Bi\n'
+
+
+def test_spooling_after_a_torn_line_starts_a_new_line(tmp_path):
+    (tmp_path / 'spool.jsonl').write_text('{"_id": "a", "Bi')
+    writer = start(tmp_path, unavailable)
+    writer.insert({'_id': 'b'})
+    writer.close()
+    lines = (tmp_path / 'spool.jsonl').read_text().splitlines()
+    assert json.loads(lines[-1]) == {'_id': 'b'}
+
+
+def test_replay_does_not_hold_the_spool_lock_on_the_network(tmp_path, collection):
+    write_spool(tmp_path / 'spool.jsonl', [json.dumps({'_id': 'a'})])
+    held = []
+
+    class Probe:
+        def insert_many(self, records, ordered=True):
+            free = writer._spool_lock.acquire(blocking=False)
+            if free:
+                writer._spool_lock.release()
+            held.append(not free)
+            return collection.insert_many(records, ordered=ordered)
+
+    writer = start(tmp_path, Probe)
+    writer.close()
+    assert held and not any(held)
+
+
+def test_failed_replay_is_retried(tmp_path, collection):
+    write_spool(tmp_path / 'spool.jsonl', [json.dumps({'_id': 'a'})])
+    writer = start(tmp_path, unavailable)
+    writer.insert({'_id': 'b'})
+    writer.close()
+    writer = start(tmp_path, lambda: collection)
+    writer.close()
+    assert sorted(doc['_id'] for doc in collection.find()) == ['a', 'b']
+
+
+def test_writer_survives_unexpected_errors(tmp_path):
+    def broken():
+        raise RuntimeError('boom')
+    writer = start(tmp_path, broken)
+    writer.insert({'_id': 'a'})
+    deadline = time.monotonic() + 5
+    while writer.spooled < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.spooled == 1
+    assert writer._thread.is_alive()
+    writer.close()
+
+
+def test_spool_only_writer_never_connects(tmp_path):
+    calls = []
+    writer = start(tmp_path, lambda: calls.append(1), upload=False)
+    writer.insert({'_id': 'a'})
+    writer.close()
+    assert calls == []
+    assert writer.spooled == 1
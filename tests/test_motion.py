@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import motion
+
+
+def frame(value=90, shape=(48, 64, 3)):
+    return np.full(shape, value, dtype=np.uint8)
+
+
+def test_parse_region():
+    assert motion.parse_region('0.1,0.2,0.5,0.5') == (0.1, 0.2, 0.5, 0.5)
+    with pytest.raises(ValueError):
+        motion.parse_region('0.6,0,0.5,1')
+
+
+def test_region_view_is_a_view():
+    f = frame()
+    view = motion.region_view(f, (0.5, 0.5, 0.5, 0.5), step=2)
+    assert view.shape == (12, 16, 3)
+    assert np.shares_memory(view, f)
+
+
+def test_still_scene_is_skipped_until_keepalive():
+    gate = motion.MotionGate(threshold=0.01, hold=1.0, keepalive=5.0)
+    passed = [t for t in np.arange(0, 12, 0.5) if gate.check(frame(), t)]
+    # The first frame (no background yet) and its hold, then one per keepalive
+    assert passed == [0.0, 0.5, 1.0, 6.0, 11.0]
+
+
+def test_motion_passes_for_the_hold_time():
+    gate = motion.MotionGate(threshold=0.01, hold=1.0, keepalive=100.0)
+    gate.check(frame(), 0.0)
+    assert not gate.check(frame(), 5.0)
+    moved = frame()
+    moved[:24] = 250
+    assert gate.check(moved, 6.0)
+    assert gate.check(frame(), 6.5)
+    assert not gate.check(frame(), 7.5)
+
+
+def test_motion_outside_the_region_is_ignored():
+    gate = motion.MotionGate(threshold=0.01, region=(0.0, 0.0, 0.5, 1.0), hold=0.0,
+                             keepalive=100.0)
+    gate.check(frame(), 0.0)
+    moved = frame()
+    moved[:, 40:] = 250
+    assert not gate.check(moved, 1.0)
+    assert gate.skipped == 1
@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+pytest.importorskip('phue')
+
+import phillips_hue
+from fake_hue_bridge import FakeHueBridge
+
+ROBIN = 'Turdus migratorius (American Robin)'
+
+
+@pytest.fixture
+def bridge():
+    server = FakeHueBridge()
+    yield server
+    server.close()
+
+
+def make_controller(bridge, paused=False, **kwargs):
+    config = phillips_hue.load_config(None)
+    config.update({'bridge_ip': bridge.address, 'username': bridge.username,
+                   'birds': {ROBIN: [1000, 200, 150]}})
+    client = phillips_hue.connect_bridge(config)
+    kwargs.setdefault('coalesce', 0.05)
+    return phillips_hue.HueController(config, lambda: client, is_paused=lambda: paused,
+                                      **kwargs)
+
+
+def settle(controller, timeout=5):
+    """Waits until the controller has no pending intent."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with controller._cond:
+            idle = controller._desired is None
+        if idle:
+            time.sleep(0.2)
+            with controller._cond:
+                if controller._desired is None:
+                    return
+        time.sleep(0.01)
+
+
+def light_writes(bridge):
+    writes = [(path, body) for _, path, body in bridge.writes() if '/lights/' in path]
+    assert all(path.endswith('/lights/1/state') for path, _ in writes)
+    return [body for _, body in writes]
+
+
+def scene_writes(bridge):
+    return [body for _, path, body in bridge.writes() if '/groups/' in path]
+
+
+def test_bird_colour_is_applied(bridge):
+    controller = make_controller(bridge)
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.close()
+    assert light_writes(bridge) == [{'hue': 1000, 'sat': 200, 'bri': 150}]
+
+
+def test_burst_is_coalesced_to_the_latest_intent(bridge):
+    controller = make_controller(bridge, coalesce=0.2)
+    for _ in range(5):
+        controller.show_bird(ROBIN)
+        controller.restore()
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.close()
+    assert light_writes(bridge) == [{'hue': 1000, 'sat': 200, 'bri': 150}]
+    assert scene_writes(bridge) == []
+
+
+def test_unchanged_state_is_not_sent_again(bridge):
+    controller = make_controller(bridge)
+    controller.restore()
+    settle(controller)
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.restore()
+    settle(controller)
+    controller.close()
+    assert len(light_writes(bridge)) == 1
+    assert [body['scene'] for body in scene_writes(bridge)] == ['conc01']
+    assert controller.skipped == 2
+
+
+def test_birds_without_a_colour_are_ignored(bridge):
+    controller = make_controller(bridge)
+    controller.show_bird('Passer domesticus (House Sparrow)')
+    settle(controller)
+    controller.close()
+    assert bridge.writes() == []
+
+
+def test_missing_light_is_reported(bridge, capsys):
+    controller = make_controller(bridge)
+    controller.config['light'] = 'Porch Lights'
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.close()
+    assert light_writes(bridge) == []
+    assert 'Hue light not found: Porch Lights' in capsys.readouterr().out
+
+
+def test_paused_lights_are_left_alone(bridge):
+    controller = make_controller(bridge, paused=True)
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.close()
+    assert bridge.writes() == []
+
+
+def test_missing_bridge_is_skipped():
+    controller = phillips_hue.HueController(
+        dict(phillips_hue.DEFAULT_CONFIG, birds={ROBIN: [1, 2, 3]}), lambda: None,
+        coalesce=0.01)
+    controller.show_bird(ROBIN)
+    settle(controller)
+    controller.close()
+    assert (controller.commands, controller.skipped) == (0, 1)
+
+
+def test_token_bucket_paces_requests():
+    bucket = phillips_hue.TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.take()
+    # Two tokens are there up front, the other four arrive at 20 per second
+    assert time.monotonic() - start >= 0.18
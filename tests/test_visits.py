@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import motion
+import visits
+
+
+def run_still_bird(linger, keepalive, seconds=120, fps=10):
+    """A bird that sits still in front of a gated camera for seconds; returns
+    the visit events."""
+    gate = motion.MotionGate(threshold=0.01, keepalive=keepalive)
+    tracker = visits.VisitTracker(linger=visits.gated_linger(linger, keepalive))
+    frame = np.full((48, 64, 3), 90, dtype=np.uint8)
+    events = []
+    for n in range(seconds * fps):
+        now = (n + 0.3 * (n % 3)) / fps  # frames arrive with some jitter
+        if gate.check(frame, now):
+            events += tracker.update(now, [('bird', 0.9)])
+        else:
+            events += tracker.expire(now)
+    events += tracker.flush(seconds)
+    return events
+
+
+@pytest.mark.parametrize('linger, keepalive', [(2, 10), (10, 10)])
+def test_still_bird_is_one_visit(linger, keepalive):
+    events = run_still_bird(linger, keepalive)
+    assert [e.kind for e in events if e.kind != visits.VISIT_UPDATE] == \
+        [visits.VISIT_START, visits.VISIT_END]
+
+
+def test_gated_linger_outlasts_keepalive():
+    assert visits.gated_linger(2, 10) > 10
+    assert visits.gated_linger(30, 10) == 30
+
+
+def test_single_frame_does_not_start_a_visit():
+    tracker = visits.VisitTracker(window=3, votes=2)
+    assert tracker.update(0.0, [('bird', 0.9)]) == []
+    assert tracker.update(0.1, []) == []
+    events = tracker.update(0.2, [('bird', 0.9)])
+    assert [e.kind for e in events] == [visits.VISIT_START]
+
+
+def test_visit_ends_after_linger():
+    tracker = visits.VisitTracker(linger=2.0, window=1, votes=1)
+    tracker.update(0.0, [('bird', 0.9)])
+    assert tracker.expire(1.5) == []
+    events = tracker.expire(2.5)
+    assert [(e.kind, e.label, e.duration) for e in events] == [(visits.VISIT_END, 'bird', 0.0)]
+    assert tracker.visits == {}
+
+
+def test_smoothing_follows_the_newest_score():
+    tracker = visits.VisitTracker(alpha=0.5)
+    tracker.update(0.0, [('bird', 1.0)])
+    tracker.update(0.1, [])
+    assert tracker.smoothed['bird'] == pytest.approx(0.25)
+
+
+def test_best_frame_follows_the_peak_score():
+    released = []
+    tracker = visits.VisitTracker(window=1, votes=1, release=released.append)
+    for n, score in enumerate([0.8, 0.9, 0.85]):
+        tracker.update(n, [('bird', score)], capture=lambda n=n: 'frame%d' % n)
+    event, = tracker.flush(3)
+    assert (event.best, event.peak_score, event.top_score) == ('frame1', 0.9, 0.9)
+    assert released == ['frame0']
+
+
+def test_failed_capture_keeps_the_peak_with_the_held_frame():
+    tracker = visits.VisitTracker(window=1, votes=1)
+    tracker.update(0, [('bird', 0.8)], capture=lambda: 'frame0')
+    tracker.update(1, [('bird', 0.9)], capture=lambda: None)
+    event, = tracker.flush(2)
+    assert (event.best, event.peak_score, event.top_score) == ('frame0', 0.8, 0.9)
+
+
+def test_quality_breaks_ties_on_the_peak_score():
+    tracker = visits.VisitTracker(window=1, votes=1)
+    tracker.update(0, [('bird', 0.9)], capture=lambda: 'blurry', quality=lambda: 1.0)
+    tracker.update(1, [('bird', 0.9)], capture=lambda: 'sharp', quality=lambda: 5.0)
+    tracker.update(2, [('bird', 0.9)], capture=lambda: 'blurrier', quality=lambda: 0.5)
+    event, = tracker.flush(3)
+    assert event.best == 'sharp'